@@ -28,8 +28,6 @@ import ntpath
 import numpy
 import datetime
 import random
-import fnmatch
-import copy
 
 import bpy
 from bpy.props import (
@@ -41,6 +39,30 @@ from bpy.props import (
         FloatProperty,
         )
 
+from glimpse_render_plan import (
+        all_bodies,
+        default_clothing_sets,
+        default_render_settings,
+        frame_seed,
+        normalize_mocap_entry,
+        mocap_filter_reason,
+        parse_tags_skip,
+        skip_frame_randomly,
+        skip_frame_by_tag,
+        whitelist_bodies,
+        whitelist_clothing_sets,
+        clothing_epoch,
+        clothing_table,
+        choose_clothes,
+        camera_mode,
+        camera_trajectory,
+        camera_trajectory_key,
+        save_camera_trajectory,
+        load_camera_trajectory,
+        )
+import glimpse_frame_store
+import glimpse_render_timings
+
 bl_info = {
     "name": "Glimpse Training Data Generator",
     "description": "Tool to help generate skeleton tracking training data",
@@ -53,74 +75,6 @@ bl_info = {
     "wiki_url": "",
     "category": "Mesh"}
 
-# all_bodies = [ 'Man0', 'Woman0', 'Man1', 'Woman1', 'Man2', 'Woman2' ]
-
-# XXX: Woman1 black listed for now because the mocap doesn't make sense
-# with the large hips and the hands often intersect the hips which will
-# affect our labeling / training
-all_bodies = ['Man0', 'Woman0', 'Man1', 'Man2', 'Woman2']
-
-default_clothing_sets = {
-    "hat": [
-        {
-            "name": "none",
-            "probability": 0.4,
-        },
-        {
-            "name": "knitted_hat_01",
-            "probability": 0.2,
-        },
-        {
-            "name": "newsboy_cap",
-            "probability": 0.2,
-        },
-        {
-            "name": "patrol_cap",
-            "probability": 0.2,
-        },
-    ],
-    "glasses": [
-        {
-            "name": "none",
-            "probability": 0.7,
-        },
-        {
-            "name": "glasses",
-            "probability": 0.3,
-        },
-    ],
-    "top": [
-        {
-            "name": "none",
-            "probability": 0.8,
-        },
-        {
-            "name": "hooded_cardigan",
-            "probability": 0.2,
-        },
-
-        # XXX: start fleet uniform black listed for now because hands may
-        # intersect it too much resulting in labelling the hips as
-        # hands/wrists.
-        # {
-        #     "name": "star_fleet_uniform_female_gold_reference",
-        #     "probability": ,
-        # },
-    ],
-    "trousers": [
-        {
-            "name": "none",
-            "probability": 0.5,
-        },
-        {
-            "name": "m_trousers_01",
-            "probability": 0.5,
-        },
-    ],
-    # "shoes": [
-    # ],
-}
-
 hbars = [u"\u0020", u"\u258f", u"\u258e", u"\u258d", u"\u258b", u"\u258a", u"\u2589"]
 max_bar_width = 10
 
@@ -143,6 +97,365 @@ def mkdir_p(path):
     os.makedirs(path, exist_ok=True)
 
 
+# Once all the files for a frame (label .png, depth .exr and meta .json) have
+# been written the frame is recorded in a journal so that an interrupted
+# render can be resumed without re-rendering completed frames
+#
+# Instances of Blender that share a render directory each write their own
+# journal, named with the instance's GlimpsePartSuffix
+def journal_filename(directory, suffix=''):
+    return os.path.join(directory, 'render%s.journal' % suffix)
+
+
+completed_frames_cache = {}
+
+
+def load_completed_frames(journal_filenames):
+    """Returns the set of (bvh, body, frame) tuples listed in journals
+
+    journal_filenames is a os.pathsep separated string of journal files.
+    The result is cached since the same journals are checked for each job
+    when a Blender instance is handed multiple jobs. A persistent worker
+    clears the cache before each subcommand.
+    """
+    if journal_filenames in completed_frames_cache:
+        return completed_frames_cache[journal_filenames]
+
+    completed = set()
+    for filename in journal_filenames.split(os.pathsep):
+        if not filename:
+            continue
+        try:
+            with open(filename, 'r') as fp:
+                for line in fp:
+                    try:
+                        entry = json.loads(line)
+                        completed.add((entry['bvh'], entry['body'],
+                                       entry['frame']))
+                    except (ValueError, KeyError):
+                        # The last line may be incomplete if we crashed
+                        # while writing it
+                        pass
+        except IOError as e:
+            print("WARNING: Failed to read journal %s: %s" % (filename, e))
+        print("Loaded %s (%d completed frames so far)" %
+              (filename, len(completed)))
+
+    completed_frames_cache[journal_filenames] = completed
+    return completed
+
+
+def camera_world_matrix(camera):
+    """Returns what camera.matrix_world will be after the next scene update
+
+    This is computed directly from the camera's location, quaternion
+    rotation and scale so that moving the camera doesn't require another
+    scene.update() (which re-evaluates all the posed bodies too). It's only
+    valid for a camera without a parent or constraints.
+    """
+    scale = mathutils.Matrix(((camera.scale.x, 0, 0),
+                              (0, camera.scale.y, 0),
+                              (0, 0, camera.scale.z)))
+    mat4 = (camera.rotation_quaternion.to_matrix() * scale).to_4x4()
+    mat4.translation = camera.location
+    return mat4
+
+
+def camera_space_bones(pose_obj, camera_world_inverse_mat4):
+    """Returns the camera space (head, tail) positions of all pose bones
+
+    The positions are returned as an (n_bones, 2, 3) float32 array. They are
+    read from Blender in bulk and transformed with a single matrix multiply,
+    instead of transforming each head and tail with mathutils in Python.
+    """
+    bones = pose_obj.pose.bones
+    n_bones = len(bones)
+
+    heads = numpy.empty(n_bones * 3, dtype=numpy.float32)
+    tails = numpy.empty(n_bones * 3, dtype=numpy.float32)
+    bones.foreach_get('head', heads)
+    bones.foreach_get('tail', tails)
+
+    positions = numpy.empty((n_bones, 2, 3), dtype=numpy.float32)
+    positions[:, 0] = heads.reshape(n_bones, 3)
+    positions[:, 1] = tails.reshape(n_bones, 3)
+
+    mat4 = numpy.array(camera_world_inverse_mat4, dtype=numpy.float32)
+    return numpy.dot(positions, mat4[:3, :3].T) + mat4[:3, 3]
+
+
+manifest_frames_cache = {}
+
+
+def load_manifest_frames(manifest_filename):
+    """Returns the set of (bvh, body, frame) tuples listed in a manifest
+
+    A manifest has a JSON description of one frame per line. As with
+    journals, the result is cached for Blender instances handed multiple
+    jobs and cleared before each subcommand of a persistent worker.
+    """
+    if manifest_filename in manifest_frames_cache:
+        return manifest_frames_cache[manifest_filename]
+
+    frames = set()
+    with open(manifest_filename, 'r') as fp:
+        for line in fp:
+            entry = json.loads(line)
+            frames.add((entry['bvh'], entry['body'], entry['frame']))
+    print("Loaded %s (%d frames)" % (manifest_filename, len(frames)))
+
+    manifest_frames_cache[manifest_filename] = frames
+    return frames
+
+
+class BodyClothes:
+    """The clothing objects of a body, looked up once per render
+
+    .items maps the name of each clothing item that's available for the
+    body to the objects that make up that item, so changing clothes only
+    needs to toggle the objects of the items involved instead of searching
+    all the children of the body's pose object by name.
+    """
+
+    def __init__(self, body, clothing_sets):
+        pose_obj = bpy.data.objects[body + "PoseObject"]
+        prefix = body + "Clothes:"
+
+        self.objects = [child for child in pose_obj.children
+                        if prefix in child.name]
+        self.items = {}
+        for key in clothing_sets:
+            for entry in clothing_sets[key]:
+                name = entry['name']
+                if name == 'none' or prefix + name not in bpy.data.objects:
+                    continue
+                self.items[name] = [obj for obj in self.objects
+                                    if prefix + name in obj.name]
+        self.shown = None
+
+    def hide_all(self):
+        for obj in self.objects:
+            obj.hide = True
+            obj.layers = obj.parent.layers
+        self.shown = {}
+
+    def show(self, clothes):
+        """Makes just the given clothes visible on the render layer
+
+        clothes maps clothing set names to item names, as in a frame's
+        meta data.
+        """
+        if self.shown is None:
+            self.hide_all()
+        if clothes == self.shown:
+            return
+
+        for name in self.shown.values():
+            for obj in self.items.get(name, []):
+                obj.hide = True
+                obj.layers = obj.parent.layers
+        for name in clothes.values():
+            for obj in self.items.get(name, []):
+                obj.hide = False
+                obj.layers[0] = True
+        self.shown = dict(clothes)
+
+
+background_floor_name = "Background:Floor"
+background_walls_name = "Background:Walls"
+
+
+def build_background_scenery():
+    """Builds the background floor and walls, unless they already exist
+
+    The scenery is built directly with the data API (the walls being a
+    single mesh of randomly offset blocks) so it only takes a moment and
+    since it's built by the preload operator it's normally already saved in
+    the .blend file before rendering.
+    """
+    materials = bpy.data.materials
+    objects = bpy.data.objects
+
+    if "Scenery" not in materials:
+        if bpy.context.scene.GlimpseDebug:
+            print("> Scenery material created")
+        materials.new("Scenery")
+        materials["Scenery"].use_shadeless = True
+        # XXX: this can't conflict with the labels we use
+        # for the body, but it would obviously be better
+        # to not just hard code the colour here!
+        materials["Scenery"].diffuse_color = (0.3, 0.3, 0.3)
+    scenery_material = materials["Scenery"]
+
+    if background_floor_name not in objects:
+        floor_mesh = bpy.data.meshes.new(background_floor_name)
+        floor_mesh.from_pydata([(-50, -50, 0), (50, -50, 0),
+                                (50, 50, 0), (-50, 50, 0)],
+                               [], [(0, 1, 2, 3)])
+        floor_mesh.materials.append(scenery_material)
+        floor_mesh.update(calc_edges=True)
+
+        floor_obj = objects.new(background_floor_name, floor_mesh)
+        bpy.context.scene.objects.link(floor_obj)
+
+        if bpy.context.scene.GlimpseDebug:
+            print("> %s added" % background_floor_name)
+
+    if background_walls_name not in objects:
+        if bpy.context.scene.GlimpseDebug:
+            print("> Generating walls...")
+
+        wall_width = 10
+        wall_height = 10
+        room_sides = 3
+        wall_part_size = mathutils.Vector((1.0, 0.5, 0.5))
+        wall_start_pos = mathutils.Vector((-wall_width, wall_width / 3, 0))
+
+        # The walls are laid out relative to the origin with their own fixed
+        # seed so they always look the same
+        wall_random = random.Random(0)
+
+        # The back wall faces the origin and the two sides are rotated to
+        # face each other
+        wall_rot = mathutils.Quaternion(mathutils.Vector((0, 0, 1)),
+                                        math.radians(-90)).to_matrix().to_4x4()
+        side_pos = [
+            wall_start_pos,
+            mathutils.Vector((wall_part_size.x * wall_width,
+                              wall_part_size.y * 5,
+                              0)),
+            mathutils.Vector((wall_start_pos.x,
+                              wall_part_size.y * 5,
+                              wall_start_pos.z)),
+        ]
+        side_mat4 = [mathutils.Matrix.Translation(side_pos[0])]
+        for k in range(1, room_sides):
+            side_mat4.append(mathutils.Matrix.Translation(side_pos[k]) * wall_rot)
+
+        part_scale = mathutils.Matrix(((wall_part_size.x, 0, 0),
+                                       (0, wall_part_size.y, 0),
+                                       (0, 0, wall_part_size.z))).to_4x4()
+
+        cube_verts = [(1, 1, -1), (1, -1, -1), (-1, -1, -1), (-1, 1, -1),
+                      (1, 1, 1), (1, -1, 1), (-1, -1, 1), (-1, 1, 1)]
+        cube_faces = [(0, 1, 2, 3), (4, 7, 6, 5), (0, 4, 5, 1),
+                      (1, 5, 6, 2), (2, 6, 7, 3), (4, 0, 3, 7)]
+
+        verts = []
+        faces = []
+        for k in range(0, room_sides):
+            for i in range(0, wall_height):
+                for j in range(0, wall_width):
+                    wall_depth = wall_random.randrange(-1, 1)
+                    part_pos = mathutils.Vector((j * (wall_part_size.x * 2),
+                                                 wall_depth,
+                                                 i))
+                    part_mat4 = (side_mat4[k] *
+                                 mathutils.Matrix.Translation(part_pos) *
+                                 part_scale)
+
+                    base = len(verts)
+                    for v in cube_verts:
+                        verts.append(part_mat4 * mathutils.Vector(v))
+                    for f in cube_faces:
+                        faces.append(tuple(base + index for index in f))
+
+        walls_mesh = bpy.data.meshes.new(background_walls_name)
+        walls_mesh.from_pydata(verts, [], faces)
+        walls_mesh.materials.append(scenery_material)
+        walls_mesh.update(calc_edges=True)
+
+        walls_obj = objects.new(background_walls_name, walls_mesh)
+        bpy.context.scene.objects.link(walls_obj)
+
+        if bpy.context.scene.GlimpseDebug:
+            print("> %s added" % background_walls_name)
+
+
+def show_background_scenery(show):
+    """Shows or hides the background floor and walls, building them if needed"""
+    if show:
+        build_background_scenery()
+
+    for name in (background_floor_name, background_walls_name):
+        if name in bpy.data.objects:
+            obj = bpy.data.objects[name]
+            obj.hide = not show
+            obj.hide_render = not show
+            if show:
+                obj.layers[0] = True
+
+
+def scene_render_settings():
+    """The current render settings, as used by glimpse_render_plan"""
+    return {name: getattr(bpy.context.scene, name)
+            for name in default_render_settings}
+
+
+# Noise based camera movement, to simulate the smooth movement of a hand
+# holding a phone camera. This depends on Blender's noise functions so isn't
+# handled by glimpse_render_plan.camera_trajectory()
+def add_smooth_camera_movement(trajectory, bvh_fps, settings):
+    frequency = settings['GlimpseSmoothCameraFrequency']
+
+    def perlin_noise(frame, seed):
+        frame_time = (1 / bvh_fps) * frame * frequency
+        position = mathutils.Vector((frame_time, 0, seed))
+        return mathutils.noise.noise(position, mathutils.noise.types.STDPERLIN)
+
+    # mid points and ranges based on min and max values
+    min_height_mm = settings['GlimpseMinCameraHeightMM']
+    height_range_mm = settings['GlimpseMaxCameraHeightMM'] - min_height_mm
+    mid_height_mm = min_height_mm + (height_range_mm / 2)
+    min_dist_mm = settings['GlimpseMinCameraDistanceMM']
+    dist_range_mm = settings['GlimpseMaxCameraDistanceMM'] - min_dist_mm
+    mid_dist_mm = min_dist_mm + (dist_range_mm / 2)
+    min_view_angle = settings['GlimpseMinViewingAngle']
+    view_angle_range = settings['GlimpseMaxViewingAngle'] - min_view_angle
+    mid_view_angle = min_view_angle + (view_angle_range / 2)
+
+    # separate noise 'seeds' for each factor of the camera placement
+    height_seed = 1
+
+    for i, frame in enumerate(trajectory['frame'].tolist()):
+        trajectory['height_mm'][i] = (mid_height_mm +
+                                      perlin_noise(frame, height_seed) *
+                                      height_range_mm)
+        trajectory['distance_mm'][i] = (mid_dist_mm +
+                                        perlin_noise(frame, height_seed + 1) *
+                                        dist_range_mm)
+        trajectory['viewing_angle'][i] = (mid_view_angle +
+                                          perlin_noise(frame, height_seed + 2) *
+                                          view_angle_range)
+        trajectory['target_offset_mm'][i] = [
+            perlin_noise(frame, height_seed + 3 + axis) for axis in range(3)]
+
+
+def load_or_compute_camera_trajectory(bvh, body, settings, cache_dir=None):
+    """Returns the camera_trajectory() for a (bvh, body) pass
+
+    If a cache_dir is given the trajectory is saved there as
+    <bvh>/<body>.npz and reused by later renders with the same settings.
+    """
+    filename = None
+    if cache_dir:
+        key = camera_trajectory_key(bvh, body, settings)
+        filename = os.path.join(cache_dir, bvh['name'], body + '.npz')
+        trajectory = load_camera_trajectory(filename, key)
+        if trajectory is not None:
+            return trajectory
+
+    trajectory = camera_trajectory(bvh, body, settings)
+    if camera_mode(settings) == 'smooth':
+        add_smooth_camera_movement(trajectory, bvh['fps'], settings)
+
+    if filename:
+        mkdir_p(os.path.dirname(filename))
+        save_camera_trajectory(filename, trajectory, key)
+
+    return trajectory
+
+
 class BvhIndex:
     index = []
     pos = 0
@@ -162,25 +475,7 @@ class BvhIndex:
 
                     self.filename_map[bvh['file']] = bvh
 
-                    # normalize so we don't have to consider that it's left unspecified
-                    if 'blacklist' not in bvh:
-                        bvh['blacklist'] = False
-
-                    if 'tags' not in bvh:
-                        bvh['tags'] = {'unknown'}
-
-                    # So we can start to just use tag-based blacklisting...
-                    if bvh['blacklist'] and 'blacklist' not in bvh['tags']:
-                        bvh['tags']['blacklist'] = True
-
-                    if 'start' not in bvh:
-                        bvh['start'] = 1
-
-                    if 'name' not in bvh:
-                        bvh['name'] = ntpath.basename(bvh['file'])[:-4]
-
-                    if 'fps' not in bvh:
-                        bvh['fps'] = 120
+                    normalize_mocap_entry(bvh)
 
                     if 'end' not in bvh:
                         bvh_name = bvh['name']
@@ -274,38 +569,14 @@ class BvhFilteredIndex:
         for i in range(start, end):
             bvh = full_index[i]
 
-            if tags_whitelist:
-                matched_whitelist = False
-                for tag in tags_whitelist:
-                    if tag in bvh['tags']:
-                        matched_whitelist = True
-                        break
-                if not matched_whitelist:
-                    if bpy.context.scene.GlimpseDebug and bpy.context.scene.GlimpseVerbose:
-                        print("> filtered out %s: tags didn't match whitelist" % bvh['name'])
-                    continue
-
-            if tags_blacklist:
-                matched_blacklist = False
-                for tag in tags_blacklist:
-                    if tag in bvh['tags']:
-                        matched_blacklist = True
-                        break
-                if matched_blacklist:
-                    if bpy.context.scene.GlimpseDebug and bpy.context.scene.GlimpseVerbose:
-                        print("> filtered out %s: tags matched blacklist" % bvh['name'])
-                    continue
-
-            if name_patterns is not None:
-                matched_name = False
-                for match in name_patterns:
-                    if fnmatch.fnmatch(bvh['name'], match):
-                        matched_name = True
-                        break
-                if not matched_name:
-                    if bpy.context.scene.GlimpseDebug and bpy.context.scene.GlimpseVerbose:
-                        print("> filtered out %s: didn't match name patterns" % bvh['name'])
-                    continue
+            reason = mocap_filter_reason(bvh,
+                                         name_patterns=name_patterns,
+                                         tags_whitelist=tags_whitelist,
+                                         tags_blacklist=tags_blacklist)
+            if reason is not None:
+                if bpy.context.scene.GlimpseDebug and bpy.context.scene.GlimpseVerbose:
+                    print("> filtered out %s: %s" % (bvh['name'], reason))
+                continue
 
             # Collect some stats about the bvh tags as we build the
             # index...
@@ -580,6 +851,12 @@ class GeneratorPreLoadOperator(bpy.types.Operator):
 
                     load_bvh_file(bvh_state)
 
+        # The background scenery is also built up front so that it's saved
+        # along with the preloaded mocaps, hidden until a render needs it
+        if not bpy.context.scene.GlimpseDryRun:
+            build_background_scenery()
+            show_background_scenery(False)
+
         return {'FINISHED'}
 
 
@@ -651,6 +928,7 @@ class GeneratorOperator(bpy.types.Operator):
         meta = {}
         frame_count = 0
         frame_skip_count = 0
+        frame_resume_count = 0
 
         # stats
         clothes_stats = {}
@@ -701,6 +979,20 @@ class GeneratorOperator(bpy.types.Operator):
 
         camera = bpy.data.objects['Camera']
 
+        # Unless the camera depends on other objects we can work out its
+        # world matrix without having to update the scene again after moving
+        # it, so the scene is only evaluated once per frame, by frame_set()
+        camera_needs_update = (camera.parent is not None or
+                               len(camera.constraints) > 0)
+
+        # For measuring the cost of the scene updates that older versions
+        # made after frame_set() and after moving the camera
+        legacy_scene_updates = bpy.context.scene.GlimpseLegacySceneUpdates
+        if legacy_scene_updates:
+            camera_needs_update = True
+
+        frame_timer = glimpse_render_timings.StageTimer()
+
         z_forward = mathutils.Vector((0, 0, 1))
 
         res_x = bpy.context.scene.render.resolution_x = bpy.context.scene.GlimpseRenderWidth
@@ -755,39 +1047,69 @@ class GeneratorOperator(bpy.types.Operator):
             print("Parsing GlimpseBvhTagsSkip='%s'" %
                   bpy.context.scene.GlimpseBvhTagsSkip)
 
-        tags_skipped = {}
-        if (bpy.context.scene.GlimpseBvhTagsSkip and
-                bpy.context.scene.GlimpseBvhTagsSkip != 'none'):
-            for skip_tag in bpy.context.scene.GlimpseBvhTagsSkip.split(","):
-                tag_data = skip_tag.split("=")
-                tags_skipped[tag_data[0]] = tag_data[1]
-
-        if bpy.context.scene.GlimpseClothesWhitelist != 'all':
-            clothing_sets = copy.deepcopy(default_clothing_sets)
-
-            clothes_whitelist = bpy.context.scene.GlimpseClothesWhitelist.split(',')
-            whitelist_as_set = set(clothes_whitelist)
-            for key in clothing_sets:
-                clothing_sets[key] = [entry for entry in clothing_sets[key]
-                                      if entry['name'] in whitelist_as_set]
-                # probabilities may no longer add up to 1.0 so
-                # re-normalize...
-                total = 0
-                for entry in clothing_sets[key]:
-                    total += entry['probability']
-                for entry in clothing_sets[key]:
-                    entry['probability'] = entry['probability'] / total
-        else:
-            clothing_sets = default_clothing_sets
+        tags_skipped = parse_tags_skip(bpy.context.scene.GlimpseBvhTagsSkip)
+
+        render_settings = scene_render_settings()
+
+        camera_trajectories_dir = None
+        if (bpy.context.scene.GlimpseCameraTrajectories and
+                not bpy.context.scene.GlimpseDryRun):
+            camera_trajectories_dir = os.path.join(abs_gen_dir, 'cameras')
+
+        clothing_sets = whitelist_clothing_sets(
+            bpy.context.scene.GlimpseClothesWhitelist)
 
         if bpy.context.scene.GlimpseDebug:
             print("Available clothing sets = %s" % str(clothing_sets))
 
+        clothes_table = clothing_table(clothing_sets)
+        body_clothes = {}
+        for body in all_bodies:
+            body_clothes[body] = BodyClothes(body, clothing_sets)
+
         top_meta_filename = os.path.join(abs_gen_dir, 'meta.json')
 
+        # Other instances may be rendering into the same directory (with the
+        # same settings) so meta.json is replaced atomically
+        part_suffix = bpy.context.scene.GlimpsePartSuffix
         if not bpy.context.scene.GlimpseDryRun:
-            with open(top_meta_filename, 'w') as fp:
+            tmp_filename = top_meta_filename + part_suffix + '.tmp'
+            with open(tmp_filename, 'w') as fp:
                 json.dump(top_meta, fp, indent=2)
+            os.rename(tmp_filename, top_meta_filename)
+
+        completed_frames = set()
+        if bpy.context.scene.GlimpseResumeJournals:
+            completed_frames = load_completed_frames(
+                bpy.context.scene.GlimpseResumeJournals)
+
+        manifest_frames = None
+        if bpy.context.scene.GlimpseManifest:
+            manifest_frames = load_manifest_frames(
+                bpy.context.scene.GlimpseManifest)
+
+        journal_fp = None
+        if not bpy.context.scene.GlimpseDryRun:
+            journal_fp = open(journal_filename(abs_gen_dir, part_suffix), 'a')
+
+        # Instead of writing a .json file per frame the meta data may be
+        # appended to a consolidated store (see glimpse_frame_store.py)
+        meta_writer = None
+        render_bodies = whitelist_bodies(bpy.context.scene.GlimpseBodyWhitelist)
+        if (not bpy.context.scene.GlimpseDryRun and
+                bpy.context.scene.GlimpseMetaFormat == 'store' and
+                render_bodies):
+            pose_obj = bpy.data.objects[render_bodies[0] + 'PoseObject']
+            bone_names = [bone.name for bone in pose_obj.pose.bones]
+            meta_writer = glimpse_frame_store.FrameMetaWriter(
+                abs_gen_dir, bone_names,
+                {'date': date_str, 'camera': dict(camera_meta)},
+                name=glimpse_frame_store.default_store_name + part_suffix)
+
+        # Turn the background (floor and walls) on or off depending on the
+        # set flag
+        if not bpy.context.scene.GlimpseDryRun:
+            show_background_scenery(bpy.context.scene.GlimpseAddBackground)
 
         # Nested function for sake of improving cProfile data
         def render_bvh(bvh):
@@ -801,14 +1123,9 @@ class GeneratorOperator(bpy.types.Operator):
 
             print("> Rendering " + bvh_name)
 
-            numpy.random.seed(0)
-            random.seed(0)
-
             bpy.context.scene.frame_start = bvh['start']
             bpy.context.scene.frame_end = bvh['end']
 
-            bvh_fps = bvh['fps']
-
             if bpy.context.scene.GlimpseDebug and bpy.context.scene.GlimpseVerbose:
                 print("> Setting %s action on all body meshes" % action_name)
             assign_body_poses(action_name)
@@ -818,45 +1135,18 @@ class GeneratorOperator(bpy.types.Operator):
             # Nested function for sake of improving cProfile data
             def render_body(body):
 
-                def hide_body_clothes(body):
-                    pose_obj = bpy.data.objects[body + "PoseObject"]
-                    for child in pose_obj.children:
-                        if body + "Clothes:" in child.name:
-                            child.hide = True
-                            child.layers = child.parent.layers
-
-                # Make sure the clothes defined in meta are visible on the
-                # render layer
-                def show_body_clothes_from_meta(body):
-                    pose_obj = bpy.data.objects[body + "PoseObject"]
-                    if 'clothes' in meta:
-                        for key in meta['clothes']:
-                            for child in pose_obj.children:
-                                if body + "Clothes:" + meta['clothes'][key] in child.name:
-                                    child.hide = False
-                                    child.layers[0] = True
-
                 # Make sure no other bodies are visible on the render layer
                 def hide_bodies_from_render():
                     for _body in all_bodies:
                         mesh_obj = bpy.data.objects[_body + "BodyMeshObject"]
                         mesh_obj.layers[0] = False
-                        hide_body_clothes(_body)
+                        body_clothes[_body].hide_all()
                         bpy.data.armatures[_body + 'Pose'].pose_position = 'REST'
 
-                dist_mm = 0
-                view_angle = 0
-                height_mm = 0
-                target_x_mm = 0
-                target_y_mm = 0
-                target_z_mm = 0
                 camera_location = mathutils.Vector((0, 0, 0))
                 target = mathutils.Vector((0, 0, 0))
                 is_camera_pointing = False
 
-                # random seed when smooth_camera_movement is true
-                height_seed = 1
-
                 if bpy.context.scene.GlimpseDebug:
                     print("> Rendering with " + body)
 
@@ -865,6 +1155,7 @@ class GeneratorOperator(bpy.types.Operator):
                 hide_bodies_from_render()
 
                 body_pose = bpy.data.objects[body + "PoseObject"]
+                bone_names = [bone.name for bone in body_pose.pose.bones]
                 body_obj = bpy.data.objects[body + "BodyMeshObject"]
                 body_obj.layers[0] = True
                 bpy.data.armatures[body + 'Pose'].pose_position = 'POSE'
@@ -874,15 +1165,55 @@ class GeneratorOperator(bpy.types.Operator):
 
                 # bpy.data.objects['Camera'].constraints['Track To'].target = body_pose
 
+                # The camera placement (relative to the focus bone) is worked
+                # out for the whole pass up front, so the frame loop only has
+                # to apply it
+                trajectory = load_or_compute_camera_trajectory(
+                    bvh, body, render_settings, camera_trajectories_dir)
+                first_frame = int(bvh['start'])
+
+                focus_bone_name = bpy.context.scene.GlimpseFocusBone
+                focus = body_pose.pose.bones[focus_bone_name]
+
+                # The fixed camera location and pointing are based on the
+                # first frame of the sequence, whether or not that frame is
+                # rendered, so they don't depend on which subset of frames
+                # gets rendered
+                if (is_camera_fixed and not is_camera_debug and
+                        len(trajectory['frame'])):
+                    bpy.context.scene.frame_set(first_frame)
+
+                    person_forward_2d = (focus.matrix.to_3x3() *
+                                         z_forward).xy.normalized()
+                    person_forward = mathutils.Vector((person_forward_2d.x,
+                                                       person_forward_2d.y,
+                                                       0))
+                    dist_m = float(trajectory['distance_mm'][0]) / 1000
+                    view_angle = float(trajectory['viewing_angle'][0])
+                    view_rot = mathutils.Quaternion((0, 0, 1), math.radians(view_angle))
+                    person_forward.rotate(view_rot)
+                    camera_location = focus.head.xy + dist_m * person_forward.xy
+                    target = focus.head.copy()
+
                 # Hit some errors with the range bounds not being integer and I
                 # guess that comes from the json library loading our mocap
                 # index may make some numeric fields float so bvh['start'] or
                 # bvh['end'] might be float
+                clothes_epoch = None
                 for frame in range(int(bvh['start']), int(bvh['end'])):
 
                     nonlocal frame_skip_count
 
-                    if random.randrange(0, 100) < bpy.context.scene.GlimpseSkipPercentage:
+                    if (manifest_frames is not None and
+                            (bvh_name, body, frame) not in manifest_frames):
+                        continue
+
+                    # See frame_seed()
+                    frame_random = random.Random(
+                        frame_seed(bvh_name, body, frame))
+
+                    if skip_frame_randomly(frame_random,
+                                           bpy.context.scene.GlimpseSkipPercentage):
                         frame_skip_count += 1
                         for tag in bvh['tags']:
                             tag_skip_stats[tag] = tag_skip_stats.get(tag, 0) + 1
@@ -890,13 +1221,8 @@ class GeneratorOperator(bpy.types.Operator):
                             print("> Skipping (randomized) " + bvh_name + " frame " + str(frame))
                         continue
 
-                    skip = False
-                    tag_name = ""
-                    for tag in tags_skipped:
-                        if tag in bvh['tags'] and random.randrange(0, 100) < int(tags_skipped[tag]):
-                            skip = True
-                            break
-                    if skip:
+                    tag_name = skip_frame_by_tag(frame_random, bvh, tags_skipped)
+                    if tag_name is not None:
                         frame_skip_count += 1
                         for tag in bvh['tags']:
                             tag_skip_stats[tag] = tag_skip_stats.get(tag, 0) + 1
@@ -929,160 +1255,28 @@ class GeneratorOperator(bpy.types.Operator):
 
                     meta['frame'] = frame
 
-                    # The scene update and frame_set can be relatively slow
-                    # and since they don't affect the collection of stats
-                    # during a dry-run we can avoid skip them for faster
-                    # results...
-                    if not bpy.context.scene.GlimpseDryRun:
-                        bpy.context.scene.frame_set(frame)
-                        context.scene.update()
-
-                    # turn off/on the background (floor and walls) depending
-                    # on the set flag
-                    add_background = bpy.context.scene.GlimpseAddBackground
-                    if add_background:
-                        materials = bpy.data.materials
-
-                        if bpy.context.scene.GlimpseDebug and bpy.context.scene.GlimpseVerbose:
-                            print("> Generating background...")
-                        if "Scenery" not in materials:
-                            if bpy.context.scene.GlimpseDebug:
-                                print("> Scenery material created")
-                            materials.new("Scenery")
-                            materials[("Scenery")].use_shadeless = True
-                            # XXX: this can't conflict with the labels we use
-                            # for the body, but it would obviously be better
-                            # to not just hard code the colour here!
-                            materials[("Scenery")].diffuse_color = (0.3, 0.3, 0.3)
-
-                        floor_obj_name = "Background:Floor"
-                        if floor_obj_name not in bpy.data.objects:
-                            bpy.ops.mesh.primitive_plane_add(radius=50, location=(0, 0, 0))
-                            bpy.context.active_object.name = floor_obj_name
-
-                            if len(bpy.context.active_object.material_slots) == 0:
-                                bpy.ops.object.material_slot_add()
-                                bpy.context.active_object.material_slots[0].material = materials['Scenery']
-
-                            if bpy.context.scene.GlimpseDebug:
-                                print("> Background:Floor added")
-
-                        floor_obj = bpy.data.objects[floor_obj_name]
-                        floor_obj.hide = False
-                        floor_obj.layers[0] = True
-
-                        wall_obj_name = "Background:Wall"
-                        if wall_obj_name not in bpy.data.objects:
-                            if bpy.context.scene.GlimpseDebug:
-                                print("> Generating walls...")
-                            objects = bpy.data.objects
-                            wall_width = 10
-                            wall_height = 10
-                            room_sides = 3
-                            wall_part_size = mathutils.Vector((1.0, 0.5, 0.5))
-
-                            # Create an empty mesh and the object.
-                            wall_start_pos = (body_pose.pose.bones['pelvis'].location +
-                                              mathutils.Vector((-wall_width, wall_width / 3, 0)))
-                            wall_empty = bpy.data.objects.new("Background:Wall", None)
-                            bpy.context.scene.objects.link(wall_empty)
-                            wall_empty.location = wall_start_pos
-
-                            for k in range(0, room_sides):
-
-                                wall_side = bpy.data.objects.new("Wall:Side_%s" % k, None)
-                                bpy.context.scene.objects.link(wall_side)
-                                wall_side.location = wall_start_pos
-
-                                for i in range(0, wall_height):
-                                    for j in range(0, wall_width):
-                                        wall_depth = random.randrange(-1, 1)
-                                        bpy.ops.mesh.primitive_cube_add(
-                                            location=(wall_start_pos.x + (j * (wall_part_size.x * 2)),
-                                                      wall_start_pos.y + wall_depth,
-                                                      wall_start_pos.z + i))
-                                        bpy.ops.transform.resize(
-                                            value=(wall_part_size.x,
-                                                   wall_part_size.y,
-                                                   wall_part_size.z))
-                                        bpy.context.active_object.name = ("WallSide_%s_Part_%s_%s" % (k, i, j))
-
-                                        if len(bpy.context.active_object.material_slots) == 0:
-                                            bpy.ops.object.material_slot_add()
-                                            bpy.context.active_object.material_slots[0].material = materials['Scenery']
-
-                                        bpy.context.active_object.select = True
-                                        wall_side.select = True
-                                        bpy.context.scene.objects.active = wall_side
-                                        bpy.ops.object.parent_set(type='OBJECT')
-                                        bpy.ops.object.select_all(action='DESELECT')
-
-                                wall_side.select = True
-                                wall_empty.select = True
-                                bpy.context.scene.objects.active = wall_empty
-                                bpy.ops.object.parent_set(type='OBJECT')
-                                bpy.ops.object.select_all(action='DESELECT')
-
-                            side1 = objects["Wall:Side_1"]
-                            side2 = objects["Wall:Side_2"]
-
-                            wall_rot = mathutils.Quaternion(mathutils.Vector((0, 0, 1)),
-                                                            math.radians(-90))
-
-                            side1_pos = mathutils.Vector((wall_part_size.x * wall_width,
-                                                          wall_part_size.y * 5,
-                                                          0))
-                            side1.location = side1_pos
-                            side1.rotation_mode = 'QUATERNION'
-                            side1.rotation_quaternion = wall_rot
-
-                            side2_pos = mathutils.Vector((wall_start_pos.x,
-                                                          wall_part_size.y * 5,
-                                                          wall_start_pos.z))
-                            side2.location = side2_pos
-                            side2.rotation_mode = 'QUATERNION'
-                            side2.rotation_quaternion = wall_rot
-
-                            if bpy.context.scene.GlimpseDebug:
-                                print("> Background:Wall added")
-
-                        wall_obj = bpy.data.objects[wall_obj_name]
-                        for obj in wall_obj.children:
-                            obj.hide = False
-                            obj.layers[0] = True
-
-                    if ('clothes' not in meta or
-                            (bpy.context.scene.GlimpseClothingStep > 0 and
-                             frame % bpy.context.scene.GlimpseClothingStep == 0)):
+                    # The clothing is randomized every GlimpseClothingStep
+                    # frames, seeded by the first frame of each step so the
+                    # choice doesn't depend on which frames came before
+                    frame_clothes_epoch = clothing_epoch(
+                        bvh, frame, bpy.context.scene.GlimpseClothingStep)
+                    if frame_clothes_epoch != clothes_epoch:
+                        clothes_epoch = frame_clothes_epoch
 
                         if bpy.context.scene.GlimpseDebug and bpy.context.scene.GlimpseVerbose:
                             print("> Randomizing clothing")
 
                         clothes_meta = {}
 
-                        for key in clothing_sets:
-                            if bpy.context.scene.GlimpseDebug and bpy.context.scene.GlimpseVerbose:
-                                print(" > picking %s" % key)
-                            clothing_set = clothing_sets[key]
-                            set_choices = [entry['name'] for entry in clothing_set]
-                            set_probabilities = [entry['probability'] for entry in clothing_set]
-
-                            if not len(set_choices):
-                                if bpy.context.scene.GlimpseDebug and bpy.context.scene.GlimpseVerbose:
-                                    print("  > no choice found for %s" % key)
-                                continue
-
-                            set_choice = numpy.random.choice(set_choices, p=set_probabilities)
-                            if set_choices == 'none':
-                                if bpy.context.scene.GlimpseDebug and bpy.context.scene.GlimpseVerbose:
-                                    print("  > %s = none" % key)
-                                continue
+                        clothes = choose_clothes(bvh_name, body, clothes_epoch,
+                                                 clothes_table)
+                        for key in sorted(clothes):
+                            set_choice = clothes[key]
 
                             if bpy.context.scene.GlimpseDebug and bpy.context.scene.GlimpseVerbose:
                                 print("  > %s = %s" % (key, set_choice))
 
-                            choice_obj_name = "%sClothes:%s" % (body, set_choice)
-                            if choice_obj_name in bpy.data.objects:
+                            if set_choice in body_clothes[body].items:
                                 clothes_meta[key] = set_choice
                             else:
                                 if bpy.context.scene.GlimpseDebug and bpy.context.scene.GlimpseVerbose:
@@ -1103,24 +1297,43 @@ class GeneratorOperator(bpy.types.Operator):
                             bpy.context.scene.GlimpseShowStats):
                         continue
 
-                    hide_body_clothes(body)
-                    show_body_clothes_from_meta(body)
+                    # Since nothing depends on the frames before, frames
+                    # completed by a previous run can simply be skipped
+                    if (bvh_name, body, frame) in completed_frames:
+                        nonlocal frame_resume_count
+                        frame_resume_count += 1
+                        if bpy.context.scene.GlimpseDebug and bpy.context.scene.GlimpseVerbose:
+                            print("> Skipping (already rendered) " + bvh_name +
+                                  " frame " + str(frame) + " with " + body)
+                        continue
 
-                    # Randomize the placement of the camera...
+                    # frame_set() evaluates the poses for the new frame so
+                    # no scene.update() is needed before reading the bones
+                    frame_timer.start_frame()
+                    bpy.context.scene.frame_set(frame)
+                    frame_timer.count('scene evaluations')
+                    frame_timer.mark('frame_set')
+                    if legacy_scene_updates:
+                        context.scene.update()
+                        frame_timer.count('scene evaluations')
+                        frame_timer.mark('scene update')
+
+                    # Make sure the clothes defined in meta are visible on
+                    # the render layer
+                    body_clothes[body].show(meta['clothes'])
+
+                    frame_timer.mark('clothes')
+
+                    # Place the camera according to the trajectory...
                     #
                     # See RandomizedCamView script embedded in
                     # glimpse-training.blend for an experimental copy of this
                     # code where it's easy to get interactive feedback / test
                     # that it's working (Alt-P to run)
-                    focus_bone_name = bpy.context.scene.GlimpseFocusBone
-                    focus = body_pose.pose.bones[focus_bone_name]
-                    person_forward_2d = (focus.matrix.to_3x3() *
-                                         z_forward).xy.normalized()
-
-                    # Vector.rotate doesn't work for 2D vectors...
-                    person_forward = mathutils.Vector((person_forward_2d.x,
-                                                       person_forward_2d.y,
-                                                       0))
+                    traj_pos = frame - first_frame
+                    dist_m = float(trajectory['distance_mm'][traj_pos]) / 1000
+                    view_angle = float(trajectory['viewing_angle'][traj_pos])
+                    height_mm = float(trajectory['height_mm'][traj_pos])
 
                     if is_camera_debug:
                         rot = mathutils.Quaternion((0.707, 0.707, 0, 0))
@@ -1131,105 +1344,34 @@ class GeneratorOperator(bpy.types.Operator):
                         dist_m = 3
                         view_angle = 0
 
-                    # the distance to the camera as well as the
-                    # angle needs to be fixed if set in parameter
                     elif is_camera_fixed:
 
-                        dist_mm = min_distance_mm
-                        dist_m = dist_mm / 1000
-                        view_angle = min_viewing_angle
-                        height_mm = min_height_mm
-                        target_x_mm = focus.head.x * 1000
-                        target_y_mm = focus.head.y * 1000
-                        target_z_mm = focus.head.z * 1000
-
-                        # fixed camera location
-                        if camera_location.length == 0:
-                            view_rot = mathutils.Quaternion((0, 0, 1), math.radians(view_angle))
-                            person_forward.rotate(view_rot)
-                            person_forward_2d = person_forward.xy
-                            camera_location = focus.head.xy + dist_m * person_forward_2d
-
-                        # fixed camera pointing
-                        if target.length == 0:
-                            target = mathutils.Vector((target_x_mm / 1000,
-                                                       target_y_mm / 1000,
-                                                       target_z_mm / 1000))
-
-                        # reset camera pointing
+                        # location and pointing were determined before
+                        # rendering the first frame
                         is_camera_pointing = False
 
-                    elif is_camera_smooth_movement:
-
-                        # add perlin noise to all factors of the camera
-                        # final position for a given frame to simulate
-                        # the smooth movement of a hand holding a phone camera
-
-                        # mid points and ranges based on min and max values
-                        height_range_mm = max_height_mm - min_height_mm
-                        mid_height_mm = min_height_mm + (height_range_mm / 2)
-                        dist_range_mm = max_distance_mm - min_distance_mm
-                        mid_dist_mm = min_distance_mm + (dist_range_mm / 2)
-                        view_angle_range_mm = max_viewing_angle - min_viewing_angle
-                        mid_view_angle = min_viewing_angle + (view_angle_range_mm / 2)
-
-                        def perlin_noise(frame, bvh_fps, frequency, seed):
-                            frame_time = (1 / bvh_fps) * frame * frequency
-                            position = mathutils.Vector((frame_time, 0, seed))
-                            noise = mathutils.noise.noise(position, mathutils.noise.types.STDPERLIN)
-                            return noise
-
-                        height_mm = mid_height_mm + (perlin_noise(frame, bvh_fps, frequency, height_seed) * height_range_mm)
-                        dist_mm = mid_dist_mm + (perlin_noise(frame, bvh_fps, frequency, height_seed + 1) * dist_range_mm)
-                        dist_m = dist_mm / 1000
-                        view_angle = mid_view_angle + (perlin_noise(frame, bvh_fps, frequency, height_seed + 2) * view_angle_range_mm)
-
-                        target_x_mm = (focus.head.x * 1000) + perlin_noise(frame, bvh_fps, frequency, height_seed + 3)
-                        target_y_mm = (focus.head.y * 1000) + perlin_noise(frame, bvh_fps, frequency, height_seed + 4)
-                        target_z_mm = (focus.head.z * 1000) + perlin_noise(frame, bvh_fps, frequency, height_seed + 5)
-
-                        # smooth camera location
-                        view_rot = mathutils.Quaternion((0, 0, 1), math.radians(view_angle))
-
-                        person_forward.rotate(view_rot)
-                        person_forward_2d = person_forward.xy
-                        camera_location = focus.head.xy + dist_m * person_forward_2d
-
-                        # smooth camera target pointing
-                        target = mathutils.Vector((target_x_mm / 1000,
-                                                   target_y_mm / 1000,
-                                                   target_z_mm / 1000))
-
                     else:
 
-                        dist_mm = random.randrange(min_distance_mm, max_distance_mm)
-                        dist_m = dist_mm / 1000
-                        view_angle = random.randrange(min_viewing_angle, max_viewing_angle)
-                        height_mm = random.randrange(min_height_mm, max_height_mm)
-
-                        # We roughly point the camera at the focus bone but randomize
-                        # this a little...
-                        target_fuzz_range_mm = 100
-                        focus_x_mm = focus.head.x * 1000
-                        focus_y_mm = focus.head.y * 1000
-                        focus_z_mm = focus.head.z * 1000
-                        target_x_mm = random.randrange(int(focus_x_mm - target_fuzz_range_mm),
-                                                       int(focus_x_mm + target_fuzz_range_mm))
-                        target_y_mm = random.randrange(int(focus_y_mm - target_fuzz_range_mm),
-                                                       int(focus_y_mm + target_fuzz_range_mm))
-                        target_z_mm = random.randrange(int(focus_z_mm - target_fuzz_range_mm),
-                                                       int(focus_z_mm + target_fuzz_range_mm))
+                        person_forward_2d = (focus.matrix.to_3x3() *
+                                             z_forward).xy.normalized()
+
+                        # Vector.rotate doesn't work for 2D vectors...
+                        person_forward = mathutils.Vector((person_forward_2d.x,
+                                                           person_forward_2d.y,
+                                                           0))
 
                         # camera location
                         view_rot = mathutils.Quaternion((0, 0, 1), math.radians(view_angle))
                         person_forward.rotate(view_rot)
-                        person_forward_2d = person_forward.xy
-                        camera_location = focus.head.xy + dist_m * person_forward_2d
+                        camera_location = focus.head.xy + dist_m * person_forward.xy
 
-                        # camera target pointing
-                        target = mathutils.Vector((target_x_mm / 1000,
-                                                   target_y_mm / 1000,
-                                                   target_z_mm / 1000))
+                        # We roughly point the camera at the focus bone, offset
+                        # a little by the trajectory
+                        target_offset_mm = trajectory['target_offset_mm'][traj_pos]
+                        target = mathutils.Vector((
+                            (focus.head.x * 1000 + float(target_offset_mm[0])) / 1000,
+                            (focus.head.y * 1000 + float(target_offset_mm[1])) / 1000,
+                            (focus.head.z * 1000 + float(target_offset_mm[2])) / 1000))
 
                         # reset camera pointing
                         is_camera_pointing = False
@@ -1249,26 +1391,26 @@ class GeneratorOperator(bpy.types.Operator):
                         camera.rotation_quaternion = rot
                         is_camera_pointing = True
 
-                    context.scene.update()  # update camera.matrix_world
+                    frame_timer.mark('camera')
 
-                    camera_world_inverse_mat4 = camera.matrix_world.inverted()
+                    if camera_needs_update:
+                        context.scene.update()  # update camera.matrix_world
+                        frame_timer.count('scene evaluations')
+                        frame_timer.mark('scene update')
+                        camera_world_mat4 = camera.matrix_world.copy()
+                    else:
+                        camera_world_mat4 = camera_world_matrix(camera)
+                    camera_world_inverse_mat4 = camera_world_mat4.inverted()
 
                     # Calculating the gravity vector
                     # We are flipping the z-axis to match the iOS gravity vector specs
-                    z_point = camera.matrix_world.translation - mathutils.Vector((0, 0, 1))
+                    z_point = camera_world_mat4.translation - mathutils.Vector((0, 0, 1))
                     cam_gravity_vec = (camera_world_inverse_mat4 * z_point).normalized()
                     meta['gravity'] = [cam_gravity_vec.x, cam_gravity_vec.y, -cam_gravity_vec.z]
 
-                    meta['bones'] = []
-                    for bone in body_pose.pose.bones:
-                        head_cam = camera_world_inverse_mat4 * bone.head.to_4d()
-                        tail_cam = camera_world_inverse_mat4 * bone.tail.to_4d()
-                        bone_meta = {
-                                'name': bone.name,
-                                'head': [head_cam.x, head_cam.y, head_cam.z],
-                                'tail': [tail_cam.x, tail_cam.y, tail_cam.z],
-                        }
-                        meta['bones'].append(bone_meta)
+                    bones_cam = camera_space_bones(body_pose,
+                                                   camera_world_inverse_mat4)
+                    frame_timer.mark('bones')
 
                     # pose_cam_vec = body_pose.pose.bones['pelvis'].head - camera.location
 
@@ -1288,27 +1430,71 @@ class GeneratorOperator(bpy.types.Operator):
                           " to " + bpy.context.scene.node_tree.nodes['LabelOutput'].base_path)
 
                     bpy.ops.render.render(write_still=True)
-
-                    meta_filename = os.path.join(abs_gen_dir, "labels", bvh_name, section_name, 'Image%04u.json' % frame)
-                    with open(meta_filename, 'w') as fp:
-                        json.dump(meta, fp, indent=2)
+                    frame_timer.mark('render')
+
+                    if meta_writer:
+                        meta_writer.append(bvh_name, body, section_name, frame,
+                                           meta['clothes'],
+                                           meta['camera']['distance'],
+                                           meta['camera']['viewing_angle'],
+                                           meta['gravity'],
+                                           bones_cam)
+                    else:
+                        meta['bones'] = [
+                            {'name': name, 'head': head, 'tail': tail}
+                            for (name, (head, tail)) in zip(bone_names,
+                                                            bones_cam.tolist())]
+                        meta_filename = os.path.join(abs_gen_dir, "labels", bvh_name, section_name, 'Image%04u.json' % frame)
+                        with open(meta_filename, 'w') as fp:
+                            json.dump(meta, fp, indent=2)
+
+                    journal_fp.write(json.dumps({'bvh': bvh_name,
+                                                 'body': body,
+                                                 'section': section_name,
+                                                 'frame': frame}) + "\n")
+                    journal_fp.flush()
+                    os.fsync(journal_fp.fileno())
+                    frame_timer.mark('meta')
+
+                    # A structured progress event that glimpse-generator.py
+                    # aggregates across all the instances of a render
+                    print("> PROGRESS " + json.dumps({
+                        'bvh': bvh_name,
+                        'body': body,
+                        'body_index': render_bodies.index(body),
+                        'n_bodies': len(render_bodies),
+                        'frame': frame,
+                        'start': int(bvh['start']),
+                        'end': int(bvh['end'])}), flush=True)
 
             # For now we render each mocap using all the body meshes we have,
             # just randomizing the clothing
-            body_whitelist = bpy.context.scene.GlimpseBodyWhitelist
-            if body_whitelist != 'all':
-                body_whitelist = body_whitelist.split(",")
-                for whitelist_body in body_whitelist:
-                    if whitelist_body in all_bodies:
-                        render_body(whitelist_body)
-            else:
-                for body in all_bodies:
-                    render_body(body)
+            for body in render_bodies:
+                render_body(body)
 
         print("Rendering %d filtered mocap sequences" % (len(filtered_index)))
         for (i, bvh) in filtered_index:
             render_bvh(bvh)
 
+        if journal_fp:
+            journal_fp.close()
+        if meta_writer:
+            meta_writer.close()
+
+        if frame_resume_count:
+            print("Skipped %d frames already rendered by a previous run" %
+                  frame_resume_count)
+
+        # The timings of every job run by an instance (and any previous runs
+        # being resumed) are accumulated in one report
+        if frame_timer.n_frames:
+            print("Frame timings (%d frames rendered):" % frame_timer.n_frames)
+            for line in frame_timer.summary_lines():
+                print("  " + line)
+            glimpse_render_timings.accumulate_report(
+                glimpse_render_timings.report_filename(abs_gen_dir, part_suffix),
+                frame_timer.report())
+
         if bpy.context.scene.GlimpseShowStats and frame_count:
 
             dash = '-' * 80
@@ -1939,83 +2125,83 @@ def register():
     bpy.types.Scene.GlimpseBvhTagsWhitelist = StringProperty(
             name="TagsWhitelist",
             description="A set of specified tags for index entries that will be rendered",
-            default='all')
+            default=default_render_settings['GlimpseBvhTagsWhitelist'])
 
     bpy.types.Scene.GlimpseBvhTagsBlacklist = StringProperty(
             name="TagsBlacklist",
             description="A set of specified tags for index entries that will not be rendered",
-            default='none')
+            default=default_render_settings['GlimpseBvhTagsBlacklist'])
 
     bpy.types.Scene.GlimpseBvhTagsSkip = StringProperty(
             name="TagsSkip",
             description="A set of specified tags for index entries that will not be rendered",
-            default='none')
+            default=default_render_settings['GlimpseBvhTagsSkip'])
 
     bpy.types.Scene.GlimpseFocusBone = StringProperty(
             name="FocusBone",
             description="Bone in the armature the camera will focus on during renders",
-            default='pelvis')
+            default=default_render_settings['GlimpseFocusBone'])
 
     bpy.types.Scene.GlimpseRenderWidth = IntProperty(
             name="RenderWidth",
             description="Width, in pixels, of rendered frames",
-            default=320,
+            default=default_render_settings['GlimpseRenderWidth'],
             min=10,
             max=4096)
 
     bpy.types.Scene.GlimpseRenderHeight = IntProperty(
             name="RenderHeight",
             description="Height, in pixels, of rendered frames",
-            default=240,
+            default=default_render_settings['GlimpseRenderHeight'],
             min=10,
             max=4096)
 
     bpy.types.Scene.GlimpseVerticalFOV = FloatProperty(
             name="VerticalFOV",
             description="Vertical field of view of camera",
-            default=43.940769,
+            default=default_render_settings['GlimpseVerticalFOV'],
             min=1,
             max=180)
 
     bpy.types.Scene.GlimpseMinCameraDistanceMM = IntProperty(
             name="MinCameraDistanceMM",
             description="Minimum distance of camera",
-            default=2000,
+            default=default_render_settings['GlimpseMinCameraDistanceMM'],
             min=1500,
             max=10000)
 
     bpy.types.Scene.GlimpseMaxCameraDistanceMM = IntProperty(
             name="MaxCameraDistanceMM",
             description="Maximum distance of camera",
-            default=2500,
+            default=default_render_settings['GlimpseMaxCameraDistanceMM'],
             min=1500,
             max=10000)
 
     bpy.types.Scene.GlimpseMinCameraHeightMM = IntProperty(
             name="MinCameraHeightMM",
             description="Minimum height of camera",
-            default=1100,
+            default=default_render_settings['GlimpseMinCameraHeightMM'],
             min=0,
             max=5000)
 
     bpy.types.Scene.GlimpseMaxCameraHeightMM = IntProperty(
             name="MaxCameraHeightMM",
             description="Maximum height of camera",
-            default=1400,
+            default=default_render_settings['GlimpseMaxCameraHeightMM'],
             min=0,
             max=5000)
 
     bpy.types.Scene.GlimpseMinViewingAngle = IntProperty(
             name="MinViewAngle",
             description="Maximum viewing angle, to left of center, for rendered training images",
-            default=30,
+            default=default_render_settings['GlimpseMinViewingAngle'],
             min=-180,
             max=180)
 
     bpy.types.Scene.GlimpseMaxViewingAngle = IntProperty(
             name="MaxViewAngle",
             description="Maximum viewing angle, to right of center, for rendered training images",
-            default=0,
+            default=default_render_settings['GlimpseMaxViewingAngle'],
             min=-180,
             max=180)
 
@@ -2027,34 +2213,34 @@ def register():
     bpy.types.Scene.GlimpseSkipPercentage = IntProperty(
             name="SkipPercent",
             description="Randomized percentage of frames to skip generating",
-            default=0,
+            default=default_render_settings['GlimpseSkipPercentage'],
             min=0,
             max=100)
 
     bpy.types.Scene.GlimpseClothingStep = IntProperty(
             name="ClothingStep",
             description="Randomize the clothing every N frames",
-            default=5,
+            default=default_render_settings['GlimpseClothingStep'],
             min=1,
             max=1000)
 
     bpy.types.Scene.GlimpseFixedCamera = BoolProperty(
             name="FixedCamera",
             description="Lock camera in a fixed position using the specified min parameters",
-            default=False)
+            default=default_render_settings['GlimpseFixedCamera'])
     bpy.types.Scene.GlimpseDebugCamera = BoolProperty(
             name="DebugCamera",
             description="Lock camera straight in front of a model in order to debug glimpse viewer",
-            default=False)
+            default=default_render_settings['GlimpseDebugCamera'])
 
     bpy.types.Scene.GlimpseSmoothCameraMovement = BoolProperty(
             name="SmoothCameraMovement",
             description="Smooth camera movement (disable randomization of the camera position and orientation)",
-            default=False)
+            default=default_render_settings['GlimpseSmoothCameraMovement'])
     bpy.types.Scene.GlimpseSmoothCameraFrequency = IntProperty(
             name="SmoothCameraFrequency",
             description="Period at which data is sampled when --smooth-camera-movement is enabled",
-            default=1,
+            default=default_render_settings['GlimpseSmoothCameraFrequency'],
             min=1,
             max=100)
 
@@ -2067,18 +2253,59 @@ def register():
     bpy.types.Scene.GlimpseClothesWhitelist = StringProperty(
             name="ClothesWhitelist",
             description="Limit rendering to only use these clothes",
-            default='all')
+            default=default_render_settings['GlimpseClothesWhitelist'])
 
     bpy.types.Scene.GlimpseBodyWhitelist = StringProperty(
             name="BodyWhitelist",
             description="Limit rendering to these body models",
-            default='all')
+            default=default_render_settings['GlimpseBodyWhitelist'])
 
     bpy.types.Scene.GlimpseAddBackground = BoolProperty(
             name="AddBackground",
             description="Add background in a form of a floor and walls",
+            default=default_render_settings['GlimpseAddBackground'])
+
+    bpy.types.Scene.GlimpseResumeJournals = StringProperty(
+            name="ResumeJournals",
+            description="Skip frames listed in these (os.pathsep separated) "
+                        "journals of previously completed frames",
+            default='')
+
+    bpy.types.Scene.GlimpseMetaFormat = StringProperty(
+            name="MetaFormat",
+            description="How to write the meta data for each frame: 'json' "
+                        "for a .json file per frame or 'store' to append to "
+                        "a consolidated store for the whole render",
+            default='json')
+
+    bpy.types.Scene.GlimpsePartSuffix = StringProperty(
+            name="PartSuffix",
+            description="Suffix for the names of the journal, timing report "
+                        "and frame meta data store written by this instance, "
+                        "for instances that share a render directory",
+            default='')
+
+    bpy.types.Scene.GlimpseLegacySceneUpdates = BoolProperty(
+            name="LegacySceneUpdates",
+            description="Update the scene after frame_set() and after "
+                        "moving the camera, as older versions did, to "
+                        "measure the cost of these updates",
             default=False)
 
+    bpy.types.Scene.GlimpseCameraTrajectories = BoolProperty(
+            name="CameraTrajectories",
+            description="Save the camera trajectory for each mocap and body "
+                        "under cameras/ and reuse them when re-rendering "
+                        "with the same settings",
+            default=False)
+
+    bpy.types.Scene.GlimpseManifest = StringProperty(
+            name="Manifest",
+            description="Only render the frames listed in this render "
+                        "manifest (as written by glimpse-generator.py "
+                        "render --dry-run --manifest)",
+            default='')
+
     bpy.types.Scene.GlimpseShowStats = BoolProperty(
             name="ShowStats",
             description="Output statistics after the rendering",
@@ -0,0 +1,297 @@
+# Copyright (c) 2018 Glimp IP Ltd
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# A consolidated store for the meta data of rendered frames, as an
+# alternative to writing a labels/<bvh>/<section>/ImageNNNN.json file per
+# frame (see glimpse-generator.py render --meta-format)
+#
+# A store is made up of three files within a render directory:
+#
+#   frames.meta.json - A header with the bone names and the camera meta data
+#                      that's the same for every frame
+#   frames.bin       - Fixed size records for each frame (see
+#                      frame_record_dtype()) which can be memory mapped as a
+#                      numpy structured array, so e.g. all the bone positions
+#                      can be accessed as one (n_frames, n_bones, 2, 3)
+#                      float32 array
+#   frames.index     - One JSON line per frame with the bvh, body, section,
+#                      frame number and clothes of the frame along with the
+#                      offset of its record within frames.bin
+#
+# When multiple instances of Blender render into the same directory each
+# instance writes its own store, named with the instance's suffix (e.g.
+# frames-part-0.meta.json, frames-part-0.bin and frames-part-0.index). See
+# store_names() for finding all the stores in a directory.
+#
+# Records are only ever appended. If a frame is rendered more than once (e.g.
+# when resuming an interrupted render) the last record for the frame is the
+# one that counts.
+#
+# Nothing in here depends on Blender so it can be used both by the
+# glimpse_data_generator addon and by standalone scripts like
+# glimpse-frame-meta-export.py
+#
+
+import os
+import glob
+import json
+
+import numpy
+
+
+store_version = 1
+
+default_store_name = 'frames'
+
+
+def store_filenames(directory, name=default_store_name):
+    """The (header, records, index) filenames of a store"""
+    return (os.path.join(directory, name + '.meta.json'),
+            os.path.join(directory, name + '.bin'),
+            os.path.join(directory, name + '.index'))
+
+
+def frame_record_dtype(n_bones):
+    """The numpy dtype of a single frame's record in frames.bin
+
+    'bones' holds the camera space (head, tail) position of each bone.
+    """
+    return numpy.dtype([
+        ('frame', '<i4'),
+        ('camera_distance', '<f4'),
+        ('camera_viewing_angle', '<f4'),
+        ('gravity', '<f4', (3,)),
+        ('bones', '<f4', (n_bones, 2, 3)),
+    ])
+
+
+def exists(directory, name=default_store_name):
+    return os.path.exists(store_filenames(directory, name)[0])
+
+
+def store_names(directory):
+    """The names of all the stores within a directory"""
+    names = []
+    for header_filename in glob.glob(os.path.join(glob.escape(directory),
+                                                  '*.meta.json')):
+        names.append(os.path.basename(header_filename)[:-len('.meta.json')])
+    return sorted(names)
+
+
+def last_index_entry(index_filename, block_size=65536):
+    """Returns (valid_length, entry) for the last complete line of an index
+
+    valid_length is the length of the index up to the end of that line and
+    entry is the line's parsed JSON, or None if there are no complete lines.
+    Only the end of the index is read so this stays cheap for large stores.
+    """
+    with open(index_filename, 'rb') as fp:
+        pos = fp.seek(0, os.SEEK_END)
+        tail = b''
+        while True:
+            # A line is only complete once its newline has been written
+            line_end = tail.rfind(b"\n")
+            if line_end >= 0:
+                line_start = tail.rfind(b"\n", 0, line_end) + 1
+                if line_start > 0 or pos == 0:
+                    try:
+                        entry = json.loads(
+                            tail[line_start:line_end].decode('utf-8'))
+                        return (pos + line_end + 1, entry)
+                    except ValueError:
+                        tail = tail[:line_start]
+                        continue
+            if pos == 0:
+                return (0, None)
+            step = min(pos, block_size)
+            pos -= step
+            fp.seek(pos)
+            tail = fp.read(step) + tail
+
+
+class FrameMetaWriter:
+    """Appends frame meta data records to a (new or existing) store
+
+    If a previous writer was interrupted, any partially written record is
+    discarded when the store is opened.
+    """
+
+    def __init__(self, directory, bone_names, attrs,
+                 name=default_store_name):
+        self.directory = directory
+        self.bone_names = list(bone_names)
+        self.dtype = frame_record_dtype(len(self.bone_names))
+
+        (header_filename,
+         records_filename,
+         index_filename) = store_filenames(directory, name)
+
+        if os.path.exists(header_filename):
+            with open(header_filename, 'r') as fp:
+                header = json.load(fp)
+            if header['bone_names'] != self.bone_names:
+                raise ValueError("Bones don't match existing frame meta "
+                                 "data store in %s" % directory)
+        else:
+            header = {
+                'version': store_version,
+                'bone_names': self.bone_names,
+                'attrs': attrs,
+            }
+            tmp_filename = header_filename + '.tmp'
+            with open(tmp_filename, 'w') as fp:
+                json.dump(header, fp, indent=2)
+            os.rename(tmp_filename, header_filename)
+
+        # Only the records listed in the index are considered complete, and
+        # since records are appended in order that's everything up to the
+        # record of the last complete index line
+        n_records = 0
+        if os.path.exists(index_filename):
+            (valid_length, entry) = last_index_entry(index_filename)
+            if entry is not None:
+                n_records = entry['offset'] // self.dtype.itemsize + 1
+            with open(index_filename, 'r+b') as fp:
+                fp.truncate(valid_length)
+
+        self.records_fp = open(records_filename, 'ab')
+        self.records_fp.truncate(n_records * self.dtype.itemsize)
+        self.records_fp.seek(0, os.SEEK_END)
+        self.index_fp = open(index_filename, 'a')
+
+    def append(self, bvh, body, section, frame, clothes,
+               camera_distance, camera_viewing_angle, gravity, bones):
+        """Append the meta data for a frame
+
+        bones should be an (n_bones, 2, 3) array of camera space (head,
+        tail) bone positions, ordered like the bone names given to the
+        writer.
+        """
+        record = numpy.zeros(1, dtype=self.dtype)
+        record['frame'] = frame
+        record['camera_distance'] = camera_distance
+        record['camera_viewing_angle'] = camera_viewing_angle
+        record['gravity'] = gravity
+        record['bones'] = bones
+
+        offset = self.records_fp.tell()
+        self.records_fp.write(record.tobytes())
+        self.records_fp.flush()
+
+        self.index_fp.write(json.dumps({'bvh': bvh,
+                                        'body': body,
+                                        'section': section,
+                                        'frame': frame,
+                                        'clothes': clothes,
+                                        'offset': offset}) + "\n")
+        self.index_fp.flush()
+
+    def close(self):
+        self.records_fp.close()
+        self.index_fp.close()
+
+
+class FrameMetaStore:
+    """Read access to a store of frame meta data
+
+    .records is a memory mapped structured array of all the records in
+    frames.bin and .index has the corresponding list of index entries.
+    """
+
+    def __init__(self, directory, name=default_store_name):
+        self.directory = directory
+
+        (header_filename,
+         records_filename,
+         index_filename) = store_filenames(directory, name)
+
+        with open(header_filename, 'r') as fp:
+            header = json.load(fp)
+        if header['version'] != store_version:
+            raise ValueError("Unsupported frame meta data store version %d" %
+                             header['version'])
+        self.bone_names = header['bone_names']
+        self.attrs = header['attrs']
+        self.dtype = frame_record_dtype(len(self.bone_names))
+
+        self.index = []
+        with open(index_filename, 'r') as fp:
+            for line in fp:
+                # The last line may be incomplete if a writer crashed
+                if not line.endswith("\n"):
+                    break
+                self.index.append(json.loads(line))
+
+        n_records = os.path.getsize(records_filename) // self.dtype.itemsize
+        if n_records:
+            self.records = numpy.memmap(records_filename, dtype=self.dtype,
+                                        mode='r', shape=(n_records,))
+        else:
+            self.records = numpy.zeros(0, dtype=self.dtype)
+
+        # In case the records file has a trailing, partially written record
+        # that was never indexed
+        self.index = [entry for entry in self.index
+                      if entry['offset'] // self.dtype.itemsize < n_records]
+
+    def __len__(self):
+        return len(self.index)
+
+    def latest(self):
+        """Returns the positions of the last record of each distinct frame"""
+        latest = {}
+        for i, entry in enumerate(self.index):
+            latest[(entry['bvh'], entry['section'], entry['frame'])] = i
+        return sorted(latest.values())
+
+    def record(self, i):
+        return self.records[self.index[i]['offset'] // self.dtype.itemsize]
+
+    def frame_path(self, i):
+        """The /<bvh>/<section>/ImageNNNN path of a frame, as used by indices"""
+        entry = self.index[i]
+        return "/%s/%s/Image%04u" % (entry['bvh'], entry['section'],
+                                     entry['frame'])
+
+    def frame_meta(self, i):
+        """Returns the meta data for a frame in the per-frame .json layout"""
+        entry = self.index[i]
+        record = self.record(i)
+
+        camera_meta = dict(self.attrs.get('camera', {}))
+        camera_meta['distance'] = float(record['camera_distance'])
+        camera_meta['viewing_angle'] = float(record['camera_viewing_angle'])
+
+        bones = []
+        for name, (head, tail) in zip(self.bone_names,
+                                      record['bones'].tolist()):
+            bones.append({'name': name, 'head': head, 'tail': tail})
+
+        meta = {}
+        if 'date' in self.attrs:
+            meta['date'] = self.attrs['date']
+        meta['camera'] = camera_meta
+        meta['bvh'] = entry['bvh']
+        meta['body'] = entry['body']
+        meta['frame'] = entry['frame']
+        meta['clothes'] = entry['clothes']
+        meta['gravity'] = record['gravity'].tolist()
+        meta['bones'] = bones
+        return meta
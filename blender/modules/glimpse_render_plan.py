@@ -0,0 +1,536 @@
+# Copyright (c) 2018 Glimp IP Ltd
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# The decisions about what to render, shared by the glimpse_data_generator
+# addon and glimpse-generator.py
+#
+# Nothing in here depends on Blender, so glimpse-generator.py can work out
+# exactly which frames a render will include (and the random clothing and
+# camera choices for each frame) without starting Blender. Since the random
+# choices are derived from per-frame seeds (see frame_seed()) the plan matches
+# what the addon renders as long as they both make their choices via this
+# module, in the same order.
+#
+
+import os
+import json
+import fnmatch
+import hashlib
+import ntpath
+import random
+
+import numpy
+
+
+# all_bodies = [ 'Man0', 'Woman0', 'Man1', 'Woman1', 'Man2', 'Woman2' ]
+
+# XXX: Woman1 black listed for now because the mocap doesn't make sense
+# with the large hips and the hands often intersect the hips which will
+# affect our labeling / training
+all_bodies = ['Man0', 'Woman0', 'Man1', 'Man2', 'Woman2']
+
+default_clothing_sets = {
+    "hat": [
+        {
+            "name": "none",
+            "probability": 0.4,
+        },
+        {
+            "name": "knitted_hat_01",
+            "probability": 0.2,
+        },
+        {
+            "name": "newsboy_cap",
+            "probability": 0.2,
+        },
+        {
+            "name": "patrol_cap",
+            "probability": 0.2,
+        },
+    ],
+    "glasses": [
+        {
+            "name": "none",
+            "probability": 0.7,
+        },
+        {
+            "name": "glasses",
+            "probability": 0.3,
+        },
+    ],
+    "top": [
+        {
+            "name": "none",
+            "probability": 0.8,
+        },
+        {
+            "name": "hooded_cardigan",
+            "probability": 0.2,
+        },
+
+        # XXX: start fleet uniform black listed for now because hands may
+        # intersect it too much resulting in labelling the hips as
+        # hands/wrists.
+        # {
+        #     "name": "star_fleet_uniform_female_gold_reference",
+        #     "probability": ,
+        # },
+    ],
+    "trousers": [
+        {
+            "name": "none",
+            "probability": 0.5,
+        },
+        {
+            "name": "m_trousers_01",
+            "probability": 0.5,
+        },
+    ],
+    # "shoes": [
+    # ],
+}
+
+# The render settings, named after the Blender scene properties they're
+# applied to (these are also the defaults registered for those properties)
+default_render_settings = {
+    'GlimpseBvhTagsWhitelist': 'all',
+    'GlimpseBvhTagsBlacklist': 'none',
+    'GlimpseBvhTagsSkip': 'none',
+    'GlimpseSkipPercentage': 0,
+    'GlimpseBodyWhitelist': 'all',
+    'GlimpseClothesWhitelist': 'all',
+    'GlimpseClothingStep': 5,
+    'GlimpseAddBackground': False,
+    'GlimpseRenderWidth': 320,
+    'GlimpseRenderHeight': 240,
+    'GlimpseVerticalFOV': 43.940769,
+    'GlimpseFocusBone': 'pelvis',
+    'GlimpseMinCameraDistanceMM': 2000,
+    'GlimpseMaxCameraDistanceMM': 2500,
+    'GlimpseMinCameraHeightMM': 1100,
+    'GlimpseMaxCameraHeightMM': 1400,
+    'GlimpseMinViewingAngle': 30,
+    'GlimpseMaxViewingAngle': 0,
+    'GlimpseFixedCamera': False,
+    'GlimpseDebugCamera': False,
+    'GlimpseSmoothCameraMovement': False,
+    'GlimpseSmoothCameraFrequency': 1,
+}
+
+# How far (in mm) a randomized camera may point away from the focus bone
+camera_target_fuzz_mm = 100
+
+
+# Random choices are made with generators seeded from the (bvh, body, frame)
+# being rendered, instead of one global sequence, so that any subset of frames
+# can be rendered on any instance, in any order, with identical results
+def frame_seed(bvh_name, body, frame, stream='frame'):
+    key = "%s/%s/%d/%s" % (bvh_name, body, frame, stream)
+    digest = hashlib.sha256(key.encode('utf-8')).digest()
+    return int.from_bytes(digest[:4], byteorder='little')
+
+
+def normalize_mocap_entry(bvh):
+    """Fill in the defaults for optional fields of a mocap index entry
+
+    The 'end' frame is left for the caller to handle since within Blender
+    it can be determined from a preloaded action.
+    """
+
+    # normalize so we don't have to consider that it's left unspecified
+    if 'blacklist' not in bvh:
+        bvh['blacklist'] = False
+
+    if 'tags' not in bvh:
+        bvh['tags'] = {'unknown'}
+
+    # So we can start to just use tag-based blacklisting...
+    if bvh['blacklist'] and 'blacklist' not in bvh['tags']:
+        bvh['tags']['blacklist'] = True
+
+    if 'start' not in bvh:
+        bvh['start'] = 1
+
+    if 'name' not in bvh:
+        bvh['name'] = ntpath.basename(bvh['file'])[:-4]
+
+    if 'fps' not in bvh:
+        bvh['fps'] = 120
+
+
+def mocap_filter_reason(bvh, name_patterns=None,
+                        tags_whitelist=None, tags_blacklist=None):
+    """Returns why a mocap index entry is filtered out, or None"""
+
+    if tags_whitelist:
+        matched_whitelist = False
+        for tag in tags_whitelist:
+            if tag in bvh['tags']:
+                matched_whitelist = True
+                break
+        if not matched_whitelist:
+            return "tags didn't match whitelist"
+
+    if tags_blacklist:
+        for tag in tags_blacklist:
+            if tag in bvh['tags']:
+                return "tags matched blacklist"
+
+    if name_patterns is not None:
+        matched_name = False
+        for match in name_patterns:
+            if fnmatch.fnmatch(bvh['name'], match):
+                matched_name = True
+                break
+        if not matched_name:
+            return "didn't match name patterns"
+
+    return None
+
+
+def parse_tags_skip(tags_skip):
+    """Parses a GlimpseBvhTagsSkip string like 'tag0=20,tag1=50'"""
+    tags_skipped = {}
+    if tags_skip and tags_skip != 'none':
+        for skip_tag in tags_skip.split(","):
+            tag_data = skip_tag.split("=")
+            tags_skipped[tag_data[0]] = int(tag_data[1])
+    return tags_skipped
+
+
+def skip_frame_randomly(frame_random, skip_percentage):
+    return frame_random.randrange(0, 100) < skip_percentage
+
+
+def skip_frame_by_tag(frame_random, bvh, tags_skipped):
+    """Returns the tag that a frame is (randomly) skipped for, or None"""
+
+    # NB: the tags are visited in a fixed order so that the same random
+    # numbers get compared with the same tags in every process
+    for tag in sorted(tags_skipped):
+        if tag in bvh['tags'] and frame_random.randrange(0, 100) < tags_skipped[tag]:
+            return tag
+    return None
+
+
+def whitelist_bodies(body_whitelist):
+    if body_whitelist == 'all':
+        return list(all_bodies)
+    return [body for body in body_whitelist.split(',') if body in all_bodies]
+
+
+def whitelist_clothing_sets(clothes_whitelist):
+    if clothes_whitelist == 'all':
+        return default_clothing_sets
+
+    whitelist_as_set = set(clothes_whitelist.split(','))
+    clothing_sets = {}
+    for key in default_clothing_sets:
+        clothing_sets[key] = [dict(entry)
+                              for entry in default_clothing_sets[key]
+                              if entry['name'] in whitelist_as_set]
+        # probabilities may no longer add up to 1.0 so
+        # re-normalize...
+        total = 0
+        for entry in clothing_sets[key]:
+            total += entry['probability']
+        for entry in clothing_sets[key]:
+            entry['probability'] = entry['probability'] / total
+    return clothing_sets
+
+
+def clothing_epoch(bvh, frame, clothing_step):
+    """Returns the first frame of the run of frames sharing clothing
+
+    The clothing is randomized every clothing_step frames (or once per
+    sequence if clothing_step is zero)
+    """
+    if clothing_step > 0:
+        return frame - (frame % clothing_step)
+    else:
+        return int(bvh['start'])
+
+
+def clothing_table(clothing_sets):
+    """Precomputes what choose_clothes() needs to pick from clothing sets
+
+    Returns a list of (set name, item names, cumulative probabilities)
+    tuples, in a fixed order, leaving out empty sets.
+    """
+    table = []
+
+    # NB: the sets are visited in a fixed order so that each set gets the
+    # same random number in every process
+    for key in sorted(clothing_sets):
+        clothing_set = clothing_sets[key]
+        if not len(clothing_set):
+            continue
+
+        names = [entry['name'] for entry in clothing_set]
+        cdf = numpy.cumsum([entry['probability'] for entry in clothing_set])
+        cdf /= cdf[-1]
+        table.append((key, names, cdf))
+
+    return table
+
+
+def choose_clothes(bvh_name, body, epoch, table):
+    """Randomly picks an item from each clothing set
+
+    table is the clothing_table() for the clothing sets to pick from.
+
+    Returns a dictionary mapping clothing set names to the chosen item,
+    leaving out sets where 'none' was chosen. The caller still needs to
+    check that the chosen items are available for the given body.
+    """
+    clothes_random = numpy.random.RandomState(
+        frame_seed(bvh_name, body, epoch, 'clothes'))
+    clothes = {}
+
+    for (key, names, cdf) in table:
+        # Equivalent to clothes_random.choice(names, p=probabilities)
+        set_choice = names[int(cdf.searchsorted(clothes_random.random_sample(),
+                                                side='right'))]
+        if set_choice != 'none':
+            clothes[key] = set_choice
+
+    return clothes
+
+
+def random_in_range(frame_random, minimum, maximum):
+    """frame_random.randrange(minimum, maximum), or minimum if it's empty
+
+    No random number is consumed for an empty range.
+    """
+    if maximum <= minimum:
+        return minimum
+    return frame_random.randrange(minimum, maximum)
+
+
+def randomize_camera(frame_random,
+                     min_distance_mm, max_distance_mm,
+                     min_viewing_angle, max_viewing_angle,
+                     min_height_mm, max_height_mm):
+    """Randomly picks the camera placement for a 'randomized' camera
+
+    Returns (distance_mm, viewing_angle, height_mm, target_offset_mm) where
+    target_offset_mm is an (x, y, z) offset from the focus bone for the
+    camera to point at.
+
+    An empty range (such as the default viewing angles of 30 to 0 degrees)
+    isn't randomized and the minimum is used instead.
+    """
+    dist_mm = random_in_range(frame_random, min_distance_mm, max_distance_mm)
+    view_angle = random_in_range(frame_random,
+                                 min_viewing_angle, max_viewing_angle)
+    height_mm = random_in_range(frame_random, min_height_mm, max_height_mm)
+
+    # We roughly point the camera at the focus bone but randomize
+    # this a little...
+    target_offset_mm = tuple(
+        frame_random.randrange(-camera_target_fuzz_mm, camera_target_fuzz_mm)
+        for axis in range(3))
+
+    return (dist_mm, view_angle, height_mm, target_offset_mm)
+
+
+def camera_mode(settings):
+    """One of 'debug', 'fixed', 'smooth' or 'randomized'"""
+    if settings['GlimpseDebugCamera']:
+        return 'debug'
+    elif settings['GlimpseFixedCamera']:
+        return 'fixed'
+    elif settings['GlimpseSmoothCameraMovement']:
+        return 'smooth'
+    else:
+        return 'randomized'
+
+
+# The settings that affect a camera trajectory (see camera_trajectory_key())
+camera_trajectory_settings = [
+    'GlimpseSkipPercentage',
+    'GlimpseBvhTagsSkip',
+    'GlimpseMinCameraDistanceMM',
+    'GlimpseMaxCameraDistanceMM',
+    'GlimpseMinCameraHeightMM',
+    'GlimpseMaxCameraHeightMM',
+    'GlimpseMinViewingAngle',
+    'GlimpseMaxViewingAngle',
+    'GlimpseFixedCamera',
+    'GlimpseDebugCamera',
+    'GlimpseSmoothCameraMovement',
+    'GlimpseSmoothCameraFrequency',
+]
+
+
+def camera_trajectory(bvh, body, settings):
+    """Computes the camera placement for every frame of a (bvh, body) pass
+
+    Returns a dictionary of arrays with an entry for each frame from
+    bvh['start'] up to bvh['end']:
+
+      'frame'            - The frame number
+      'skipped'          - Whether the frame is skipped due to
+                           GlimpseSkipPercentage or GlimpseBvhTagsSkip
+      'distance_mm'      - The camera's horizontal distance from the focus
+                           bone
+      'viewing_angle'    - The camera's angle (in degrees) around the focus
+                           bone, relative to the direction the body faces
+      'height_mm'        - The camera's height
+      'target_offset_mm' - An (x, y, z) offset from the focus bone for the
+                           camera to point at
+
+    The placement is relative to the focus bone because that depends on the
+    pose for each frame, which is only known within Blender. The smooth
+    camera movement is also left for Blender to fill in (since it's based on
+    Blender's noise functions) so the placement of 'smooth' and 'debug'
+    cameras is all zero here.
+    """
+    bvh_name = bvh['name']
+    skip_percentage = settings['GlimpseSkipPercentage']
+    tags_skipped = parse_tags_skip(settings['GlimpseBvhTagsSkip'])
+    mode = camera_mode(settings)
+
+    frames = numpy.arange(int(bvh['start']), int(bvh['end']), dtype='int32')
+    n_frames = len(frames)
+    trajectory = {
+        'frame': frames,
+        'skipped': numpy.zeros(n_frames, dtype='bool'),
+        'distance_mm': numpy.zeros(n_frames, dtype='float64'),
+        'viewing_angle': numpy.zeros(n_frames, dtype='float64'),
+        'height_mm': numpy.zeros(n_frames, dtype='float64'),
+        'target_offset_mm': numpy.zeros((n_frames, 3), dtype='float64'),
+    }
+
+    if mode == 'fixed':
+        trajectory['distance_mm'][:] = settings['GlimpseMinCameraDistanceMM']
+        trajectory['viewing_angle'][:] = settings['GlimpseMinViewingAngle']
+        trajectory['height_mm'][:] = settings['GlimpseMinCameraHeightMM']
+
+    for i, frame in enumerate(frames.tolist()):
+        # The random choices have to be made in the same order as when
+        # rendering, so the skip decisions come before the camera placement
+        frame_random = random.Random(frame_seed(bvh_name, body, frame))
+
+        if (skip_frame_randomly(frame_random, skip_percentage) or
+                skip_frame_by_tag(frame_random, bvh, tags_skipped) is not None):
+            trajectory['skipped'][i] = True
+            continue
+
+        if mode == 'randomized':
+            (dist_mm, view_angle, height_mm, target_offset_mm) = \
+                randomize_camera(frame_random,
+                                 settings['GlimpseMinCameraDistanceMM'],
+                                 settings['GlimpseMaxCameraDistanceMM'],
+                                 settings['GlimpseMinViewingAngle'],
+                                 settings['GlimpseMaxViewingAngle'],
+                                 settings['GlimpseMinCameraHeightMM'],
+                                 settings['GlimpseMaxCameraHeightMM'])
+            trajectory['distance_mm'][i] = dist_mm
+            trajectory['viewing_angle'][i] = view_angle
+            trajectory['height_mm'][i] = height_mm
+            trajectory['target_offset_mm'][i] = target_offset_mm
+
+    return trajectory
+
+
+def camera_trajectory_key(bvh, body, settings):
+    """A digest of everything a camera trajectory depends on
+
+    Used to check that a previously saved trajectory can be reused.
+    """
+    key = {
+        'bvh': [bvh['name'], int(bvh['start']), int(bvh['end']),
+                bvh.get('fps'), sorted(bvh.get('tags', []))],
+        'body': body,
+        'settings': [settings[name] for name in camera_trajectory_settings],
+    }
+    key_str = json.dumps(key, sort_keys=True)
+    return hashlib.sha256(key_str.encode('utf-8')).hexdigest()
+
+
+def save_camera_trajectory(filename, trajectory, key):
+    """Saves a camera trajectory as a .npz file, along with its key"""
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'wb') as fp:
+        numpy.savez(fp, key=numpy.array(key), **trajectory)
+    os.rename(tmp_filename, filename)
+
+
+def load_camera_trajectory(filename, key):
+    """Loads a camera trajectory saved by save_camera_trajectory()
+
+    Returns None if there's no saved trajectory or it was saved with a
+    different key.
+    """
+    if not os.path.exists(filename):
+        return None
+    with numpy.load(filename) as data:
+        if str(data['key']) != key:
+            return None
+        return {name: data[name] for name in data.files if name != 'key'}
+
+
+def plan_mocap_frames(bvh, settings):
+    """Yields a description of each frame that would be rendered for a mocap
+
+    Each frame is described by a dictionary with the bvh name, body, frame
+    number, clothing and camera placement. The clothing may still be
+    reduced within Blender if an item hasn't been fitted to a body and the
+    smooth camera movement is only determined within Blender.
+    """
+    bvh_name = bvh['name']
+    clothes_table = clothing_table(
+        whitelist_clothing_sets(settings['GlimpseClothesWhitelist']))
+    clothing_step = settings['GlimpseClothingStep']
+    mode = camera_mode(settings)
+
+    for body in whitelist_bodies(settings['GlimpseBodyWhitelist']):
+        clothes_epoch = None
+        clothes = {}
+
+        trajectory = camera_trajectory(bvh, body, settings)
+
+        for i, frame in enumerate(trajectory['frame'].tolist()):
+            if trajectory['skipped'][i]:
+                continue
+
+            frame_clothes_epoch = clothing_epoch(bvh, frame, clothing_step)
+            if frame_clothes_epoch != clothes_epoch:
+                clothes_epoch = frame_clothes_epoch
+                clothes = choose_clothes(bvh_name, body, clothes_epoch,
+                                         clothes_table)
+
+            camera = {'mode': mode}
+            if mode in ('randomized', 'fixed'):
+                camera['distance_mm'] = int(trajectory['distance_mm'][i])
+                camera['viewing_angle'] = int(trajectory['viewing_angle'][i])
+                camera['height_mm'] = int(trajectory['height_mm'][i])
+            if mode == 'randomized':
+                camera['target_offset_mm'] = tuple(
+                    int(v) for v in trajectory['target_offset_mm'][i])
+
+            yield {
+                'bvh': bvh_name,
+                'body': body,
+                'frame': frame,
+                'clothes': clothes,
+                'camera': camera,
+            }
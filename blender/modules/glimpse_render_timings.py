@@ -0,0 +1,224 @@
+# Copyright (c) 2018 Glimp IP Ltd
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# Timing breakdowns for the stages of rendering each frame, used by the
+# glimpse_data_generator addon to report where the time goes (e.g. how much
+# is spent evaluating the scene vs. actually rendering)
+#
+# Each Blender instance accumulates the timings for all the frames it renders
+# in a JSON report (render.timings.json, or e.g. render-part-0.timings.json if
+# instances share a render directory) within its render directory:
+#
+#   {
+#       "version": 1,
+#       "n_frames": <number of frames timed>,
+#       "counters": { "<counter>": <total count>, ... },
+#       "stages": {
+#           "<stage>": {
+#               "n": <number of times the stage was timed>,
+#               "total": <seconds>,
+#               "min": <seconds>,
+#               "max": <seconds>,
+#               "histogram": [<counts>, ...]
+#           },
+#           ...
+#       }
+#   }
+#
+# The histogram counts are for the ranges between histogram_edges (in
+# seconds), with the first and last counts covering anything below or above
+# the first or last edge. Reports can be combined with merge_reports(), e.g.
+# to roll up the reports of all the instances of a render.
+#
+# Nothing in here depends on Blender
+#
+
+import os
+import bisect
+import collections
+import json
+import time
+
+
+report_version = 1
+
+
+def report_filename(directory, suffix=''):
+    """The filename of an instance's report within its render directory
+
+    suffix distinguishes the reports of instances sharing a directory.
+    """
+    return os.path.join(directory, 'render%s.timings.json' % suffix)
+
+# Powers of two from ~15us to ~131s
+histogram_edges = [2.0 ** e for e in range(-16, 8)]
+
+
+def new_stage_stats():
+    return {
+        'n': 0,
+        'total': 0.0,
+        'min': None,
+        'max': None,
+        'histogram': [0] * (len(histogram_edges) + 1),
+    }
+
+
+def merge_stage_stats(stats, other):
+    stats['n'] += other['n']
+    stats['total'] += other['total']
+    for (key, pick) in (('min', min), ('max', max)):
+        if other[key] is not None:
+            if stats[key] is None:
+                stats[key] = other[key]
+            else:
+                stats[key] = pick(stats[key], other[key])
+    stats['histogram'] = [a + b for (a, b) in zip(stats['histogram'],
+                                                  other['histogram'])]
+
+
+def histogram_percentile(stats, percentile):
+    """Estimates a percentile (in seconds) of a stage's timings
+
+    This is the upper edge of the histogram bucket holding the percentile,
+    limited by the maximum timing.
+    """
+    if not stats['n']:
+        return 0.0
+    threshold = stats['n'] * percentile / 100
+    count = 0
+    for (i, bucket_count) in enumerate(stats['histogram']):
+        count += bucket_count
+        if count >= threshold:
+            if i < len(histogram_edges):
+                return min(histogram_edges[i], stats['max'])
+            break
+    return stats['max']
+
+
+class StageTimer:
+    """Accumulates the time spent in each stage of rendering frames
+
+    Call start_frame() before the first stage of each frame and then
+    mark(stage) at the end of each stage, which attributes the time since
+    the previous mark (or the start of the frame) to that stage. count()
+    can be used to keep track of other per-frame costs, like the number of
+    times the scene is evaluated.
+    """
+
+    def __init__(self):
+        self.n_frames = 0
+        self.stages = collections.OrderedDict()
+        self.counters = collections.OrderedDict()
+        self._last = None
+
+    def start_frame(self):
+        self.n_frames += 1
+        self._last = time.perf_counter()
+
+    def mark(self, stage):
+        now = time.perf_counter()
+        seconds = now - self._last
+        self._last = now
+
+        if stage not in self.stages:
+            self.stages[stage] = new_stage_stats()
+        stats = self.stages[stage]
+        stats['n'] += 1
+        stats['total'] += seconds
+        if stats['min'] is None or seconds < stats['min']:
+            stats['min'] = seconds
+        if stats['max'] is None or seconds > stats['max']:
+            stats['max'] = seconds
+        stats['histogram'][bisect.bisect(histogram_edges, seconds)] += 1
+
+    def count(self, counter, n=1):
+        self.counters[counter] = self.counters.get(counter, 0) + n
+
+    def report(self):
+        return {
+            'version': report_version,
+            'n_frames': self.n_frames,
+            'counters': self.counters,
+            'stages': self.stages,
+        }
+
+    def summary_lines(self):
+        return report_summary_lines(self.report())
+
+
+def merge_reports(reports):
+    """Combines timing reports into one"""
+    merged = StageTimer().report()
+    for report in reports:
+        if report['version'] != report_version:
+            raise ValueError("Unsupported timing report version %d" %
+                             report['version'])
+        merged['n_frames'] += report['n_frames']
+        for (counter, n) in report['counters'].items():
+            merged['counters'][counter] = merged['counters'].get(counter, 0) + n
+        for (stage, stats) in report['stages'].items():
+            if stage not in merged['stages']:
+                merged['stages'][stage] = new_stage_stats()
+            merge_stage_stats(merged['stages'][stage], stats)
+    return merged
+
+
+def load_report(filename):
+    with open(filename, 'r') as fp:
+        return json.load(fp, object_pairs_hook=collections.OrderedDict)
+
+
+def save_report(filename, report):
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'w') as fp:
+        json.dump(report, fp, indent=2)
+    os.rename(tmp_filename, filename)
+
+
+def accumulate_report(filename, report):
+    """Adds the timings of a report to those already saved in filename"""
+    if os.path.exists(filename):
+        report = merge_reports([load_report(filename), report])
+    save_report(filename, report)
+
+
+def report_summary_lines(report):
+    """A human readable breakdown of the time spent per stage"""
+    n_frames = report['n_frames']
+    if not n_frames:
+        return []
+
+    total = sum(stats['total'] for stats in report['stages'].values())
+    lines = ['{:<20s}{:>12s}{:>16s}{:>8s}{:>12s}{:>12s}'.format(
+        "STAGE", "TOTAL (s)", "PER FRAME (ms)", "(%)", "P50 (ms)", "P99 (ms)")]
+    for (stage, stats) in report['stages'].items():
+        percentage = stats['total'] / total * 100 if total else 0
+        lines.append('{:<20s}{:>12.2f}{:>16.2f}{:>8.1f}{:>12.2f}{:>12.2f}'.format(
+            stage, stats['total'], stats['total'] / n_frames * 1000,
+            percentage,
+            histogram_percentile(stats, 50) * 1000,
+            histogram_percentile(stats, 99) * 1000))
+    lines.append('{:<20s}{:>12.2f}{:>16.2f}'.format(
+        "total", total, total / n_frames * 1000))
+    for (counter, n) in report['counters'].items():
+        lines.append('{:<20s}{:>12d}{:>16.2f}'.format(
+            counter, n, n / n_frames))
+    return lines
@@ -1,10 +1,30 @@
 #!/bin/bash
 
-# glimpse-render.py creates multiple directories like renders/$NAME-part-$i
+# glimpse-generator.py render --separate-parts (and older versions of
+# glimpse-generator.py) create multiple directories like renders/$NAME-part-$i
 # but for pre-processing we want a single combined directory...
+#
+# By default the rendered files are hard linked into the combined directory
+# (so nothing is copied and the part directories are left intact) or with
+# --move they are moved (renamed) instead, leaving the part directories empty.
+# Either way the part directories need to be on the same filesystem as the
+# combined directory, and files already in the combined directory (e.g. when
+# re-running after an interruption) are replaced.
+#
+# The files written per-instance (journals, timing reports and frame meta data
+# stores) are given a -part-$i suffix in the combined directory, the same as
+# for instances that render into a shared directory.
+
+set -e
+
+MOVE=0
+if test "$1" = "--move"; then
+	MOVE=1
+	shift
+fi
 
 if test $# != 3; then
-	echo "Usage: $0 RENDERS_TOP_DIR NAME N"
+	echo "Usage: $0 [--move] RENDERS_TOP_DIR NAME N"
 	exit 1
 fi
 
@@ -12,6 +32,49 @@ RENDERS_TOP_DIR=$1
 NAME=$2
 N=$3
 
+# merge SRC_DIR DEST_DIR
+#
+# Moves the contents of SRC_DIR into DEST_DIR, only descending into
+# subdirectories that exist in both
+function merge()
+{
+	local entry
+	mkdir -p "$2"
+	for entry in "$1"/*
+	do
+		test -e "$entry" || continue
+		local dest="$2/$(basename "$entry")"
+		if test -d "$entry" -a -d "$dest"; then
+			merge "$entry" "$dest"
+		else
+			mv "$entry" "$dest"
+		fi
+	done
+}
+
+# combine SRC_DIR DEST_DIR
+function combine()
+{
+	if test $MOVE = 1; then
+		echo "Moving $1 into $2 ..."
+		merge "$1" "$2"
+	else
+		echo "Linking $1 into $2 ..."
+		mkdir -p "$2"
+		cp -alf "$1"/. "$2"
+	fi
+}
+
+# combine_file SRC_FILE DEST_FILE
+function combine_file()
+{
+	if test $MOVE = 1; then
+		mv "$1" "$2"
+	else
+		ln -f "$1" "$2"
+	fi
+}
+
 cd $RENDERS_TOP_DIR
 
 mkdir -p $NAME/labels
@@ -20,9 +83,20 @@ cp $NAME-part-0/meta.json $NAME
 
 for i in `seq 0 $(($N - 1))`
 do
-	echo "cp -a $NAME-part-$i/labels/* $NAME/labels ..."
-	cp -a $NAME-part-$i/labels/* $NAME/labels
-	echo "cp -a $NAME-part-$i/depth/* $NAME/depth ..."
-	cp -a $NAME-part-$i/depth/* $NAME/depth
-done
+	PART=$NAME-part-$i
 
+	for dir in labels depth cameras
+	do
+		if test -d $PART/$dir; then
+			combine $PART/$dir $NAME/$dir
+		fi
+	done
+
+	for file in render.journal render.timings.json \
+		frames.meta.json frames.bin frames.index
+	do
+		if test -e $PART/$file; then
+			combine_file $PART/$file $NAME/${file/./-part-$i.}
+		fi
+	done
+done
@@ -25,10 +25,18 @@ import os
 import sys
 import argparse
 import textwrap
-import random
 import json
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 
-full_index = []
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                'blender', 'modules'))
+import glimpse_frame_store
+
+from glimpse_catalog import (FrameCatalog, FrameMetadata, FrameQuery,
+                             load_frame_stores)
 
 parser = argparse.ArgumentParser(
     formatter_class=argparse.RawDescriptionHelpFormatter,
@@ -42,13 +50,38 @@ parser = argparse.ArgumentParser(
     epilog=textwrap.dedent("""\
         Firstly if no index.full file can be loaded listing all available
         frames then one will be created by traversing all the files under the
-        <data> directory looking for frames. --full can be used to override
-        which index is loaded here.
+        <data>/labels directory looking for frames. --full can be used to
+        override which index is loaded here. A compact binary
+        index.full.catalog file is maintained alongside index.full for faster
+        loading and filtering and is automatically re-created if index.full is
+        newer.
+
+        The modification times of all the directories traversed are saved in
+        index.full.dirs so that -u,--update can later add newly rendered
+        frames to the full index by only re-scanning modified directories.
 
         Secondly the full index is filtered according to any white/blacklists
         for tags (via --tags-blacklist and --tags-whitelist); to optionally
         remove flipped frames (via --no-flipped) or exclude files listed in
-        another index (via --exclude).
+        another index (via --exclude). Filtering by body or tags depends on
+        the per-frame .json meta data which is consolidated into an
+        index.full.meta table the first time it's needed (and updated as new
+        frames are indexed).
+
+        More general filters can be given via -q,--query expressions, made of
+        terms combined with & (and), | (or), ! (not) and parentheses. Terms
+        can match names with glob patterns like bvh:PATTERN, section:PATTERN,
+        body:PATTERN, tag:PATTERN or clothes:PATTERN (or exact names with
+        = and !=), check flipped=true/false or compare frame, distance (camera
+        distance) or angle (camera viewing angle) with = != < <= > >= and a
+        number. For example:
+
+          -q 'tag:walk & !body:Man2 & flipped=false'
+          -q '(bvh:"02_*" | bvh:05_*) & distance<3.5'
+
+        All filters (including the options above) are combined into a single
+        query whose result is cached under index.full.cache, and is
+        automatically invalidated if the full index or meta data change.
 
         Finally for each -i <name> <N> argument sequence given it will create a
         data/index.<name> file with <N> randomly sampled frames taken from the
@@ -57,20 +90,36 @@ parser = argparse.ArgumentParser(
         Sampling for each index is done with replacment by default, such that
         you may get duplicates within an index. Use the -w,--without-replacment
         options to sample without replacment.  Replacement always happens after
-        creating each index, so you should run the tool multiple times and use
-        -e,--exclude to avoid any overlapping samples between separate index
-        files if required.
+        creating each index, so separate index files may overlap.
+
+        To create index files that are guaranteed not to overlap use
+        -p,--partition <name> <N> instead of -i. All partitions are taken
+        from a single shuffle of the filtered frames (seeded with the
+        comma separated partition names by default) and any -i indices are
+        then sampled from the frames that weren't assigned to a partition.
+        With --split-by=bvh whole mocap sequences are assigned to each
+        partition, so e.g. a test set never shares a sequence with training
+        data (--split-by=body similarly keeps body models separate).
+
+        By default frames are sampled uniformly, so a mocap sequence or tag
+        that's over-represented in the full index will also be
+        over-represented in each sampled index. With --balance-by=bvh, body
+        or tags the frames are grouped by mocap sequence, body model or
+        combination of tags and the same number of frames are sampled from
+        each group. --balance-weights=walk=0.5,run=2 can change the relative
+        share of the index given to each group (a tag combination has the
+        mean weight of its tags) and --balance-cap limits the number of frames
+        taken from any one group, with any remainder being shared between
+        the other groups.
 
         The sampling is pseudo random and reproducible for a given directory of
         data. The seed can be explicitly given via --seed= and the value is
-        passed as a string to random.seed() which will calculate a hash of the
-        string to use as an RNG seed. The default seed is the name of the current
-        index being created.
-
-        Note: Even if the exclusions from passing -e have no effect the act of
-        passing -e options can change the random sampling compared to running
-        with no exclusion due to how the set difference calculations may affect
-        the sorting of the index internally.
+        hashed (SHA-512) to seed numpy's RandomState random number generator.
+        The default seed is the name of the current index being created.
+
+        Note: Filtering and exclusions preserve the order of the remaining
+        frames, so passing -e options that don't actually exclude any frames
+        won't change the random sampling.
         """))
 parser.add_argument("data", nargs=1, help="Data Directory")
 parser.add_argument("-v", "--verbose", action="store_true",
@@ -79,6 +128,12 @@ parser.add_argument("-s", "--seed", help="Seed for random sampling")
 parser.add_argument("-f", "--full", nargs=1, default=['full'],
                     help="An alternative index.<FULL> extension for the full "
                          "index (default 'full')")
+parser.add_argument("-u", "--update", action="store_true",
+                    help="Update the full index by re-scanning any new or "
+                         "modified directories under <data>/labels")
+parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(),
+                    help="Number of threads to use while scanning for frames "
+                         "(default = number of CPUs)")
 
 # Filters...
 parser.add_argument('--no-flipped', action="store_true",
@@ -96,6 +151,13 @@ parser.add_argument("--body", action="append", nargs=1, metavar=('BODY_NAME'),
                     help="Only consider frames including specific body models")
 parser.add_argument("--bvh", action="append", nargs=1, metavar=('BVH_NAME'),
                     help="Only consider frames part of specific mocap sequences")
+parser.add_argument("-q", "--query", action="append",
+                    help="Only consider frames matching a query expression "
+                         "like 'tag:walk & !body:Man2 & flipped=false' "
+                         "(see below)")
+parser.add_argument("--build-metadata", action="store_true",
+                    help="Create or update the index.<FULL>.meta table of "
+                         "frame meta data even if no filters need it")
 parser.add_argument("-e", "--exclude", action="append", nargs=1, metavar=('NAME'),
                     help="Load index.<NAME> frames to be excluded from sampling")
 
@@ -107,6 +169,24 @@ parser.add_argument("-a", "--all", action="store_true",
                     help="Simply keep everything (in-order) after applying "
                          "filters and exclusions")
 
+parser.add_argument("--balance-by", choices=['bvh', 'body', 'tags'],
+                    help="Sample frames evenly across each mocap sequence, "
+                         "body model or combination of tags (see below)")
+parser.add_argument("--balance-weights", metavar='NAME=WEIGHT,...',
+                    help="Relative weights for balancing (default 1 for "
+                         "unlisted groups, or give a '*=WEIGHT' default)")
+parser.add_argument("--balance-cap", type=int, metavar='N',
+                    help="Maximum number of frames to sample from any one "
+                         "group when balancing")
+
+parser.add_argument("-p", "--partition", action="append", nargs=2,
+                    metavar=('NAME', 'N'),
+                    help="Create an index.<NAME> file with N frames that's "
+                         "disjoint from all other partitions")
+parser.add_argument("--split-by", choices=['bvh', 'body'],
+                    help="Don't share any mocap sequence (or body model) "
+                         "between partitions")
+
 parser.add_argument("-i", "--index", action="append", nargs=2, metavar=('NAME','N'),
                     help="Create an index.<NAME> file with N frames")
 
@@ -114,121 +194,472 @@ parser.add_argument("-i", "--index", action="append", nargs=2, metavar=('NAME','
 
 args = parser.parse_args()
 
+if args.balance_by and args.all:
+    parser.error("--balance-by can't be combined with -a,--all")
+if args.split_by and not args.partition:
+    parser.error("--split-by requires -p,--partition")
+if (args.balance_weights or args.balance_cap is not None) and not args.balance_by:
+    parser.error("--balance-weights and --balance-cap require --balance-by")
+
 data_dir = args.data[0]
 full_filename = os.path.join(data_dir, "index.%s" % args.full[0])
+catalog_filename = full_filename + ".catalog"
+metadata_filename = full_filename + ".meta"
+dirs_filename = full_filename + ".dirs"
+labels_dir = os.path.join(data_dir, 'labels')
+
+
+def crawl_bvh(labels_dir, bvh, old_record, store_sections):
+    """Find the frames under labels/<bvh>/ that need (re-)indexing
+
+    Returns a (record, frames) tuple where record tracks the modification
+    times of the bvh directory and its section directories and frames maps
+    the name of each section that was (re)scanned to a list of frame names.
+    Sections whose modification time matches the old_record aren't rescanned
+    (adding or removing files will update a directory's modification time).
+
+    A frame is found either by its .json meta data file or by being listed
+    for its section in store_sections (the frames of this bvh found in frame
+    meta data stores).
+    """
+    bvh_dir = os.path.join(labels_dir, bvh)
+    record = {'mtime': os.stat(bvh_dir).st_mtime_ns, 'sections': {}}
+    frames = {}
+
+    if old_record is not None and old_record['mtime'] == record['mtime']:
+        sections = list(old_record['sections'])
+        old_sections = old_record['sections']
+    else:
+        sections = [entry.name for entry in os.scandir(bvh_dir)
+                    if entry.is_dir()]
+        old_sections = old_record['sections'] if old_record else {}
+
+    for section in sections:
+        section_dir = os.path.join(bvh_dir, section)
+        try:
+            mtime = os.stat(section_dir).st_mtime_ns
+        except FileNotFoundError:
+            continue
+        record['sections'][section] = mtime
+        if old_sections.get(section) == mtime:
+            continue
 
-
-# 1. Load the full index
-try:
-    with open(full_filename, 'r') as fp:
-        full_index = fp.readlines()
-except FileNotFoundError as e:
-    for root, dirs, files in os.walk(data_dir):
-        for filename in files:
-            if filename.startswith("Image") and filename.endswith(".json"):
-                frame_name = filename[5:-5]
-                (mocap_path, section) = os.path.split(root)
-                (top_path,mocap) = os.path.split(mocap_path)
-
-                full_index.append("/%s/%s/Image%s\n" % (mocap, section, frame_name))
-
+        names = [entry.name[:-5] for entry in os.scandir(section_dir)
+                 if entry.name.startswith("Image") and
+                 entry.name.endswith(".json")]
+        found = set(names)
+        names += [name for name in store_sections.get(section, [])
+                  if name not in found]
+        frames[section] = names
+
+    return (record, frames)
+
+
+def crawl(labels_dir, catalog=None, old_records=None):
+    """Index all the frames found under labels_dir
+
+    Each top-level bvh directory is crawled in parallel. If an existing
+    catalog and the directory records from crawling it are given then only
+    frames in new or modified directories are rescanned and merged with the
+    existing catalog.
+
+    Returns a (catalog, records) tuple.
+    """
+    if catalog is None or old_records is None:
+        catalog = None
+        old_records = {}
+
+    # Renders made with --meta-format=store don't write a .json file per
+    # frame, so we also index the frames found in any frame meta data stores.
+    # The stores are only appended to, so their index sizes tell us whether
+    # they have changed and if so we rescan everything.
+    store_sizes = {}
+    for name in glimpse_frame_store.store_names(data_dir):
+        index_filename = glimpse_frame_store.store_filenames(data_dir, name)[2]
+        store_sizes[name] = os.path.getsize(index_filename)
+    if old_records.get('.frame_stores', {}) != store_sizes:
+        old_records = {}
+    store_frames = {}
+    for path in load_frame_stores(data_dir):
+        (bvh, section, name) = path[1:].split('/')
+        store_frames.setdefault(bvh, {}).setdefault(section, []).append(name)
+
+    bvhs = sorted(entry.name for entry in os.scandir(labels_dir)
+                  if entry.is_dir())
+
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        results = executor.map(
+            lambda bvh: crawl_bvh(labels_dir, bvh, old_records.get(bvh),
+                                  store_frames.get(bvh, {})), bvhs)
+
+        records = {'.frame_stores': store_sizes}
+        new_bvhs = []
+        new_sections = []
+        new_names = []
+        for (bvh, (record, frames)) in zip(bvhs, results):
+            records[bvh] = record
+            for section in sorted(frames):
+                names = frames[section]
                 if args.verbose:
-                    print("mocap = %s, section = %s, frame = %s" %
-                            (mocap, section, frame_name))
+                    print("%s/%s: %u frames" % (bvh, section, len(names)))
+                new_bvhs += [bvh] * len(names)
+                new_sections += [section] * len(names)
+                new_names += names
+
+    if catalog is None:
+        return (FrameCatalog.from_frames(new_bvhs, new_sections, new_names),
+                records)
+
+    # Only keep frames from sections that still exist and weren't rescanned
+    rescanned = set(zip(new_bvhs, new_sections))
+    keep_sections = np.zeros((len(catalog.bvh_names),
+                              len(catalog.section_names)), dtype=bool)
+    section_ids = {section: j for (j, section) in
+                   enumerate(catalog.section_names)}
+    for (i, bvh) in enumerate(catalog.bvh_names):
+        if bvh not in records:
+            continue
+        for section in records[bvh]['sections']:
+            if section in section_ids and (bvh, section) not in rescanned:
+                keep_sections[i, section_ids[section]] = True
+    keep = keep_sections[catalog.bvh, catalog.section]
 
-    with open(full_filename, 'w+') as fp:
-        full_index.sort()
-        for frame in full_index:
-            fp.write(frame)
+    print("Re-scanned %u sections, with %u frames" %
+          (len(rescanned), len(new_names)))
+    return (catalog.merge(keep, new_bvhs, new_sections, new_names), records)
 
-n_frames = len(full_index)
-print("index.%s: %u frames\n" % (args.full[0], n_frames))
 
-full_index_modified = False
+def index_rng(name):
+    """Create a random number generator for sampling the named index
 
+    The seed is either the --seed string or the name of the index, hashed
+    so that the sampling is reproducible for a given set of frames.
+    """
+    seed = args.seed if args.seed else name
+    digest = hashlib.sha512(seed.encode('utf-8')).digest()
+    return np.random.RandomState(np.frombuffer(digest[:16], dtype=np.uint32))
 
-# Apply filters that don't depend on parsing frame's .json meta data...
-if (args.bvh or
-        args.no_flipped or
-        args.only_flipped):
 
-    full_index_modified = True
-    filtered_index = []
-    for frame in full_index:
-        (bvh_name, section, frame_name) = frame.strip()[1:].split('/')
+def sample_uniform(rng, n, N, replace=True):
+    """Sample N ids in the range [0, n)"""
+    if replace:
+        return rng.randint(0, n, size=N)
+    else:
+        return rng.permutation(n)[:N]
+
+
+def sample_stratified(rng, groups, counts, replace=True):
+    """Sample counts[g] ids from the ids belonging to each group g
+
+    groups is an array giving the group id of each candidate and counts is
+    an array with the number of samples to take from each group. The
+    combined samples are shuffled.
+    """
+    order = np.argsort(groups, kind='mergesort')
+    group_sizes = np.bincount(groups, minlength=len(counts))
+    group_starts = np.concatenate(([0], np.cumsum(group_sizes)[:-1]))
+
+    samples = []
+    for g in np.flatnonzero(counts):
+        if not replace and counts[g] > group_sizes[g]:
+            raise ValueError("Not enough frames to sample without replacement")
+        members = order[group_starts[g]:group_starts[g] + group_sizes[g]]
+        samples.append(members[sample_uniform(rng, group_sizes[g], counts[g],
+                                              replace)])
+    if not samples:
+        return np.zeros(0, dtype=np.int64)
+    return rng.permutation(np.concatenate(samples))
+
+
+def load_metadata():
+    """Load (and update if necessary) the meta data for all frames"""
+    global metadata
+    if metadata is None:
+        metadata = FrameMetadata.update(catalog, data_dir, metadata_filename,
+                                        verbose=args.verbose)
+    return metadata
+
+
+def parse_weights(spec):
+    weights = {}
+    for entry in spec.split(','):
+        try:
+            (name, weight) = entry.split('=')
+            weights[name] = float(weight)
+        except ValueError:
+            sys.exit("Invalid balance weight '%s', expected NAME=WEIGHT" % entry)
+        if weights[name] < 0:
+            sys.exit("Negative balance weight for '%s'" % name)
+    return weights
+
+
+def allocate(N, weights, limits):
+    """Share N samples between groups in proportion to their weights
+
+    No group will be allocated more than its limit and any shortfall is
+    re-distributed between the remaining groups.
+    """
+    counts = np.zeros(len(weights), dtype=np.int64)
+    active = (weights > 0) & (limits > 0)
+    remaining = N
+    while remaining > 0 and np.any(active):
+        share = remaining * weights[active] / np.sum(weights[active])
+        alloc = np.floor(share).astype(np.int64)
+        # Largest remainder rounding...
+        short = remaining - np.sum(alloc)
+        alloc[np.argsort(alloc - share, kind='mergesort')[:short]] += 1
+        alloc = np.minimum(alloc, limits[active] - counts[active])
+        counts[active] += alloc
+        remaining -= np.sum(alloc)
+        active &= counts < limits
+    if remaining > 0:
+        raise ValueError("Not enough frames to balance index")
+    return counts
+
+
+def frame_groups(key):
+    """Returns (group names, group id per filtered frame) grouped by key
+
+    key may be 'bvh', 'body' or 'tags'.
+    """
+    if key == 'bvh':
+        (ids, groups) = np.unique(catalog.bvh[full_index], return_inverse=True)
+        return ([catalog.bvh_names[i] for i in ids], groups)
+
+    # Frames without any meta data are put in a None group which won't be
+    # sampled from
+    load_metadata()
+    if key == 'body':
+        (column, names) = (metadata.body, metadata.body_names)
+    else:
+        (column, names) = (metadata.tags, metadata.tag_sets)
+    keys = np.where(metadata.valid[full_index] != 0,
+                    column[full_index].astype(np.int64), -1)
+    (ids, groups) = np.unique(keys, return_inverse=True)
+    return ([names[i] if i >= 0 else None for i in ids], groups)
+
+
+def sample_balanced(rng, N, replace=True):
+    (group_names, groups) = frame_groups(args.balance_by)
+    group_sizes = np.bincount(groups, minlength=len(group_names))
+
+    weights = np.array([name is not None for name in group_names],
+                       dtype=np.float64)
+    if args.balance_weights:
+        spec = parse_weights(args.balance_weights)
+        default = spec.get('*', 1.0)
+        for (i, name) in enumerate(group_names):
+            if name is None:
+                continue
+            elif args.balance_by == 'tags':
+                tags = name.split(',') if name else []
+                weights[i] = np.mean([spec.get(tag, default)
+                                      for tag in tags] or [default])
+            else:
+                weights[i] = spec.get(name, default)
 
-        if args.no_flipped and frame_name.endswith('flipped'):
-            continue
+    if replace:
+        limits = np.where(group_sizes > 0, N, 0)
+    else:
+        limits = group_sizes.copy()
+    if args.balance_cap is not None:
+        limits = np.minimum(limits, args.balance_cap)
+
+    counts = allocate(N, weights, limits)
+    if args.verbose:
+        for i in np.argsort(-counts, kind='mergesort'):
+            if group_names[i] is None:
+                name = '<no meta data>'
+            else:
+                name = group_names[i] or '<none>'
+            print("  %-30s %8u frames (of %u)" %
+                  (name, counts[i], group_sizes[i]))
+
+    return sample_stratified(rng, groups, counts, replace)
+
+
+def split_partitions(rng, partitions):
+    """Split the filtered frames into disjoint partitions of the given sizes
+
+    Returns a list of the positions (within full_index) of the frames for
+    each partition, followed by the sorted positions of all the remaining
+    frames. With --split-by the shuffled groups of frames are handed out to
+    each partition in turn until it has enough frames so that no group is
+    shared between partitions. Frames without the meta data to group them
+    by aren't put in any partition but are kept with the remaining frames.
+    """
+    if not args.split_by:
+        order = rng.permutation(len(full_index))
+        splits = []
+        start = 0
+        for (name, N) in partitions:
+            splits.append(order[start:start + N])
+            start += N
+        splits.append(np.sort(order[start:]))
+        return splits
+
+    (group_names, groups) = frame_groups(args.split_by)
+    group_sizes = np.bincount(groups, minlength=len(group_names))
+    members = np.argsort(groups, kind='mergesort')
+    group_starts = np.concatenate(([0], np.cumsum(group_sizes)[:-1]))
+
+    def group_members(group_ids):
+        if not len(group_ids):
+            return np.zeros(0, dtype=np.int64)
+        return np.concatenate([members[group_starts[g]:
+                                       group_starts[g] + group_sizes[g]]
+                               for g in group_ids])
+
+    group_order = [g for g in rng.permutation(len(group_names))
+                   if group_names[g] is not None]
+    unknown_groups = [g for g in range(len(group_names))
+                      if group_names[g] is None]
+    n_unknown = int(sum(group_sizes[g] for g in unknown_groups))
+    if n_unknown:
+        print("WARNING: %u frames without meta data can't be split by %s so "
+              "they are left out of the partitions" % (n_unknown,
+                                                      args.split_by))
+    splits = []
+    pos = 0
+    for (name, N) in partitions:
+        start = pos
+        total = 0
+        while total < N and pos < len(group_order):
+            total += group_sizes[group_order[pos]]
+            pos += 1
+        if total < N:
+            sys.exit("Not enough frames to create partition %s without "
+                     "sharing any %s between partitions" % (name, args.split_by))
+        candidates = group_members(group_order[start:pos])
+        splits.append(candidates[rng.permutation(len(candidates))[:N]])
+        if args.verbose:
+            print("partition %s: %u %s groups" % (name, pos - start,
+                                                  args.split_by))
+    splits.append(np.sort(group_members(group_order[pos:] + unknown_groups)))
+    return splits
+
+
+def any_of(terms):
+    return '(%s)' % ' | '.join(terms)
 
-        if args.only_flipped and not frame_name.endswith('flipped'):
-            continue
 
-        if args.bvh and bvh_name not in args.bvh:
-            continue
+# 1. Load the full index
+#
+# The index.<full> text file is still considered to be the canonical list of
+# frames (it's what we document deleting to force a re-index) but we keep a
+# binary catalog next to it which is much faster to load and filter. The
+# catalog is re-created whenever it's missing or older than the text index.
+if (os.path.exists(full_filename) and
+        (not os.path.exists(catalog_filename) or
+         os.path.getmtime(catalog_filename) < os.path.getmtime(full_filename))):
+    with open(full_filename, 'r') as fp:
+        catalog = FrameCatalog.from_paths(fp.readlines())
+    catalog.save(catalog_filename)
+elif os.path.exists(full_filename):
+    catalog = FrameCatalog.load(catalog_filename)
+else:
+    catalog = None
+
+if catalog is None or args.update:
+    old_records = None
+    if catalog is not None:
+        try:
+            with open(dirs_filename, 'r') as fp:
+                old_records = json.load(fp)
+        except FileNotFoundError:
+            print("No %s file found, so re-indexing all frames" % dirs_filename)
+
+    print("Indexing frames under %s..." % labels_dir)
+    (catalog, records) = crawl(labels_dir, catalog, old_records)
+
+    catalog.write_index(full_filename, np.arange(len(catalog)))
+    catalog.save(catalog_filename)
+    with open(dirs_filename, 'w') as fp:
+        json.dump(records, fp)
+
+n_frames = len(catalog)
+print("index.%s: %u frames\n" % (args.full[0], n_frames))
 
-        filtered_index.append(frame)
-    full_index = filtered_index
+# We track the set of frames left after filtering as an (ascending) array of
+# catalog row ids
+full_index = np.arange(n_frames)
+full_index_modified = False
 
+# Only loaded if needed for filtering or balancing
+metadata = None
 
-# Apply (slower) filters that depend on parsing frame's .json meta data...
-if (args.body or
-        (args.tags_whitelist and args.tags_whitelist != 'all') or
-        (args.tags_blacklist and args.tags_blacklist != 'none')):
 
-    if args.tags_blacklist and args.tags_blacklist != 'none':
-        tags_blacklist = set(args.tags_blacklist.split(","))
-    else:
-        tags_blacklist = set()
-    if args.tags_whitelist and args.tags_whitelist != 'all':
-        tags_whitelist = set(args.tags_whitelist.split(","))
-    else:
-        tags_whitelist = set()
+# Apply filters...
+#
+# All the filter options are translated into a single FrameQuery (combined
+# with any -q,--query expression) which is evaluated to a bitmap over the
+# full catalog. The bitmaps are cached under index.<full>.cache keyed by the
+# query and the catalog + meta data versions so repeated runs with the same
+# filters don't need to re-evaluate them.
+#
+# The meta data for all frames is consolidated into an index.<full>.meta
+# table the first time it's needed and then incrementally updated when new
+# frames are added to the full index.
+filter_terms = []
+if args.no_flipped:
+    filter_terms.append('flipped=false')
+if args.only_flipped:
+    filter_terms.append('flipped=true')
+if args.bvh:
+    filter_terms.append(any_of(['bvh=%s' % json.dumps(bvh_name)
+                                for (bvh_name,) in args.bvh]))
+if args.body:
+    filter_terms.append(any_of(['body=%s' % json.dumps(body)
+                                for (body,) in args.body]))
+if args.tags_whitelist and args.tags_whitelist != 'all':
+    filter_terms.append(any_of(['tag=%s' % json.dumps(tag)
+                                for tag in args.tags_whitelist.split(',')]))
+if args.tags_blacklist and args.tags_blacklist != 'none':
+    filter_terms.append('!' + any_of(['tag=%s' % json.dumps(tag)
+                                      for tag in args.tags_blacklist.split(',')]))
+if args.query:
+    for query in args.query:
+        try:
+            filter_terms.append('(%s)' % FrameQuery(query))
+        except ValueError as e:
+            sys.exit("Invalid query '%s': %s" % (query, e))
+
+if filter_terms:
+    query = FrameQuery(' & '.join(filter_terms))
+
+    if query.uses_metadata:
+        load_metadata()
+
+    (keep, cached) = query.cached_evaluate(catalog, metadata,
+                                           full_filename + ".cache")
+    print("Filter: %s%s" % (query, " (cached)" if cached else ""))
 
     full_index_modified = True
-    filtered_index = []
-    for frame in full_index:
-        frame = frame.strip()
-
-        meta_filename = os.path.join(data_dir, 'labels', frame[1:] + ".json")
-        keep = True
-        with open(meta_filename, 'r') as fp:
-            meta = json.load(fp)
-
-            # We add a while loop here just for the sake of being able
-            # to break from the block early if any of the filters
-            # match this frame...
-            while True:
-                if args.body and meta['body'] not in args.body:
-                    keep = False
-                    break
-                bvh_tags = set(meta.get('tags', {}))
-                if tags_whitelist and not tags_whitelist & bvh_tags:
-                    keep = False
-                    break
-                if tags_blacklist & bvh_tags:
-                    keep = False
-                    break
-                break  # We don't actually want to loop
-
-        if keep:
-            filtered_index.append(frame)
-    full_index = filtered_index
+    full_index = full_index[keep]
+
+if args.build_metadata:
+    load_metadata()
 
 
 # Apply --exclude filters
+#
+# Excluded frames are looked up in the catalog and then removed via a
+# bitmap of excluded row ids, which preserves the order of the remaining
+# frames
 if args.exclude:
     full_index_modified = True
-    exclusions = []
+    excluded = np.zeros(len(catalog), dtype=bool)
     for (name,) in args.exclude:
         with open(os.path.join(data_dir, 'index.%s' % name), 'r') as fp:
-            lines = fp.readlines()
+            lines = fp.read().splitlines()
             print("index.%s: loaded %u frames to exclude" % (name, len(lines)))
-            exclusions += lines
+        ids = catalog.lookup(lines)
+        if args.verbose and np.any(ids < 0):
+            print("index.%s: %u frames not found in index.%s" %
+                  (name, np.count_nonzero(ids < 0), args.full[0]))
+        excluded[ids[ids >= 0]] = True
 
-    full_set = set(full_index)
-    exclusion_set = set(exclusions)
-    difference = full_set.difference(exclusion_set)
-    full_index = list(difference)
+    full_index = full_index[~excluded[full_index]]
 
 
 if not len(full_index):
@@ -238,48 +669,78 @@ if not len(full_index):
 if full_index_modified:
     n_frames = len(full_index)
     print("\n%u frames left after applying filters" % n_frames)
-    print("sorting...")
-    full_index.sort()
+
+
+names = {}
+for (name, length_str) in (args.partition or []) + (args.index or []):
+    if name in names:
+        raise ValueError("each index needs a unique name")
+    names[name] = 1
+
+
+# Split disjoint partitions
+if args.partition:
+    partitions = [(name, int(length_str))
+                  for (name, length_str) in args.partition]
+    if sum(N for (name, N) in partitions) > n_frames:
+        raise ValueError("Not enough frames to create requested partitions")
+
+    if args.seed:
+        rng = index_rng(args.seed)
+    else:
+        rng = index_rng(','.join(name for (name, N) in partitions))
+    splits = split_partitions(rng, partitions)
+
+    print("")
+    for ((name, N), split) in zip(partitions, splits):
+        catalog.write_index(os.path.join(data_dir, "index.%s" % name),
+                            full_index[split])
+        if args.split_by:
+            print("index %s: %d frames (disjoint partition, split by %s)" %
+                  (name, N, args.split_by))
+        else:
+            print("index %s: %d frames (disjoint partition)" % (name, N))
+
+    # Any -i,--index files are sampled from the remaining frames
+    full_index = full_index[splits[-1]]
+    n_frames = len(full_index)
+    if args.index:
+        print("\n%u frames left after partitioning" % n_frames)
 
 
 # Sample index files
 if args.index:
-    names = {}
-
     for (name, length_str) in args.index:
-        if name in names:
-            raise ValueError("each index needs a unique name")
-        names[name] = 1
         n_samples = int(length_str)
         if (args.without_replacement or args.all) and n_samples > n_frames:
             raise ValueError("Not enough frames to create requested index file %s" % name)
 
     print("")
-    start = 0
     for (name, length_str) in args.index:
         N = int(length_str)
+        rng = index_rng(name)
 
-        if args.seed:
-            random.seed(args.seed)
+        if args.all:
+            samples = np.arange(N)
+        elif args.balance_by:
+            samples = sample_balanced(rng, N,
+                                      replace=not args.without_replacement)
         else:
-            random.seed(name)
+            samples = sample_uniform(rng, n_frames, N,
+                                     replace=not args.without_replacement)
+
+        catalog.write_index(os.path.join(data_dir, "index.%s" % name),
+                            full_index[samples])
 
-        frame_range = range(n_frames)
         if args.all:
-            samples = frame_range[:N]
+            print("index %s: %d frames" % (name, N))
+        elif args.balance_by and args.without_replacement:
+            print("index %s: %d samples balanced by %s (without replacement)" %
+                  (name, N, args.balance_by))
+        elif args.balance_by:
+            print("index %s: %d samples balanced by %s (with replacement)" %
+                  (name, N, args.balance_by))
         elif args.without_replacement:
-            samples = random.sample(frame_range, N)
+            print("index %s: %d samples (without replacement)" % (name, N))
         else:
-            samples = [ random.choice(frame_range) for i in range(N) ]
-
-        with open(os.path.join(data_dir, "index.%s" % name), 'w+') as fp:
-            for i in samples:
-                fp.write(full_index[i])
-
-            if args.all:
-                print("index %s: %d frames" % (name, N))
-            elif args.without_replacement:
-                print("index %s: %d samples (without replacement)" % (name, N))
-            else:
-                print("index %s: %d samples (with replacement)" % (name, N))
-
+            print("index %s: %d samples (with replacement)" % (name, N))
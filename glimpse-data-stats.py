@@ -21,24 +21,71 @@
 # SOFTWARE.
 #
 
-# This lets us inspect the distribution of different tags across our indexed
-# training data.
+# This lets us inspect the distribution of different tags, bodies, clothing,
+# mocap sequences and camera parameters across our indexed training data, and
+# compare the composition of multiple indices (e.g. a test set and the
+# indices for training several trees).
+#
+# Frame meta data is taken from the index.<full>.meta table maintained by
+# glimpse-data-indexer.py when it's available and up to date, and otherwise
+# the frame .json files are loaded in parallel by a pool of processes.
 
 import os
 import sys
 import argparse
 import json
+import csv
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+import numpy as np
+
+from glimpse_catalog import (FrameCatalog, FrameMetadata, Interner,
+                             load_frame_stores, summarize_frames)
 
-parser = argparse.ArgumentParser()
+histogram_names = ['tags', 'bvh', 'body', 'clothes', 'camera']
+
+parser = argparse.ArgumentParser(
+    description="Report the distribution of tags, mocap sequences, bodies, "
+                "clothing and camera parameters across the frames of an "
+                "index. If multiple indices are given then their "
+                "distributions are compared with the first index, along with "
+                "the number of frames shared between each pair of indices.")
 parser.add_argument('--training-data',
                     default=os.path.dirname(os.path.realpath(__file__)),
                     help="Path to training data")
+parser.add_argument("-f", "--full", default='full',
+                    help="The index.<FULL> extension of the full index whose "
+                         ".catalog and .meta tables should be used (default "
+                         "'full')")
+parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(),
+                    help="Number of processes to use for loading frame .json "
+                         "files (default = number of CPUs)")
+parser.add_argument("--histograms", default=','.join(histogram_names),
+                    help="Comma separated list of histograms to report, out "
+                         "of %s (default all)" % ', '.join(histogram_names))
+parser.add_argument("--camera-bins", type=int, default=10,
+                    help="Number of bins for camera distance and viewing "
+                         "angle histograms (default 10)")
+
+parser.add_argument("--json", metavar="FILE",
+                    help="Also write the statistics to a JSON file")
+parser.add_argument("--csv", metavar="FILE",
+                    help="Also write the statistics to a CSV file")
 
-parser.add_argument("index_filename",
-                    help="Filename of index (create with glimpse-data-indexer) to parse")
+parser.add_argument("index_filename", nargs='+',
+                    help="Filename of index (create with glimpse-data-indexer) "
+                         "to parse. If multiple indices are given their "
+                         "distributions are compared with the first index")
 
 args = parser.parse_args()
 
+histograms = args.histograms.split(',')
+for name in histograms:
+    if name not in histogram_names:
+        parser.error("Unknown histogram '%s'" % name)
+
 hbars = [u"\u0020", u"\u258f", u"\u258e", u"\u258d", u"\u258b", u"\u258a", u"\u2589"]
 max_bar_width = 10
 
@@ -57,66 +104,500 @@ def get_percentage_bar(value, max_entries):
     return bar_output
 
 
-print("Training Data Dir: %s" % args.training_data)
+def print_histogram(title, counts, total_frames, sort=True):
+    """Print a table of (name, count) pairs with percentage bars
+
+    Unless sort=False the entries are sorted with the most frequent first.
+    """
+    if sort:
+        counts = sorted(counts, key=lambda kv: (-kv[1], kv[0]))
+    name_width = max([15] + [len(name) + 1 for (name, count) in counts])
+
+    dash = '-' * 80
+    print("N %s %s" % ((title + ':').ljust(12), len(counts)))
+    print(dash)
+    print('{:<{w}s}{:<10s}{:<10s} |{:<10s}|'.format("NAME",
+                                                    "FRAMES",
+                                                    "FRAMES(%)",
+                                                    " ",
+                                                    w=name_width))
+    print(dash)
+    for (name, count) in counts:
+        percentage = count / total_frames * 100
+        bar = get_percentage_bar(count, total_frames)
+
+        print('{:<{w}s}{:<10d}{:<10f} |{:<10s}|'.format(name,
+                                                        count,
+                                                        percentage,
+                                                        bar,
+                                                        w=name_width))
+    print(dash)
+
+
+def load_tables(data_dir):
+    """Load the full index catalog and meta data tables, if up to date"""
+    catalog_filename = os.path.join(data_dir, "index.%s.catalog" % args.full)
+    metadata_filename = os.path.join(data_dir, "index.%s.meta" % args.full)
+    if (not os.path.exists(catalog_filename) or
+            not os.path.exists(metadata_filename)):
+        return (None, None)
+
+    catalog = FrameCatalog.load(catalog_filename)
+    metadata = FrameMetadata.load(metadata_filename)
+    if metadata.catalog_version != catalog.version:
+        print("Ignoring out of date %s (re-run glimpse-data-indexer.py "
+              "with --build-metadata to update)" % metadata_filename)
+        return (None, None)
+
+    return (catalog, metadata)
+
+
+def load_frame_stats(data_dir, paths, need_meta=True):
+    """Load the properties we report statistics on for a list of frames
+
+    Returns a dict of per-frame columns ('bvh', 'body', 'clothes',
+    'distance', 'angle' and 'valid') along with the string tables that the
+    'bvh', 'body' and 'clothes' ids index. Only the 'bvh' column (which is
+    derived from the frame paths) is loaded if need_meta=False.
+    """
+    n_frames = len(paths)
+
+    bvhs = Interner([])
+    bvh = np.array([bvhs(path.split('/', 2)[1]) for path in paths],
+                   dtype=np.int64)
+    stats = {
+        'bvh': bvh,
+        'bvh_names': bvhs.table,
+    }
+    if not need_meta:
+        return stats
+
+    bodies = Interner([])
+    clothes = Interner([])
+    body = np.zeros(n_frames, dtype=np.int64)
+    clothes_ids = np.zeros(n_frames, dtype=np.int64)
+    distance = np.full(n_frames, np.nan, dtype=np.float64)
+    angle = np.full(n_frames, np.nan, dtype=np.float64)
+    valid = np.zeros(n_frames, dtype=bool)
+
+    # Firstly copy what we can from the consolidated meta data table...
+    (catalog, metadata) = load_tables(data_dir)
+    if catalog is not None:
+        ids = catalog.lookup(paths)
+        rows = np.flatnonzero(ids >= 0)
+        rows = rows[metadata.valid[ids[rows]] != 0]
+        ids = ids[rows]
+
+        body_map = np.array([bodies(name) for name in metadata.body_names],
+                            dtype=np.int64)
+        clothes_map = np.array([clothes(name)
+                                for name in metadata.clothes_sets],
+                               dtype=np.int64)
+        if len(rows):
+            body[rows] = body_map[metadata.body[ids]]
+            clothes_ids[rows] = clothes_map[metadata.clothes[ids]]
+            distance[rows] = metadata.camera_distance[ids]
+            angle[rows] = metadata.camera_viewing_angle[ids]
+            valid[rows] = True
+        print("Loaded meta data for %u frames from index.%s.meta" %
+              (len(rows), args.full))
+
+    # ...and then load the frame meta data stores or .json files for any
+    # remaining frames
+    missing = np.flatnonzero(~valid)
+    if len(missing):
+        print("Loading meta data for %u frames from frame stores or .json "
+              "files..." % len(missing))
+        # Load the stores before forking so each worker doesn't reload them
+        load_frame_stores(data_dir)
+        missing_paths = [paths[i] for i in missing.tolist()]
+        n_jobs = max(1, args.jobs)
+        chunk_size = max(1000, len(missing_paths) // (n_jobs * 4) + 1)
+        chunks = [missing_paths[i:i + chunk_size]
+                  for i in range(0, len(missing_paths), chunk_size)]
+
+        if n_jobs > 1 and len(chunks) > 1:
+            # Explicitly fork so the workers don't re-run this script
+            with ProcessPoolExecutor(
+                    max_workers=n_jobs,
+                    mp_context=multiprocessing.get_context('fork')) as executor:
+                results = executor.map(summarize_frames, repeat(data_dir),
+                                       chunks)
+                results = [result for chunk in results for result in chunk]
+        else:
+            results = [result for chunk in chunks
+                       for result in summarize_frames(data_dir, chunk)]
+
+        for (i, result) in zip(missing.tolist(), results):
+            if result is None:
+                continue
+            (body_name, clothes_set, tags_set, cam_distance, cam_angle) = result
+            body[i] = bodies(body_name)
+            clothes_ids[i] = clothes(clothes_set)
+            distance[i] = cam_distance
+            angle[i] = cam_angle
+            valid[i] = True
+
+    stats.update({
+        'body': body,
+        'body_names': bodies.table,
+        'clothes': clothes_ids,
+        'clothes_sets': clothes.table,
+        'distance': distance,
+        'angle': angle,
+        'valid': valid,
+    })
+    return stats
+
+
+def table_counts(ids, names, mask=None):
+    """Count the frames referencing each entry of a string table"""
+    if mask is not None:
+        ids = ids[mask]
+    counts = np.bincount(ids, minlength=len(names))
+    return [(name, int(count)) for (name, count) in zip(names, counts)
+            if count]
+
+
+def tag_counts(stats, rows, mocap_name_map):
+    bvh_counts = table_counts(stats['bvh'][rows], stats['bvh_names'])
+    counts = {}
+    n_unknown = 0
+    for (bvh_name, count) in bvh_counts:
+        if bvh_name not in mocap_name_map:
+            n_unknown += count
+            continue
+        for tag in mocap_name_map[bvh_name].get('tags', {}):
+            counts[tag] = counts.get(tag, 0) + count
+    if n_unknown:
+        print("WARNING: %u frames belong to mocap sequences not found in the "
+              "mocap index" % n_unknown)
+    return list(counts.items())
 
-mocaps_dir = os.path.join(args.training_data, 'mocap')
-print("MoCaps Dir: %s" % mocaps_dir)
+
+def clothes_counts(stats, rows):
+    """Count the frames with each item of clothing (like 'hat=patrol_cap')"""
+    counts = {}
+    for (clothes_set, count) in table_counts(stats['clothes'][rows],
+                                             stats['clothes_sets'],
+                                             stats['valid'][rows]):
+        for item in clothes_set.split(','):
+            if item:
+                counts[item] = counts.get(item, 0) + count
+    return list(counts.items())
+
+
+def label_set_counts(name, stats, rows):
+    """Count the frames with each combination of tags or clothing
+
+    Each frame can have any number of tags or items of clothing, so their
+    histograms can't be compared as distributions over frames. Instead they
+    are compared by the distribution of each frame's whole set of labels
+    (with 'none' for frames without any).
+    """
+    if name == 'tags':
+        counts = {}
+        for (bvh_name, count) in table_counts(stats['bvh'][rows],
+                                              stats['bvh_names']):
+            if bvh_name not in mocap_name_map:
+                continue
+            tags = ','.join(sorted(mocap_name_map[bvh_name].get('tags', {})))
+            label = tags or 'none'
+            counts[label] = counts.get(label, 0) + count
+        return list(counts.items())
+    else:
+        return [(clothes_set or 'none', count)
+                for (clothes_set, count) in table_counts(
+                    stats['clothes'][rows], stats['clothes_sets'],
+                    stats['valid'][rows])]
+
+
+def camera_counts(values, edges):
+    values = values[np.isfinite(values)]
+    if not len(values) or edges is None:
+        return []
+    (counts, edges) = np.histogram(values, bins=edges)
+    return [("%.2f - %.2f" % (edges[i], edges[i + 1]), int(count))
+            for (i, count) in enumerate(counts)]
+
+
+def camera_edges(values, bins):
+    """Bin edges shared by all the indices being compared"""
+    values = values[np.isfinite(values)]
+    if not len(values):
+        return None
+    return np.histogram_bin_edges(values, bins=bins)
+
+
+def histogram_counts(name, stats, rows, edges):
+    """Returns a list of (label, count) pairs for one of our histograms"""
+    if name == 'tags':
+        return tag_counts(stats, rows, mocap_name_map)
+    elif name == 'bvh':
+        return table_counts(stats['bvh'][rows], stats['bvh_names'])
+    elif name == 'body':
+        return table_counts(stats['body'][rows], stats['body_names'],
+                            stats['valid'][rows])
+    elif name == 'clothes':
+        return clothes_counts(stats, rows)
+    else:
+        return camera_counts(stats[name][rows], edges[name])
+
+
+def divergence(p, q):
+    """Returns the Jensen-Shannon divergence and total variation distance
+
+    p and q are arrays of counts which are normalized into distributions.
+    The Jensen-Shannon divergence is measured in bits (so is in the range
+    [0, 1]).
+    """
+    p = p / max(p.sum(), 1)
+    q = q / max(q.sum(), 1)
+    m = (p + q) / 2
+
+    def kl(a, b):
+        nonzero = a > 0
+        return np.sum(a[nonzero] * np.log2(a[nonzero] / b[nonzero]))
+
+    return (float((kl(p, m) + kl(q, m)) / 2),
+            float(np.abs(p - q).sum() / 2))
+
+
+def index_label(filename):
+    name = os.path.basename(filename)
+    return name[len('index.'):] if name.startswith('index.') else name
+
+
+# Each camera histogram is reported as two separate histograms
+report_names = []
+for name in histograms:
+    if name == 'camera':
+        report_names += ['distance', 'angle']
+    else:
+        report_names.append(name)
+report_titles = {
+    'tags': "Tags",
+    'bvh': "BVHs",
+    'body': "Bodies",
+    'clothes': "Clothes",
+    'distance': "Distances",
+    'angle': "Angles",
+}
+
+
+print("Training Data Dir: %s" % args.training_data)
 
 mocap_name_map = {}
+if 'tags' in histograms:
+    mocaps_dir = os.path.join(args.training_data, 'mocap')
+    print("MoCaps Dir: %s" % mocaps_dir)
 
-index_filename = os.path.join(mocaps_dir, "index.json")
-with open(index_filename, 'r') as fp:
-    mocap_index = json.load(fp)
+    index_filename = os.path.join(mocaps_dir, "index.json")
+    with open(index_filename, 'r') as fp:
+        mocap_index = json.load(fp)
 
-    for bvh in mocap_index:
-        mocap_name_map[bvh['name']] = bvh
+        for bvh in mocap_index:
+            mocap_name_map[bvh['name']] = bvh
 
-if not len(mocap_name_map):
-    sys.exit("Empty mocap index")
+    if not len(mocap_name_map):
+        sys.exit("Empty mocap index")
 
-data_dir = os.path.dirname(args.index_filename)
-print("Data Dir: %s" % data_dir)
-with open(args.index_filename, 'r') as fp:
-    index = fp.readlines()
+indices = []
+for filename in args.index_filename:
+    with open(filename, 'r') as fp:
+        paths = [line.strip() for line in fp.readlines() if line.strip()]
+    if not paths:
+        sys.exit("Empty index %s" % filename)
+    indices.append({
+        'filename': filename,
+        'label': index_label(filename),
+        'data_dir': os.path.dirname(filename),
+        'paths': paths,
+    })
 
-    tag_counts = {}
+# The stats for all indices under the same data directory are loaded
+# together for the union of their frames, so frames shared between indices
+# (or duplicated within an index) are only loaded once
+need_meta = bool(set(histograms) & set(['body', 'clothes', 'camera']))
+data_dirs = []
+for index in indices:
+    if index['data_dir'] not in data_dirs:
+        data_dirs.append(index['data_dir'])
+dir_stats = {}
+for data_dir in data_dirs:
+    print("Data Dir: %s" % data_dir)
+    dir_indices = [index for index in indices if index['data_dir'] == data_dir]
+    unique_paths = sorted(set(path for index in dir_indices
+                              for path in index['paths']))
+    stats = load_frame_stats(data_dir, unique_paths, need_meta)
+    if need_meta:
+        n_invalid = int(np.count_nonzero(~stats['valid']))
+        if n_invalid:
+            print("WARNING: Failed to load meta data for %u frames" % n_invalid)
+    dir_stats[data_dir] = stats
 
-    total_frames = len(index)
-    if not total_frames:
-        sys.exit("Empty index")
+    path_rows = {path: i for (i, path) in enumerate(unique_paths)}
+    for index in dir_indices:
+        index['rows'] = np.array([path_rows[path] for path in index['paths']],
+                                 dtype=np.int64)
+        index['unique_rows'] = np.unique(index['rows'])
 
-    for frame in index:
-        filename = os.path.join(data_dir, 'labels', frame.strip()[1:] + ".json")
-        with open(filename, 'r') as fp:
-            meta = json.load(fp)
+edges = {}
+for name in ['distance', 'angle']:
+    if name in report_names:
+        values = np.concatenate([dir_stats[index['data_dir']][name][index['rows']]
+                                 for index in indices])
+        edges[name] = camera_edges(values, args.camera_bins)
 
-            bvh = mocap_name_map[meta['bvh']]
-            if 'tags' in bvh:
-                for tag in bvh['tags']:
-                    if tag not in tag_counts:
-                        tag_counts[tag] = 1
-                    else:
-                        tag_counts[tag] += 1
+report = {
+    'indices': [],
+    'overlap': [],
+    'histograms': {},
+}
+for index in indices:
+    report['indices'].append({
+        'name': index['label'],
+        'filename': index['filename'],
+        'n_frames': len(index['rows']),
+        'n_unique_frames': len(index['unique_rows']),
+    })
 
-    dash = '-' * 80
+# Count the unique frames shared between each pair of indices
+for a in indices:
+    row = []
+    for b in indices:
+        if a['data_dir'] != b['data_dir']:
+            row.append(0)
+        else:
+            row.append(len(np.intersect1d(a['unique_rows'], b['unique_rows'],
+                                          assume_unique=True)))
+    report['overlap'].append(row)
+
+# Compare each index's histograms with the first index
+for name in report_names:
+    per_index = [dict(histogram_counts(name, dir_stats[index['data_dir']],
+                                       index['rows'], edges))
+                 for index in indices]
+    if name in ('distance', 'angle'):
+        # The bins are shared, so keep them in order
+        labels = []
+        for counts in per_index:
+            labels += [label for label in counts if label not in labels]
+    else:
+        totals = {}
+        for counts in per_index:
+            for (label, count) in counts.items():
+                totals[label] = totals.get(label, 0) + count
+        labels = sorted(totals, key=lambda label: (-totals[label], label))
+    counts = np.array([[counts.get(label, 0) for label in labels]
+                       for counts in per_index], dtype=np.int64)
+    if name in ('tags', 'clothes'):
+        per_index_sets = [dict(label_set_counts(name,
+                                                dir_stats[index['data_dir']],
+                                                index['rows']))
+                          for index in indices]
+        set_labels = sorted(set(label for set_counts in per_index_sets
+                                for label in set_counts))
+        set_counts = np.array([[set_counts.get(label, 0)
+                                for label in set_labels]
+                               for set_counts in per_index_sets],
+                              dtype=np.int64)
+        divergences = [divergence(set_counts[0], set_counts[i])
+                       for i in range(len(indices))]
+    else:
+        divergences = [divergence(counts[0], counts[i])
+                       for i in range(len(indices))]
+    report['histograms'][name] = {
+        'labels': labels,
+        'counts': counts.tolist(),
+        'js_divergence': [js for (js, tv) in divergences],
+        'total_variation': [tv for (js, tv) in divergences],
+    }
+
+
+dash = '-' * 80
+if len(indices) == 1:
+    total_frames = report['indices'][0]['n_frames']
     print(dash)
     print("N Frames:      %s" % total_frames)
-    print("N Tags:        %s" % len(tag_counts))
 
+    for name in report_names:
+        histogram = report['histograms'][name]
+        print_histogram(report_titles[name],
+                        list(zip(histogram['labels'], histogram['counts'][0])),
+                        total_frames,
+                        sort=name not in ('distance', 'angle'))
+else:
+    label_width = max([15] + [len(index['label']) + 1 for index in indices])
+    column_width = max([10] + [len(index['label']) + 1 for index in indices])
+
+    def print_row(name, values, fmt):
+        print(name.ljust(label_width) +
+              ''.join(fmt.format(value).ljust(column_width)
+                      for value in values))
+
+    print(dash)
+    print_row("INDEX", [index['label'] for index in indices], '{}')
     print(dash)
-    print('{:<15s}{:<10s}{:<10s} |{:<10s}|'.format("NAME",
-                                                   "FRAMES",
-                                                   "FRAMES(%)",
-                                                   " "))
+    print_row("N Frames", [info['n_frames'] for info in report['indices']],
+              '{}')
+    print_row("N Unique", [info['n_unique_frames']
+                           for info in report['indices']], '{}')
+    print(dash)
+    print("OVERLAP (unique frames shared between indices)")
+    print(dash)
+    for (index, row) in zip(indices, report['overlap']):
+        print_row(index['label'], row, '{}')
 
+    for name in report_names:
+        histogram = report['histograms'][name]
+        totals = [info['n_frames'] for info in report['indices']]
+        name_width = max([label_width] + [len(label) + 1
+                                          for label in histogram['labels']])
+        print(dash)
+        print("%s (%% of frames)" % report_titles[name].upper())
+        print(dash)
+        for (i, label) in enumerate(histogram['labels']):
+            print(label.ljust(name_width) +
+                  ''.join(("%.2f" % (counts[i] / total * 100)).ljust(column_width)
+                          for (counts, total) in zip(histogram['counts'],
+                                                     totals)))
+        print(dash)
+        print("JS divergence from %s" % indices[0]['label'])
+        print(''.ljust(name_width) +
+              ''.join(("%.4f" % value).ljust(column_width)
+                      for value in histogram['js_divergence']))
+        print("Total variation from %s" % indices[0]['label'])
+        print(''.ljust(name_width) +
+              ''.join(("%.4f" % value).ljust(column_width)
+                      for value in histogram['total_variation']))
     print(dash)
-    for tag, val in sorted(tag_counts.items(), key=lambda kv: (-kv[1], kv[0])):
-        percentage = val / total_frames * 100
-        bar = get_percentage_bar(val, total_frames)
 
-        print('{:<15s}{:<10d}{:<10f} |{:<10s}|'.format(tag,
-                                                       tag_counts[tag],
-                                                       percentage,
-                                                       bar))
 
-    print(dash)
+if args.json:
+    with open(args.json, 'w') as fp:
+        json.dump(report, fp, indent=2)
+
+if args.csv:
+    # A 'long' format that's easy to load into a spreadsheet or dashboard
+    with open(args.csv, 'w', newline='') as fp:
+        writer = csv.writer(fp)
+        writer.writerow(['metric', 'histogram', 'label', 'index', 'value'])
+        for info in report['indices']:
+            writer.writerow(['frames', '', '', info['name'], info['n_frames']])
+            writer.writerow(['unique_frames', '', '', info['name'],
+                             info['n_unique_frames']])
+        for (a, row) in zip(report['indices'], report['overlap']):
+            for (b, count) in zip(report['indices'], row):
+                writer.writerow(['overlap', '', b['name'], a['name'], count])
+        for name in report_names:
+            histogram = report['histograms'][name]
+            for (i, info) in enumerate(report['indices']):
+                for (label, count) in zip(histogram['labels'],
+                                          histogram['counts'][i]):
+                    writer.writerow(['frames', name, label, info['name'],
+                                     count])
+                writer.writerow(['js_divergence', name, '', info['name'],
+                                 histogram['js_divergence'][i]])
+                writer.writerow(['total_variation', name, '', info['name'],
+                                 histogram['total_variation'][i]])
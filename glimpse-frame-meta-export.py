@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2018 Glimp IP Ltd
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+# Renders made with glimpse-generator.py render --meta-format=store append the
+# meta data for all frames to a consolidated store (see
+# blender/modules/glimpse_frame_store.py) instead of writing a .json file per
+# frame. This exports a store as the original labels/<bvh>/<section>/*.json
+# files for tools that still expect them (such as the image-pre-processor).
+# glimpse-data-indexer.py and glimpse-data-stats.py read stores directly.
+
+import os
+import sys
+import argparse
+import json
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                'blender', 'modules'))
+import glimpse_frame_store
+
+
+parser = argparse.ArgumentParser(
+    description="Export the consolidated frame meta data of renders as a "
+                ".json file per frame")
+parser.add_argument('render_dir', nargs='+',
+                    help="Render directory (as passed to render --dest plus "
+                         "the --name of the render or instance)")
+parser.add_argument('--compact', action='store_true',
+                    help="Don't indent the .json files")
+parser.add_argument('--skip-existing', action='store_true',
+                    help="Don't overwrite existing .json files")
+
+args = parser.parse_args()
+
+indent = None if args.compact else 2
+
+status = 0
+for render_dir in args.render_dir:
+    # Instances sharing a render directory each write their own store
+    store_names = glimpse_frame_store.store_names(render_dir)
+    if not store_names:
+        print("WARNING: No frame meta data store found in %s" % render_dir)
+        status = 1
+        continue
+
+    for store_name in store_names:
+        store = glimpse_frame_store.FrameMetaStore(render_dir, store_name)
+
+        n_written = 0
+        n_skipped = 0
+        for i in store.latest():
+            meta_filename = os.path.join(render_dir, 'labels',
+                                         store.frame_path(i)[1:] + '.json')
+            if args.skip_existing and os.path.exists(meta_filename):
+                n_skipped += 1
+                continue
+
+            os.makedirs(os.path.dirname(meta_filename), exist_ok=True)
+            with open(meta_filename, 'w') as fp:
+                json.dump(store.frame_meta(i), fp, indent=indent)
+            n_written += 1
+
+        print("%s (%s): wrote %d .json files (%d skipped) for %d frame records" %
+              (render_dir, store_name, n_written, n_skipped, len(store)))
+
+sys.exit(status)
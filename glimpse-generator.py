@@ -34,7 +34,20 @@ import sys
 import argparse
 import subprocess
 import datetime
+import time
 import json
+import collections
+import threading
+import glob
+import socket
+import traceback
+
+# The decisions about what to render are shared with the
+# glimpse_data_generator addon so we can also plan renders without Blender
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                'blender', 'modules'))
+import glimpse_render_plan
+import glimpse_render_timings
 
 # Detect whether the script is running under Blender or not...
 try:
@@ -53,8 +66,16 @@ if as_blender_addon:
     parser.add_argument('--instance-overrides',
                         action='store_true', help=argparse.SUPPRESS)
     parser.add_argument('--instance-name', help=argparse.SUPPRESS)
+    parser.add_argument('--instance-suffix', default='', help=argparse.SUPPRESS)
     parser.add_argument('--instance-start', type=int, help=argparse.SUPPRESS)
     parser.add_argument('--instance-end', type=int, help=argparse.SUPPRESS)
+    # used to override --training-data with an absolute path, since a
+    # persistent worker may be running in a different directory...
+    parser.add_argument('--instance-training-data', help=argparse.SUPPRESS)
+    # used when rendering jobs are handed out by the parent process via
+    # stdin instead of rendering a fixed --instance-start/end range...
+    parser.add_argument('--instance-queue',
+                        action='store_true', help=argparse.SUPPRESS)
 else:
     parser = argparse.ArgumentParser(prog="glimpse-generator")
 
@@ -72,6 +93,11 @@ parser.add_argument('--verbose', action='store_true',
 parser.add_argument('--training-data',
                     default=os.path.dirname(os.path.realpath(__file__)),
                     help="Path to training data")
+parser.add_argument('--worker', action='append', metavar='SOCKET',
+                    help="Run the subcommand on a persistent Blender worker "
+                         "(see the worker subcommand) instead of starting a "
+                         "new instance of Blender. Can be given multiple "
+                         "times for rendering with multiple workers")
 
 
 # TODO: support being able to give an explicit bvh name instead of --start/end
@@ -138,8 +164,13 @@ parser_render = subparsers.add_parser('render', help='Render data')
 
 parser_render.add_argument('--dest', default=os.path.join(os.getcwd(), 'renders'),
                            help='Directory to write files too')
-parser_render.add_argument('--name', default=date_str,
-                           help='Unique name for this render run')
+parser_render.add_argument('--name',
+                           help='Unique name for this render run (default '
+                                'based on the current date and time)')
+parser_render.add_argument('--resume', action='store_true',
+                           help='Resume an interrupted render with the same '
+                                '--name, skipping frames that were already '
+                                'completed')
 
 add_filter_options(parser_render)
 
@@ -147,16 +178,589 @@ parser_render.add_argument('--skip-percentage', type=int, default=0,
                            help='(random) percentage of frames to skip '
                                 '(overrides config; default 0)')
 
+parser_render.add_argument('--meta-format', choices=['json', 'store'],
+                           default='json',
+                           help='Write the meta data for each frame as a .json '
+                                'file per frame or append it all to a '
+                                'consolidated binary store for each instance '
+                                '(see glimpse-frame-meta-export.py to convert '
+                                'a store to .json files) (default json)')
+parser_render.add_argument('--camera-trajectories', action='store_true',
+                           help='Save the precomputed camera trajectory for '
+                                'each mocap and body as <name>/cameras/<bvh>/'
+                                '<body>.npz and reuse them when re-rendering '
+                                'with the same settings')
+parser_render.add_argument('--legacy-scene-updates', action='store_true',
+                           help='Update the scene after each frame_set() and '
+                                'after moving the camera, as older versions '
+                                'did, for comparing timing reports with and '
+                                'without these updates')
 parser_render.add_argument('--config',
                            help='Detailed configuration for filtering and '
                                 'camera resolution + positioning options')
 parser_render.add_argument('--dry-run',
-                           help='Just print information without rendering',
+                           help='Just print information about what would be '
+                                'rendered (determined without running '
+                                'Blender)',
                            action='store_true')
-
+parser_render.add_argument('--manifest',
+                           help='With --dry-run, write a manifest of every '
+                                'frame that would be rendered (one JSON object '
+                                'per line) to this file. Otherwise only render '
+                                'the frames listed in this manifest')
+
+parser_render.add_argument('--status-interval', type=float, default=60,
+                           help='How often (in seconds) to report the '
+                                'overall progress and update the '
+                                '<dest>/<name>.status.json status file '
+                                '(default 60)')
+parser_render.add_argument('--max-restarts', type=int, default=3,
+                           help='How many times to restart an instance of '
+                                'Blender that exits with an error before '
+                                'giving up on it (default 3)')
+parser_render.add_argument('--max-mocap-failures', type=int, default=2,
+                           help='How many times rendering a mocap may fail '
+                                'before it\'s quarantined instead of being '
+                                'retried (default 2)')
+parser_render.add_argument('--separate-parts', action='store_true',
+                           help='With multiple instances, have each instance '
+                                'render into its own <name>-part-<i> '
+                                'directory instead of sharing one <name> '
+                                'directory (see combine-split-renders.sh)')
 parser_render.add_argument('-j', '--num-instances', type=int, default=1,
                            help='Number of Blender instances to run')
 
+parser_worker = subparsers.add_parser(
+    'worker', help='Run a persistent instance of Blender that other '
+                   'subcommands can be run on via --worker (to avoid the '
+                   'cost of starting Blender and loading the .blend file '
+                   'for each subcommand)')
+parser_worker.add_argument('--socket', required=True,
+                           help='Path for the unix socket to listen on')
+parser_worker.add_argument('--blend-file',
+                           help='Override .blend file to load (default '
+                                '<training_data>/blender/glimpse-training.blend)')
+parser_worker.add_argument('--stop', action='store_true',
+                           help='Stop the worker listening on --socket')
+
+
+def render_settings(cli_args):
+    """Determine the render settings from a render --config and options
+
+    Returns a dictionary of settings named after the Blender scene
+    properties they are applied to, or raises a ValueError for an invalid
+    config.
+
+    This is used both for rendering within Blender and for planning a render
+    (with --dry-run) without Blender, so the two always agree.
+    """
+    settings = dict(glimpse_render_plan.default_render_settings)
+    settings['GlimpseBvhTagsWhitelist'] = cli_args.tags_whitelist
+    settings['GlimpseBvhTagsBlacklist'] = cli_args.tags_blacklist
+
+    skip_percentage = 0
+
+    if cli_args.config:
+        with open(cli_args.config, 'r') as fp:
+            config = json.load(fp)
+
+        def check_scalar(obj, obj_namespace, prop, minimum, maximum, scale):
+            if prop not in obj:
+                raise ValueError("Config missing %s.%s value" % (obj_namespace, prop))
+            val = obj[prop]
+            if val < minimum:
+                raise ValueError("%s.%s=%f < minimum of %f" % (obj_namespace, prop, val, minimum))
+            if val > maximum:
+                raise ValueError("%s.%s=%f > maximum of %f" % (obj_namespace, prop, val, maximum))
+            if scale != 1:
+                # Scaled values are stored in integer properties (in mm)
+                return int(round(val * scale))
+            return val
+
+        if 'filters' in config:
+            filters = config['filters']
+            skip_percentage = filters.get('skip_percentage', 0)
+
+            body_whitelist = filters.get('body_whitelist', 'all')
+            if body_whitelist != 'all':
+                settings['GlimpseBodyWhitelist'] = ','.join(body_whitelist)
+
+            clothes_whitelist = filters.get('clothes_whitelist', 'all')
+            if clothes_whitelist != 'all':
+                settings['GlimpseClothesWhitelist'] = ','.join(clothes_whitelist)
+
+            tag_whitelist = filters.get('tag_whitelist', None)
+            if tag_whitelist is not None:
+                tag_whitelist = list(set(tag_whitelist))
+                settings['GlimpseBvhTagsWhitelist'] = ','.join(tag_whitelist)
+
+            tag_blacklist = filters.get('tag_blacklist', None)
+            if tag_blacklist is not None:
+                tag_blacklist = list(set(tag_blacklist))
+                settings['GlimpseBvhTagsBlacklist'] = ','.join(tag_blacklist)
+
+            if 'tag_skip_percentages' in filters:
+                tag_skip_percentages = filters['tag_skip_percentages']
+                tag_skip_strings = []
+                for key in tag_skip_percentages:
+                    val = tag_skip_percentages[key]
+                    if val < 0 or val > 100:
+                        raise ValueError("Skip percentage for '%s' tag out of range [0,100]" % key)
+                    tag_skip_strings += ["%s=%d" % (key, val)]
+                settings['GlimpseBvhTagsSkip'] = ",".join(tag_skip_strings)
+                if settings['GlimpseBvhTagsSkip'] == "":
+                    settings['GlimpseBvhTagsSkip'] = 'none'
+
+        if 'camera' not in config:
+            raise ValueError('config must include "camera" description')
+
+        camera = config['camera']
+
+        settings['GlimpseRenderWidth'] = \
+            check_scalar(camera, 'camera', 'width', 240, 2048, 1)
+        settings['GlimpseRenderHeight'] = \
+            check_scalar(camera, 'camera', 'height', 240, 2048, 1)
+
+        settings['GlimpseVerticalFOV'] = \
+            check_scalar(camera, 'camera', 'vertical_fov', 20, 170, 1)
+
+        if 'position' not in camera:
+            raise ValueError('config "camera" must include "position"')
+        camera_pos = camera['position']
+
+        if 'mode' not in camera_pos:
+            raise ValueError('config camera.position must specify a "mode"')
+
+        camera_mode = camera_pos['mode']
+
+        if camera_mode in ('randomized', 'smooth'):
+            if camera_mode == 'smooth':
+                settings['GlimpseSmoothCameraMovement'] = True
+
+            settings['GlimpseMinCameraDistanceMM'] = \
+                check_scalar(camera_pos, 'camera.position', 'min_distance',
+                             0, 20, 1000)
+            settings['GlimpseMaxCameraDistanceMM'] = \
+                check_scalar(camera_pos, 'camera.position', 'max_distance',
+                             0, 20, 1000)
+            settings['GlimpseMinCameraHeightMM'] = \
+                check_scalar(camera_pos, 'camera.position', 'min_height',
+                             0, 20, 1000)
+            settings['GlimpseMaxCameraHeightMM'] = \
+                check_scalar(camera_pos, 'camera.position', 'max_height',
+                             0, 20, 1000)
+            settings['GlimpseMinViewingAngle'] = \
+                check_scalar(camera_pos, 'camera.position', 'min_horizontal_rotation',
+                             -180, 180, 1)
+            settings['GlimpseMaxViewingAngle'] = \
+                check_scalar(camera_pos, 'camera.position', 'max_horizontal_rotation',
+                             -180, 180, 1)
+            if camera_mode == 'smooth':
+                settings['GlimpseSmoothCameraFrequency'] = \
+                    check_scalar(camera_pos, 'camera.position', 'drift_frequency',
+                                 0, 100, 1)
+
+            if (settings['GlimpseMaxCameraDistanceMM'] <
+                    settings['GlimpseMinCameraDistanceMM']):
+                raise ValueError("Maximum camera distance must be >= minimum camera distance")
+
+            if (settings['GlimpseMaxCameraHeightMM'] <
+                    settings['GlimpseMinCameraHeightMM']):
+                raise ValueError("Maximum camera height must be >= minimum camera height")
+
+            if (settings['GlimpseMaxViewingAngle'] <
+                    settings['GlimpseMinViewingAngle']):
+                raise ValueError("Min viewing angle is higher than or equal to max viewing angle")
+
+            if 'focus_bone' in camera_pos:
+                settings['GlimpseFocusBone'] = camera_pos['focus_bone']
+
+        elif camera_mode == 'fixed':
+            settings['GlimpseFixedCamera'] = True
+
+            settings['GlimpseMinCameraDistanceMM'] = \
+                check_scalar(camera_pos, 'camera.position', 'distance',
+                             0, 20, 1000)
+            settings['GlimpseMinCameraHeightMM'] = \
+                check_scalar(camera_pos, 'camera.position', 'height',
+                             0, 20, 1000)
+            settings['GlimpseMinViewingAngle'] = \
+                check_scalar(camera_pos, 'camera.position', 'horizontal_rotation',
+                             -180, 180, 1)
+
+            if 'focus_bone' in camera_pos:
+                settings['GlimpseFocusBone'] = camera_pos['focus_bone']
+
+        elif camera_mode == 'debug':
+            settings['GlimpseDebugCamera'] = True
+        else:
+            raise ValueError('Unknown camera mode: %s (expected "randomized",'
+                             ' "smooth", "fixed" or "debug")' % camera_mode)
+
+        if 'add_background' in config:
+            settings['GlimpseAddBackground'] = config['add_background']
+        if 'clothing_step' in config:
+            settings['GlimpseClothingStep'] = config['clothing_step']
+
+    # Note: some command line options may override the given --config
+
+    if cli_args.tags_whitelist == 'all':
+        settings['GlimpseBvhTagsWhitelist'] = 'all'
+    else:
+        settings['GlimpseBvhTagsWhitelist'] = cli_args.tags_whitelist
+
+    if cli_args.tags_blacklist != 'none':
+        settings['GlimpseBvhTagsBlacklist'] = cli_args.tags_blacklist
+
+    if cli_args.skip_percentage:
+        skip_percentage = cli_args.skip_percentage
+
+    if skip_percentage < 0 or skip_percentage > 100:
+        raise ValueError("'skip_percentage' %d out of range [0,100]" % skip_percentage)
+
+    settings['GlimpseSkipPercentage'] = skip_percentage
+
+    return settings
+
+
+def plan_render(cli_args):
+    """Work out everything a render would include, without running Blender
+
+    Prints a summary of the frames that would be rendered and, if given a
+    --manifest, writes out a description of every frame which can be used to
+    estimate costs or passed back to render --manifest to render exactly
+    those frames.
+    """
+    try:
+        settings = render_settings(cli_args)
+    except ValueError as e:
+        sys.exit(str(e))
+
+    index_filename = os.path.join(cli_args.training_data, 'mocap', 'index.json')
+    with open(index_filename, 'r') as fp:
+        mocap_index = json.load(fp)
+
+    tags_whitelist = settings['GlimpseBvhTagsWhitelist']
+    if tags_whitelist == 'all':
+        tags_whitelist = None
+    else:
+        tags_whitelist = tags_whitelist.split(',')
+
+    # Like the addon, we always filter out blacklisted mocaps when rendering
+    tags_blacklist = settings['GlimpseBvhTagsBlacklist']
+    if tags_blacklist == 'none':
+        tags_blacklist = []
+    else:
+        tags_blacklist = tags_blacklist.split(',')
+    if 'blacklist' not in tags_blacklist:
+        tags_blacklist += ['blacklist']
+
+    name_patterns = None
+    if cli_args.name_match:
+        name_patterns = ','.join(cli_args.name_match).split(',')
+
+    manifest_fp = None
+    if cli_args.manifest:
+        manifest_fp = open(cli_args.manifest, 'w')
+
+    n_mocaps = 0
+    n_frames = 0
+    tag_stats = collections.Counter()
+    body_stats = collections.Counter()
+    clothes_stats = collections.Counter()
+
+    end = min(cli_args.end, len(mocap_index))
+    for i in range(cli_args.start, end):
+        bvh = mocap_index[i]
+        glimpse_render_plan.normalize_mocap_entry(bvh)
+        # NB: Blender would use the frame range of a preloaded action in
+        # this case
+        if 'end' not in bvh:
+            bvh['end'] = 1000
+
+        reason = glimpse_render_plan.mocap_filter_reason(
+            bvh, name_patterns=name_patterns,
+            tags_whitelist=tags_whitelist, tags_blacklist=tags_blacklist)
+        if reason is not None:
+            if cli_args.debug and cli_args.verbose:
+                print("> filtered out %s: %s" % (bvh['name'], reason))
+            continue
+        n_mocaps += 1
+
+        for frame in glimpse_render_plan.plan_mocap_frames(bvh, settings):
+            n_frames += 1
+            for tag in bvh['tags']:
+                tag_stats[tag] += 1
+            body_stats[frame['body']] += 1
+            clothes_stats.update(frame['clothes'].values())
+
+            if manifest_fp:
+                frame['mocap'] = i
+                manifest_fp.write(json.dumps(frame) + "\n")
+
+    if manifest_fp:
+        manifest_fp.close()
+        print("Wrote manifest of %d frames to %s" % (n_frames, cli_args.manifest))
+
+    print("Rendering %d filtered mocap sequences" % n_mocaps)
+    print("")
+
+    for (title, stats) in (("TAGS", tag_stats),
+                           ("BODIES", body_stats),
+                           ("CLOTHES", clothes_stats)):
+        if not n_frames:
+            break
+        print("%s IN RENDERED FRAMES:" % title)
+        for key, val in sorted(stats.items(), key=lambda kv: (-kv[1], kv[0])):
+            print('  {:<25s}{:<10d}{:<10.2f}'.format(key, val,
+                                                    val / n_frames * 100))
+        print("")
+
+    print("Total frame count = %d" % n_frames)
+    print("")
+    print("NB: the frame count may double to ~ %d after running the\n"
+          "image-pre-processor if flipping is enabled." %
+          (n_frames * 2))
+    print("")
+    print("NB: mocaps that haven't been preloaded will be skipped when\n"
+          "rendering, and clothes that aren't available for a body will\n"
+          "be left out.")
+    print("")
+
+
+class SocketWriter:
+    """Text file like wrapper for writing to a worker connection
+
+    Closing only shuts down our side of the connection (so the other end
+    sees the end of its input) without closing the socket.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.buf = []
+
+    def write(self, text):
+        self.buf.append(text)
+        return len(text)
+
+    def flush(self):
+        if self.buf:
+            self.sock.sendall(''.join(self.buf).encode('utf-8'))
+            self.buf = []
+
+    def close(self):
+        self.flush()
+        self.sock.shutdown(socket.SHUT_WR)
+
+
+class WorkerConnection:
+    """Runs a subcommand on a persistent Blender worker
+
+    This mimics the subset of subprocess.Popen that we use for managing
+    Blender instances, with .stdin, .stdout and .wait()
+    """
+
+    def __init__(self, socket_path, argv):
+        self.returncode = None
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(socket_path)
+        self.stdin = SocketWriter(self.sock)
+        self.stdin.write(json.dumps({'argv': argv}) + "\n")
+        self.stdin.flush()
+        self.stdout = self._read_lines(self.sock.makefile('r',
+                                                          encoding='utf-8'))
+
+    def _read_lines(self, fp):
+        for line in fp:
+            if line.startswith("> WORKER JOB STATUS:"):
+                self.returncode = int(line.split(':')[1])
+            else:
+                yield line
+
+    def wait(self):
+        for line in self.stdout:
+            pass
+        self.sock.close()
+        # If we didn't see a status then the worker died
+        if self.returncode is None:
+            self.returncode = 1
+        return self.returncode
+
+
+class RenderProgress:
+    """Tracks the progress of all the instances of a render
+
+    Instances report each frame they render with a '> PROGRESS {json}' line
+    which are aggregated here into the overall throughput and an estimated
+    time remaining. Progress is measured in terms of the length of the
+    queued mocap sequences, so it accounts for frames that get skipped.
+    """
+
+    # How far back to look when measuring the current frame rate
+    rate_window = 300
+
+    # An instance is considered stalled if it hasn't reported any progress
+    # for this long while working on a job
+    stall_seconds = 600
+
+    def __init__(self, instance_names, total_length, mocap_length):
+        self.lock = threading.Lock()
+        self.start_time = time.monotonic()
+        self.total_length = total_length
+        self.mocap_length = mocap_length
+        self.done_length = 0
+        self.instances = []
+        for name in instance_names:
+            self.instances.append({
+                'name': name,
+                'frames_done': 0,
+                'jobs_done': 0,
+                'job': None,
+                'job_fraction': 0.0,
+                'bvh': None,
+                'body': None,
+                'frame': None,
+                'last_progress': self.start_time,
+                'recent': collections.deque(),
+                'finished': False,
+            })
+
+    def job_started(self, i, job):
+        with self.lock:
+            instance = self.instances[i]
+            instance['job'] = job
+            instance['job_fraction'] = 0.0
+            instance['last_progress'] = time.monotonic()
+
+    def job_done(self, i):
+        with self.lock:
+            instance = self.instances[i]
+            if instance['job'] is not None:
+                for mocap in range(instance['job']['start'],
+                                   instance['job']['end']):
+                    self.done_length += self.mocap_length(mocap)
+                instance['jobs_done'] += 1
+            instance['job'] = None
+            instance['job_fraction'] = 0.0
+
+    def job_failed(self, i):
+        with self.lock:
+            self.instances[i]['job'] = None
+            self.instances[i]['job_fraction'] = 0.0
+
+    def finished(self, i):
+        with self.lock:
+            self.instances[i]['finished'] = True
+            self.instances[i]['job'] = None
+
+    def frame_rendered(self, i, event):
+        """Handles a progress event for a frame rendered by instance i"""
+        now = time.monotonic()
+        with self.lock:
+            instance = self.instances[i]
+            instance['frames_done'] += 1
+            instance['bvh'] = event['bvh']
+            instance['body'] = event['body']
+            instance['frame'] = event['frame']
+            instance['last_progress'] = now
+            instance['recent'].append(now)
+
+            # Each body is rendered in turn, over the whole sequence
+            n_frames = max(event['end'] - event['start'], 1)
+            instance['job_fraction'] = (
+                (event['body_index'] * n_frames + event['frame'] -
+                 event['start'] + 1) / (event['n_bodies'] * n_frames))
+
+    def status(self):
+        """A snapshot of the render's progress as a dictionary"""
+        now = time.monotonic()
+        elapsed = now - self.start_time
+        window = min(elapsed, self.rate_window)
+
+        with self.lock:
+            instances = []
+            frames_done = 0
+            done_length = self.done_length
+            total_rate = 0.0
+
+            for instance in self.instances:
+                recent = instance['recent']
+                while recent and recent[0] < now - self.rate_window:
+                    recent.popleft()
+                rate = len(recent) / window if window > 0 else 0.0
+                total_rate += rate
+                frames_done += instance['frames_done']
+
+                if instance['job'] is not None:
+                    job_length = sum(self.mocap_length(mocap) for mocap in
+                                     range(instance['job']['start'],
+                                           instance['job']['end']))
+                    done_length += instance['job_fraction'] * job_length
+
+                idle = now - instance['last_progress']
+                instances.append({
+                    'name': instance['name'],
+                    'frames_done': instance['frames_done'],
+                    'frames_per_second': rate,
+                    'jobs_done': instance['jobs_done'],
+                    'bvh': instance['bvh'],
+                    'body': instance['body'],
+                    'frame': instance['frame'],
+                    'seconds_since_progress': idle,
+                    'stalled': (instance['job'] is not None and
+                                idle > self.stall_seconds),
+                    'finished': instance['finished'],
+                })
+
+        fraction = 0.0
+        if self.total_length:
+            fraction = min(done_length / self.total_length, 1.0)
+
+        eta = None
+        if fraction > 0:
+            eta = elapsed * (1 - fraction) / fraction
+
+        return {
+            'time': datetime.datetime.now().isoformat(),
+            'elapsed_seconds': elapsed,
+            'frames_done': frames_done,
+            'frames_per_second': total_rate,
+            'fraction_done': fraction,
+            'eta_seconds': eta,
+            'instances': instances,
+        }
+
+
+def format_duration(seconds):
+    if seconds is None:
+        return "unknown"
+    seconds = int(seconds)
+    return "%d:%02d:%02d" % (seconds // 3600, (seconds // 60) % 60,
+                             seconds % 60)
+
+
+def print_progress(status):
+    stalled = [instance['name'] for instance in status['instances']
+               if instance['stalled']]
+    line = ("Progress: %.1f%%, %d frames rendered, %.2f frames/sec, "
+            "elapsed %s, ETA %s" %
+            (status['fraction_done'] * 100,
+             status['frames_done'],
+             status['frames_per_second'],
+             format_duration(status['elapsed_seconds']),
+             format_duration(status['eta_seconds'])))
+    if stalled:
+        line += " (STALLED: %s)" % ", ".join(stalled)
+    print(line, flush=True)
+
+
+def write_status(filename, status):
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'w') as fp:
+        json.dump(status, fp, indent=2)
+    os.rename(tmp_filename, filename)
+
+
 # If this script is run from the command line and we're not yet running within
 # Blender's Python environment then we will spawn Blender and tell it to
 # re-evaluate this script.
@@ -164,7 +768,15 @@ parser_render.add_argument('-j', '--num-instances', type=int, default=1,
 if not as_blender_addon:
     cli_args = parser.parse_args()
 
-    if cli_args.end < 0:
+    if cli_args.subcommand == 'worker' and cli_args.stop:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(cli_args.socket)
+        sock.sendall((json.dumps({'argv': [], 'shutdown': True}) +
+                      "\n").encode('utf-8'))
+        sock.close()
+        sys.exit(0)
+
+    if cli_args.subcommand != 'worker' and cli_args.end < 0:
         mocaps_dir = os.path.join(cli_args.training_data, 'mocap')
         index_filename = os.path.join(mocaps_dir, "index.json")
         with open(index_filename, 'r') as fp:
@@ -175,9 +787,12 @@ if not as_blender_addon:
 
     blend_filename = os.path.join(cli_args.training_data,
                                   'blender', 'glimpse-training.blend')
-    if cli_args.subcommand == 'preload' and cli_args.blend_file:
+    if cli_args.subcommand in ('preload', 'worker') and cli_args.blend_file:
         blend_filename = cli_args.blend_file
 
+    if cli_args.worker and cli_args.subcommand == 'worker':
+        sys.exit("--worker can't be used with the worker subcommand")
+
     blender_cmd = [
             'blender', '-b',
             '-noaudio',  # work around failure to quit blender
@@ -198,43 +813,237 @@ if not as_blender_addon:
         name = cli_args.name
         dest = cli_args.dest
 
-        n_mocaps = cli_args.end - cli_args.start
+        if cli_args.dry_run:
+            plan_render(cli_args)
+            sys.exit(0)
+
+        with open(os.path.join(training_data, 'mocap', 'index.json'),
+                  'r') as fp:
+            mocap_index = json.load(fp)
+
+        # Make sure instances (or workers) running in a different directory
+        # render into the same --dest that we track (which isn't in argv at
+        # all if left as the default) and find the same --config
+        sys.argv += ['--dest', os.path.abspath(dest)]
+        if cli_args.config:
+            sys.argv += ['--config', os.path.abspath(cli_args.config)]
+
+        if cli_args.manifest:
+            # Only the mocaps listed in the manifest need to be queued and we
+            # know exactly how many frames will be rendered for each one
+            manifest_frame_counts = collections.Counter()
+            with open(cli_args.manifest, 'r') as fp:
+                for line in fp:
+                    manifest_frame_counts[json.loads(line)['mocap']] += 1
+            queue_mocaps = list(manifest_frame_counts)
+
+            # Similarly for finding the manifest
+            sys.argv += ['--manifest', os.path.abspath(cli_args.manifest)]
+
+            def mocap_length(i):
+                return manifest_frame_counts[i]
+        else:
+            queue_end = min(cli_args.end, len(mocap_index))
+            queue_mocaps = list(range(cli_args.start, queue_end))
+
+            def mocap_length(i):
+                bvh = mocap_index[i]
+                return int(bvh.get('end', 1000)) - int(bvh.get('start', 1))
+
+        if name is None:
+            if cli_args.resume:
+                sys.exit("--resume requires the --name of the render to resume")
+            name = date_str
+            # Make sure all the instances agree on the name
+            sys.argv += ['--name', name]
+
+        n_mocaps = len(queue_mocaps)
+        if cli_args.worker:
+            cli_args.num_instances = len(cli_args.worker)
         if cli_args.num_instances > n_mocaps:
             cli_args.num_instances = n_mocaps
 
-        step = int(n_mocaps / cli_args.num_instances)
-
         print("Rendering %d mocap sequences with %d instance[s] of Blender" %
               (n_mocaps, cli_args.num_instances))
-        print("Each instance is rendering %d sequences" % step)
-        if step * cli_args.num_instances != n_mocaps:
-            print("Except last instance is rendering %d sequences" %
-                  (n_mocaps - (cli_args.num_instances * step)))
-
         print("Path to training data is '%s'" % training_data)
         print("Destination is '%s'" % dest)
 
-        processes = []
+        threads = []
+        instance_status = [0] * cli_args.num_instances
 
-        n_frames = 0
+        # Each instance writes a report of its frame timings which are
+        # rolled up into one report once they've all finished
+        timings_filenames = []
+        rollup_filename = os.path.join(dest, name + '.timings.json')
+        quarantine_filename = os.path.join(dest, name + '.quarantine.json')
+        for filename in (rollup_filename, quarantine_filename):
+            if not cli_args.resume and os.path.exists(filename):
+                os.remove(filename)
 
         status = 0
 
-        for i in range(cli_args.num_instances):
+        # Rather than statically dividing the mocap range between the
+        # instances (mocaps vary a lot in length so one instance could
+        # finish hours after the others) each instance is handed one
+        # mocap sequence at a time from a shared queue, longest first,
+        # whenever it finishes its previous job.
+        job_queue = collections.deque(
+            sorted(queue_mocaps, key=lambda i: (-mocap_length(i), i)))
+        job_queue_lock = threading.Lock()
+
+        print("Mocap sequences are queued longest first, with %d frames "
+              "in total" % sum(mocap_length(i) for i in job_queue))
+
+        def next_job():
+            with job_queue_lock:
+                if not job_queue:
+                    return None
+                i = job_queue.popleft()
+                return {'start': i, 'end': i + 1}
+
+        # If an instance exits with a job unfinished the job is put back on
+        # the queue for another attempt (on a restarted instance, or another
+        # instance), unless the mocap has already caused too many failures,
+        # in which case it's quarantined.
+        mocap_failures = collections.Counter()
+        quarantined_mocaps = []
+
+        def job_failed(job):
+            with job_queue_lock:
+                for mocap in range(job['start'], job['end']):
+                    mocap_failures[mocap] += 1
+                    if mocap_failures[mocap] >= cli_args.max_mocap_failures:
+                        quarantined_mocaps.append(mocap)
+                        print("WARNING: Quarantining mocap %d (%s) after %d "
+                              "failed attempts to render it" %
+                              (mocap, mocap_index[mocap]['name'],
+                               mocap_failures[mocap]))
+                    else:
+                        job_queue.appendleft(mocap)
+
+        def jobs_pending():
+            with job_queue_lock:
+                return len(job_queue) > 0
+
+        # Forwards an instance's output to its log while handing it new
+        # jobs each time it reports being ready for more work
+        #
+        # Returns the job the instance was working on if it exited before
+        # finishing it
+        def feed_instance(i, p, log_fp):
+            job = None
+            for line in p.stdout:
+                # Progress events are only for the parent so they don't
+                # clutter the log
+                if line.startswith("> PROGRESS "):
+                    try:
+                        progress.frame_rendered(
+                            i, json.loads(line[len("> PROGRESS "):]))
+                    except (ValueError, KeyError):
+                        log_fp.write(line)
+                    continue
+
+                log_fp.write(line)
+                if (line.startswith("> QUEUE READY") or
+                        line.startswith("> QUEUE JOB DONE")):
+                    log_fp.flush()
+                    progress.job_done(i)
+                    job = next_job()
+                    try:
+                        if job is None:
+                            p.stdin.close()
+                        else:
+                            progress.job_started(i, job)
+                            p.stdin.write(json.dumps(job) + "\n")
+                            p.stdin.flush()
+                    except (BrokenPipeError, ValueError):
+                        pass
+            return job
+
+        # Runs an instance until the queue is empty, restarting it (up to
+        # --max-restarts times) if it fails
+        def run_instance(i, start_instance, log_fp):
+            n_restarts = 0
+            while True:
+                try:
+                    p = start_instance(n_restarts > 0)
+                except OSError as e:
+                    print("WARNING: Failed to start instance %d: %s" % (i, e))
+                    instance_status[i] = 1
+                    break
+
+                unfinished_job = feed_instance(i, p, log_fp)
+                returncode = p.wait()
+                if returncode == 0 and unfinished_job is None:
+                    break
+
+                message = "Instance %d exited with status %d" % (i, returncode)
+                if unfinished_job is not None:
+                    message += (" before finishing mocaps %d to %d" %
+                                (unfinished_job['start'], unfinished_job['end']))
+                    progress.job_failed(i)
+                    job_failed(unfinished_job)
+                print("WARNING: " + message)
+                log_fp.write("> " + message + "\n")
+                log_fp.flush()
+
+                if not jobs_pending():
+                    if unfinished_job is None:
+                        instance_status[i] = 1
+                    break
+                if n_restarts >= cli_args.max_restarts:
+                    print("WARNING: Not restarting instance %d again after "
+                          "%d restarts" % (i, n_restarts))
+                    instance_status[i] = 1
+                    break
+
+                n_restarts += 1
+                print("Restarting instance %d (restart %d of %d)" %
+                      (i, n_restarts, cli_args.max_restarts))
+                log_fp.write("> Restarting instance (restart %d of %d)\n" %
+                             (n_restarts, cli_args.max_restarts))
+
+            progress.finished(i)
+            log_fp.close()
+
+        def instance_part_suffix(i):
             if cli_args.num_instances > 1:
-                part_suffix = '-part-%d' % i
+                return '-part-%d' % i
             else:
-                part_suffix = ""
+                return ""
 
-            part_name = name + part_suffix
+        progress = RenderProgress(
+            [name + instance_part_suffix(i)
+             for i in range(cli_args.num_instances)],
+            sum(mocap_length(i) for i in job_queue), mocap_length)
 
-            start = cli_args.start + i * step
-            # The last instance may have to do some extra work if the step
-            # doesn't factor neatly...
-            if i is not cli_args.num_instances - 1:
-                end = start + step
+        # Periodically report the overall progress and write it to a status
+        # file, so stalled or slow instances can be spotted
+        status_filename = os.path.join(dest, name + '.status.json')
+        progress_done = threading.Event()
+
+        def report_progress():
+            while not progress_done.wait(cli_args.status_interval):
+                status = progress.status()
+                print_progress(status)
+                write_status(status_filename, status)
+
+        progress_thread = threading.Thread(target=report_progress)
+        progress_thread.daemon = True
+        progress_thread.start()
+
+        for i in range(cli_args.num_instances):
+            part_suffix = instance_part_suffix(i)
+
+            # By default all the instances render into the same directory
+            # (the frames are all written to distinct paths) with a suffix
+            # for the few files that are written per-instance
+            if cli_args.separate_parts:
+                part_name = name + part_suffix
+                file_suffix = ''
             else:
-                end = cli_args.end
+                part_name = name
+                file_suffix = part_suffix
 
             # So we don't have to fiddle around with trying to edit
             # the user's given options to change the start/end range
@@ -242,9 +1051,14 @@ if not as_blender_addon:
             # instead...
             instance_args = [
                     '--instance-overrides',
-                    '--instance-start', str(start),
-                    '--instance-end', str(end),
-                    '--instance-name', part_name
+                    '--instance-queue',
+                    '--instance-start', str(cli_args.start),
+                    '--instance-end', str(cli_args.end),
+                    '--instance-training-data', os.path.abspath(training_data),
+                    '--instance-name', part_name,
+                    # NB: the suffix starts with a '-' so it has to be
+                    # passed as one argument for argparse
+                    '--instance-suffix=' + file_suffix
             ]
 
             print("Instance %d name: %s" % (i, part_name))
@@ -253,51 +1067,100 @@ if not as_blender_addon:
             print("Blender instance %d command:  %s" %
                   (i, " ".join(instance_cmd)))
 
-            # We have some special case handling of dry-run when split across
-            # multiple instances since we really want some extra convenience
-            # for determining a total frame count
-            if cli_args.dry_run:
-                try:
-                    blender_output = subprocess.check_output(instance_cmd).decode('utf-8')
-                    blender_lines = blender_output.splitlines()
-                    found_frame_count = False
-                    for line in blender_lines:
-                        if line.startswith("> DRY RUN FRAME COUNT:"):
-                            parts = line.split(":")
-                            frame_count = int(parts[1].strip())
-                            found_frame_count = True
-                            break
-                    print(blender_output)
-                    if found_frame_count:
-                        n_frames += frame_count
-                except subprocess.CalledProcessError:
-                    status = 1
-            else:
-                log_filename = os.path.join(dest, part_name,
-                                            'render%s.log' % part_suffix)
-                print("Instance %d log: %s" % (i, log_filename))
-                os.makedirs(os.path.join(dest, part_name), exist_ok=True)
-                with open(log_filename, 'w') as fp:
-                    p = subprocess.Popen(instance_cmd, stdout=fp, stderr=fp)
-                    processes.append(p)
+            log_filename = os.path.join(dest, part_name,
+                                        'render%s.log' % part_suffix)
+            print("Instance %d log: %s" % (i, log_filename))
+            os.makedirs(os.path.join(dest, part_name), exist_ok=True)
+            log_fp = open(log_filename, 'a' if cli_args.resume else 'w')
+
+            # As with the log, timings are only accumulated across runs when
+            # resuming
+            timings_filename = glimpse_render_timings.report_filename(
+                os.path.join(dest, part_name), file_suffix)
+            timings_filenames.append(timings_filename)
+            if not cli_args.resume and os.path.exists(timings_filename):
+                os.remove(timings_filename)
+
+            # A restarted instance resumes so it skips over any frames
+            # that were rendered before the failure
+            def start_instance(restart, i=i, instance_args=instance_args,
+                               instance_cmd=instance_cmd):
+                resume_args = []
+                if restart and not cli_args.resume:
+                    resume_args = ['--resume']
+                if cli_args.worker:
+                    return WorkerConnection(cli_args.worker[i],
+                                            instance_args + sys.argv[1:] +
+                                            resume_args)
+                else:
+                    return subprocess.Popen(instance_cmd + resume_args,
+                                            stdin=subprocess.PIPE,
+                                            stdout=subprocess.PIPE,
+                                            stderr=subprocess.STDOUT,
+                                            universal_newlines=True)
+
+            thread = threading.Thread(target=run_instance,
+                                      args=(i, start_instance, log_fp))
+            thread.start()
+            threads.append(thread)
 
         print("Waiting for all Blender instances to complete...")
         print("")
-        for p in processes:
-            if p.wait() != 0:
-                status = 1
+        for thread in threads:
+            thread.join()
+
+        if any(instance_status):
+            status = 1
+
+        progress_done.set()
+        progress_thread.join()
+        final_status = progress.status()
+        print_progress(final_status)
+        write_status(status_filename, final_status)
 
         if status == 1:
             print("WARNING: One of the Blender instances exited with an error")
-        elif cli_args.dry_run:
-            if n_frames:
-                print("Total frame count across all instances = %d" % n_frames)
-            print("")
-            print("NB: the frame count may double to ~ %d after running the\n"
-                  "image-pre-processor if flipping is enabled." %
-                  (n_frames * 2))
-            print("")
 
+        # Anything left in the queue was never rendered because all the
+        # instances that could have rendered it failed
+        unfinished_mocaps = sorted(job_queue)
+        if quarantined_mocaps or unfinished_mocaps:
+            status = 1
+            with open(quarantine_filename, 'w') as fp:
+                json.dump({
+                    'quarantined': [
+                        {'mocap': i,
+                         'name': mocap_index[i]['name'],
+                         'failures': mocap_failures[i]}
+                        for i in sorted(quarantined_mocaps)],
+                    'unfinished': [
+                        {'mocap': i, 'name': mocap_index[i]['name']}
+                        for i in unfinished_mocaps],
+                }, fp, indent=2)
+            print("WARNING: %d mocaps were quarantined and %d weren't "
+                  "rendered (see %s)" % (len(quarantined_mocaps),
+                                         len(unfinished_mocaps),
+                                         quarantine_filename))
+
+        timing_reports = [glimpse_render_timings.load_report(filename)
+                          for filename in timings_filenames
+                          if os.path.exists(filename)]
+        if timing_reports:
+            timings = glimpse_render_timings.merge_reports(timing_reports)
+            print("Frame timings across all instances (%d frames):" %
+                  timings['n_frames'])
+            for line in glimpse_render_timings.report_summary_lines(timings):
+                print("  " + line)
+            if len(timings_filenames) > 1:
+                glimpse_render_timings.save_report(rollup_filename, timings)
+                print("Wrote combined frame timings to %s" % rollup_filename)
+
+        sys.exit(status)
+
+    elif cli_args.subcommand == 'worker':
+        instance_cmd = blender_cmd + sys.argv[1:]
+        print("Blender command:  %s" % " ".join(instance_cmd))
+        status = subprocess.call(instance_cmd)
         sys.exit(status)
 
     else:
@@ -308,9 +1171,20 @@ if not as_blender_addon:
         instance_args = [
                 '--instance-overrides',
                 '--instance-start', str(cli_args.start),
-                '--instance-end', str(cli_args.end)
+                '--instance-end', str(cli_args.end),
+                '--instance-training-data',
+                os.path.abspath(cli_args.training_data)
         ]
 
+        if cli_args.worker:
+            print("Running on worker %s" % cli_args.worker[0])
+            p = WorkerConnection(cli_args.worker[0],
+                                 instance_args + sys.argv[1:])
+            p.stdin.close()
+            for line in p.stdout:
+                sys.stdout.write(line)
+            sys.exit(p.wait())
+
         instance_cmd = blender_cmd + instance_args + sys.argv[1:]
         print("Blender command:  %s" % " ".join(instance_cmd))
         status = subprocess.call(instance_cmd)
@@ -321,7 +1195,18 @@ if not as_blender_addon:
 # From this point on we can assume we are running withing Blender's Python
 # environment...
 
+class WorkerJobError(Exception):
+    pass
+
+
+# Set while running as a persistent worker (see serve_worker()), in which
+# case errors should only fail the current job instead of exiting Blender
+worker_mode = False
+
+
 def blender_exit(ret=0):
+    if worker_mode:
+        raise WorkerJobError(ret)
     print("Blender exiting")
     if ret:
         print("ERROR: %s" % str(ret), flush=True)
@@ -362,291 +1247,202 @@ if dep_error != "":
     print("\n")
     sys.exit(1)
 
-bpy.context.scene.GlimpseDebug = cli_args.debug
-bpy.context.scene.GlimpseVerbose = cli_args.verbose
-
-
-# Currently all the subcommands accept filtering options...
-if cli_args.instance_overrides:
-    bpy.context.scene.GlimpseBvhGenFrom = cli_args.instance_start
-    bpy.context.scene.GlimpseBvhGenTo = cli_args.instance_end
-else:
-    bpy.context.scene.GlimpseBvhGenFrom = cli_args.start
-    bpy.context.scene.GlimpseBvhGenTo = cli_args.end
-
-bpy.context.scene.GlimpseBvhTagsWhitelist = cli_args.tags_whitelist
-bpy.context.scene.GlimpseBvhTagsBlacklist = cli_args.tags_blacklist
-
-if cli_args.name_match:
-    bpy.context.scene.GlimpseBvhNamePatterns = ','.join(cli_args.name_match)
-else:
-    bpy.context.scene.GlimpseBvhNamePatterns = ''
-
-
-mocaps_dir = os.path.join(cli_args.training_data, 'mocap')
-if not os.path.isdir(mocaps_dir):
-    blender_exit("Non-existent mocaps directory %s" % mocaps_dir)
-bpy.context.scene.GlimpseBvhRoot = mocaps_dir
-
-if cli_args.subcommand == 'info':
-    bpy.ops.glimpse.generator_info()
-    blender_exit()
-elif cli_args.subcommand == 'preload':
-    bpy.context.scene.GlimpseDryRun = cli_args.dry_run
-    bpy.ops.glimpse.generator_preload()
-    if not cli_args.dry_run:
-        print("Saving to %s" % bpy.context.blend_data.filepath)
-        bpy.ops.wm.save_as_mainfile(filepath=bpy.context.blend_data.filepath)
-    blender_exit()
-elif cli_args.subcommand == 'link':
-    bpy.context.scene.GlimpseDryRun = cli_args.dry_run
-    bpy.context.scene.GlimpseMocapLibrary = cli_args.mocap_library
-    bpy.ops.glimpse.generator_link()
-    if not cli_args.dry_run:
-        print("Saving to %s" % bpy.context.blend_data.filepath)
-        bpy.ops.wm.save_as_mainfile(filepath=bpy.context.blend_data.filepath)
-    blender_exit()
-elif cli_args.subcommand == 'purge':
-    bpy.context.scene.GlimpseDryRun = cli_args.dry_run
-    bpy.ops.glimpse.purge_mocap_actions()
-    if not cli_args.dry_run:
-        print("Saving to %s" % bpy.context.blend_data.filepath)
-        bpy.ops.wm.save_as_mainfile(filepath=bpy.context.blend_data.filepath)
-    blender_exit()
-elif cli_args.subcommand == 'render':
-
-    bpy.context.scene.GlimpseDryRun = cli_args.dry_run
-    bpy.context.scene.GlimpseDataRoot = cli_args.dest
-    print("DataRoot: " + cli_args.dest)
-
-    bpy.context.scene.GlimpseMinCameraDistanceMM = bpy.context.scene.GlimpseMinCameraDistanceMM
+def run_subcommand(cli_args):
+    if worker_mode:
+        # Don't let the properties set for one job affect the next
+        for prop in bpy.types.Scene.bl_rna.properties:
+            if prop.identifier.startswith('Glimpse') and not prop.is_readonly:
+                bpy.context.scene.property_unset(prop.identifier)
 
-    skip_percentage = 0
+        # The completed and manifest frames are only cached for the jobs of
+        # a single subcommand since the journals may have been written and
+        # the manifest regenerated in between
+        import glimpse_data_generator
+        glimpse_data_generator.completed_frames_cache.clear()
+        glimpse_data_generator.manifest_frames_cache.clear()
 
-    if cli_args.config:
-        with open(cli_args.config, 'r') as fp:
-            config = json.load(fp)
+    bpy.context.scene.GlimpseDebug = cli_args.debug
+    bpy.context.scene.GlimpseVerbose = cli_args.verbose
 
-            def check_scalar(obj, obj_namespace, prop, minimum, maximum, scale):
-                if prop in obj:
-                    val = obj[prop]
-                    if val < minimum:
-                        blender_exit("%s.%s=%f < minimum of %f" % (obj_namespace, prop, val, minimum))
-                    if val > maximum:
-                        blender_exit("%s.%s=%f > maximum of %f" % (obj_namespace, prop, val, maximum))
-                    return val * scale
-                else:
-                    blender_exit("Config missing %s.%s value" % (obj_namespace, name))
-                    return 0
-
-            if 'filters' in config:
-                filters = config['filters']
-                skip_percentage = filters.get('skip_percentage', 0)
-
-                body_whitelist = filters.get('body_whitelist', 'all')
-                if body_whitelist is not 'all':
-                    bpy.context.scene.GlimpseBodyWhitelist = ','.join(body_whitelist)
-
-                clothes_whitelist = filters.get('clothes_whitelist', 'all')
-                if clothes_whitelist is not 'all':
-                    bpy.context.scene.GlimpseClothesWhitelist = ','.join(clothes_whitelist)
-
-                tag_whitelist = filters.get('tag_whitelist', None)
-                if tag_whitelist is not None:
-                    tag_whitelist = list(set(tag_whitelist))
-                    bpy.context.scene.GlimpseBvhTagsWhitelist = ','.join(tag_whitelist)
-
-                tag_blacklist = filters.get('tag_blacklist', None)
-                if tag_blacklist is not None:
-                    tag_blacklist = list(set(tag_blacklist))
-                    bpy.context.scene.GlimpseBvhTagsBlacklist = ','.join(tag_blacklist)
-
-                if 'tag_skip_percentages' in filters:
-                    tag_skip_percentages = filters['tag_skip_percentages']
-                    tag_skip_strings = []
-                    for key in tag_skip_percentages:
-                        val = tag_skip_percentages[key]
-                        if val < 0 or val > 100:
-                            blender_exit("Skip percentage for '%s' tag out of range [0,100]" % key)
-                        tag_skip_strings += ["%s=%d" % (key, val)]
-                    bpy.context.scene.GlimpseBvhTagsSkip = ",".join(tag_skip_strings)
-                    if bpy.context.scene.GlimpseBvhTagsSkip == "":
-                        bpy.context.scene.GlimpseBvhTagsSkip = 'none'
-
-            if 'camera' not in config:
-                blender_exit('config must include "camera" description')
-
-            camera = config['camera']
-
-            bpy.context.scene.GlimpseRenderWidth = \
-                check_scalar(camera, 'camera', 'width', 240, 2048, 1)
-            bpy.context.scene.GlimpseRenderHeight = \
-                check_scalar(camera, 'camera', 'height', 240, 2048, 1)
-
-            bpy.context.scene.GlimpseVerticalFOV = \
-                check_scalar(camera, 'camera', 'vertical_fov', 20, 170, 1)
-
-            if 'position' not in camera:
-                blender_exit('config "camera" must include "position"')
-            camera_pos = camera['position']
-
-            if 'mode' not in camera_pos:
-                blender_exit('config camera.position must specify a "mode"')
-
-            camera_mode = camera_pos['mode']
-
-            if camera_mode == 'randomized':
-                bpy.context.scene.GlimpseMinCameraDistanceMM = \
-                    check_scalar(camera_pos, 'camera.position', 'min_distance',
-                                 0, 20, 1000)
-                bpy.context.scene.GlimpseMaxCameraDistanceMM = \
-                    check_scalar(camera_pos, 'camera.position', 'max_distance',
-                                 0, 20, 1000)
-                bpy.context.scene.GlimpseMinCameraHeightMM = \
-                    check_scalar(camera_pos, 'camera.position', 'min_height',
-                                 0, 20, 1000)
-                bpy.context.scene.GlimpseMaxCameraHeightMM = \
-                    check_scalar(camera_pos, 'camera.position', 'max_height',
-                                 0, 20, 1000)
-                bpy.context.scene.GlimpseMinViewingAngle = \
-                    check_scalar(camera_pos, 'camera.position', 'min_horizontal_rotation',
-                                 -180, 180, 1)
-                bpy.context.scene.GlimpseMaxViewingAngle = \
-                    check_scalar(camera_pos, 'camera.position', 'max_horizontal_rotation',
-                                 -180, 180, 1)
-
-                if (bpy.context.scene.GlimpseMaxCameraDistanceMM <
-                        bpy.context.scene.GlimpseMinCameraDistanceMM):
-                    blender_exit("Maximum camera distance must be >= minimum camera distance")
-
-                if (bpy.context.scene.GlimpseMaxCameraHeightMM <
-                        bpy.context.scene.GlimpseMinCameraHeightMM):
-                    blender_exit("Maximum camera height must be >= minimum camera height")
-
-                if (bpy.context.scene.GlimpseMaxViewingAngle <
-                        bpy.context.scene.GlimpseMinViewingAngle):
-                    blender_exit("Min viewing angle is higher than or equal to max viewing angle")
-
-                if 'focus_bone' in camera_pos:
-                    bpy.context.scene.GlimpseFocusBone = camera_pos['focus_bone']
-
-            elif camera_mode == 'smooth':
-                bpy.context.scene.GlimpseSmoothCameraMovement = True
-
-                bpy.context.scene.GlimpseMinCameraDistanceMM = \
-                    check_scalar(camera_pos, 'camera.position', 'min_distance',
-                                 0, 20, 1000)
-                bpy.context.scene.GlimpseMaxCameraDistanceMM = \
-                    check_scalar(camera_pos, 'camera.position', 'max_distance',
-                                 0, 20, 1000)
-                bpy.context.scene.GlimpseMinCameraHeightMM = \
-                    check_scalar(camera_pos, 'camera.position', 'min_height',
-                                 0, 20, 1000)
-                bpy.context.scene.GlimpseMaxCameraHeightMM = \
-                    check_scalar(camera_pos, 'camera.position', 'max_height',
-                                 0, 20, 1000)
-                bpy.context.scene.GlimpseMinViewingAngle = \
-                    check_scalar(camera_pos, 'camera.position', 'min_horizontal_rotation',
-                                 -180, 180, 1)
-                bpy.context.scene.GlimpseMaxViewingAngle = \
-                    check_scalar(camera_pos, 'camera.position', 'max_horizontal_rotation',
-                                 -180, 180, 1)
-                bpy.context.scene.GlimpseSmoothCameraFrequency = \
-                    check_scalar(camera_pos, 'camera.position', 'drift_frequency',
-                                 0, 100, 1)
-
-                if (bpy.context.scene.GlimpseMaxCameraDistanceMM <
-                        bpy.context.scene.GlimpseMinCameraDistanceMM):
-                    blender_exit("Maximum camera distance must be >= minimum camera distance")
-
-                if (bpy.context.scene.GlimpseMaxCameraHeightMM <
-                        bpy.context.scene.GlimpseMinCameraHeightMM):
-                    blender_exit("Maximum camera height must be >= minimum camera height")
-
-                if (bpy.context.scene.GlimpseMaxViewingAngle <
-                        bpy.context.scene.GlimpseMinViewingAngle):
-                    blender_exit("Min viewing angle is higher than or equal to max viewing angle")
-
-                if 'focus_bone' in camera_pos:
-                    bpy.context.scene.GlimpseFocusBone = camera_pos['focus_bone']
-            elif camera_mode == 'fixed':
-                bpy.context.scene.GlimpseFixedCamera = True
-
-                bpy.context.scene.GlimpseMinCameraDistanceMM = \
-                    check_scalar(camera_pos, 'camera.position', 'distance',
-                                 0, 20, 1000)
-                bpy.context.scene.GlimpseMinCameraHeightMM = \
-                    check_scalar(camera_pos, 'camera.position', 'height',
-                                 0, 20, 1000)
-                bpy.context.scene.GlimpseMinViewingAngle = \
-                    check_scalar(camera_pos, 'camera.position', 'horizontal_rotation',
-                                 -180, 180, 1)
-
-                if 'focus_bone' in camera_pos:
-                    bpy.context.scene.GlimpseFocusBone = camera_pos['focus_bone']
-
-            elif camera_mode == 'debug':
-                bpy.context.scene.GlimpseDebugCamera = True
-            else:
-                blender_exit('Unknown camera mode: %s (expected "randomized",'
-                             ' "smooth", "fixed" or "debug")')
-
-            if 'add_background' in config:
-                bpy.context.scene.GlimpseAddBackground = config['add_background']
-            if 'clothing_step' in config:
-                bpy.context.scene.GlimpseClothingStep = config['clothing_step']
-
-    # Note: some command line options may override the given --config
 
-    if cli_args.tags_whitelist == 'all':
-        bpy.context.scene.GlimpseBvhTagsWhitelist = 'all'
+    # Currently all the subcommands accept filtering options...
+    if cli_args.instance_overrides:
+        bpy.context.scene.GlimpseBvhGenFrom = cli_args.instance_start
+        bpy.context.scene.GlimpseBvhGenTo = cli_args.instance_end
     else:
-        whitelist_set = set(cli_args.tags_whitelist.split(','))
-        if bpy.context.scene.GlimpseBvhTagsWhitelist:
-            whitelist_set.union(set(bpy.context.scene.GlimpseBvhTagsWhitelist.split(',')))
-        bpy.context.scene.GlimpseBvhTagsWhitelist = cli_args.tags_whitelist
-
-    if cli_args.tags_blacklist != 'none':
-        blacklist_set = set(cli_args.tags_blacklist.split(','))
-        if bpy.context.scene.GlimpseBvhTagsBlacklist:
-            blacklist_set.union(set(bpy.context.scene.GlimpseBvhTagsBlacklist.split(',')))
-        bpy.context.scene.GlimpseBvhTagsBlacklist = list(blacklist_set).join(',')
+        bpy.context.scene.GlimpseBvhGenFrom = cli_args.start
+        bpy.context.scene.GlimpseBvhGenTo = cli_args.end
 
-    if cli_args.skip_percentage:
-        skip_percentage = cli_args.skip_percentage
-
-    if skip_percentage < 0 or skip_percentage > 100:
-        blender_exit("'skip_percentage' %d out of range [0,100]" % skip_percentage)
+    bpy.context.scene.GlimpseBvhTagsWhitelist = cli_args.tags_whitelist
+    bpy.context.scene.GlimpseBvhTagsBlacklist = cli_args.tags_blacklist
 
-    bpy.context.scene.GlimpseSkipPercentage = skip_percentage
-
-    if cli_args.instance_overrides and cli_args.instance_name:
-        render_name = cli_args.instance_name
-    else:
-        render_name = cli_args.name
-
-    if render_name == "":
-        print("--name argument required in this case to determine where to write results")
-        bpy.ops.wm.quit_blender()
-    bpy.context.scene.GlimpseGenDir = render_name
-
-    print("Rendering Info:")
-    print("Name: " + render_name)
-    print("Dest: " + bpy.context.scene.GlimpseDataRoot)
-
-    if not cli_args.dry_run:
-        import cProfile
-        cProfile.run("bpy.ops.glimpse.generate_data()",
-                     os.path.join(cli_args.dest,
-                                  render_name,
-                                  "glimpse-" + render_name + ".prof"))
-
-        import pstats
-        p = pstats.Stats(os.path.join(cli_args.dest,
-                                      render_name,
-                                      "glimpse-" + render_name + ".prof"))
-        p.sort_stats("cumulative").print_stats(20)
+    if cli_args.name_match:
+        bpy.context.scene.GlimpseBvhNamePatterns = ','.join(cli_args.name_match)
     else:
-        bpy.ops.glimpse.generate_data()
-
-    blender_exit()
+        bpy.context.scene.GlimpseBvhNamePatterns = ''
+
+
+    if cli_args.instance_overrides and cli_args.instance_training_data:
+        cli_args.training_data = cli_args.instance_training_data
+
+    mocaps_dir = os.path.join(cli_args.training_data, 'mocap')
+    if not os.path.isdir(mocaps_dir):
+        blender_exit("Non-existent mocaps directory %s" % mocaps_dir)
+    bpy.context.scene.GlimpseBvhRoot = mocaps_dir
+
+    if cli_args.subcommand == 'info':
+        bpy.ops.glimpse.generator_info()
+    elif cli_args.subcommand == 'preload':
+        bpy.context.scene.GlimpseDryRun = cli_args.dry_run
+        bpy.ops.glimpse.generator_preload()
+        if not cli_args.dry_run:
+            print("Saving to %s" % bpy.context.blend_data.filepath)
+            bpy.ops.wm.save_as_mainfile(filepath=bpy.context.blend_data.filepath)
+    elif cli_args.subcommand == 'link':
+        bpy.context.scene.GlimpseDryRun = cli_args.dry_run
+        bpy.context.scene.GlimpseMocapLibrary = cli_args.mocap_library
+        bpy.ops.glimpse.generator_link()
+        if not cli_args.dry_run:
+            print("Saving to %s" % bpy.context.blend_data.filepath)
+            bpy.ops.wm.save_as_mainfile(filepath=bpy.context.blend_data.filepath)
+    elif cli_args.subcommand == 'purge':
+        bpy.context.scene.GlimpseDryRun = cli_args.dry_run
+        bpy.ops.glimpse.purge_mocap_actions()
+        if not cli_args.dry_run:
+            print("Saving to %s" % bpy.context.blend_data.filepath)
+            bpy.ops.wm.save_as_mainfile(filepath=bpy.context.blend_data.filepath)
+    elif cli_args.subcommand == 'render':
+
+        bpy.context.scene.GlimpseDryRun = cli_args.dry_run
+        bpy.context.scene.GlimpseDataRoot = cli_args.dest
+        bpy.context.scene.GlimpseMetaFormat = cli_args.meta_format
+        bpy.context.scene.GlimpseCameraTrajectories = cli_args.camera_trajectories
+        bpy.context.scene.GlimpseLegacySceneUpdates = cli_args.legacy_scene_updates
+        print("DataRoot: " + cli_args.dest)
+
+        try:
+            settings = render_settings(cli_args)
+        except ValueError as e:
+            blender_exit(str(e))
+        for key in settings:
+            setattr(bpy.context.scene, key, settings[key])
+
+        if cli_args.manifest and not cli_args.dry_run:
+            bpy.context.scene.GlimpseManifest = os.path.abspath(cli_args.manifest)
+
+        if cli_args.instance_overrides and cli_args.instance_name:
+            render_name = cli_args.instance_name
+        else:
+            render_name = cli_args.name
+
+        if render_name is None:
+            render_name = date_str
+
+        if render_name == "":
+            blender_exit("--name argument required in this case to determine where to write results")
+        bpy.context.scene.GlimpseGenDir = render_name
+        if cli_args.instance_overrides:
+            bpy.context.scene.GlimpsePartSuffix = cli_args.instance_suffix
+
+        print("Rendering Info:")
+        print("Name: " + render_name)
+        print("Dest: " + bpy.context.scene.GlimpseDataRoot)
+
+        # Since mocaps may be handed to different instances each time we render,
+        # we consider the journals of all the parts of a render when resuming
+        if cli_args.resume and cli_args.name:
+            journals = glob.glob(os.path.join(glob.escape(cli_args.dest),
+                                              glob.escape(cli_args.name),
+                                              'render*.journal'))
+            journals += glob.glob(os.path.join(glob.escape(cli_args.dest),
+                                               glob.escape(cli_args.name) + '-part-*',
+                                               'render.journal'))
+            print("Resuming with journals: %s" % ", ".join(journals))
+            bpy.context.scene.GlimpseResumeJournals = os.pathsep.join(journals)
+
+        if cli_args.instance_queue:
+            # Each job is a JSON line with a mocap index start/end range and
+            # we report when we're ready for another job. The parent closes our
+            # stdin when there are no more jobs.
+            #
+            # NB: the addon accumulates per-stage timings for the frames it
+            # renders in render.timings.json (see glimpse_render_timings.py)
+            print("> QUEUE READY", flush=True)
+            for line in sys.stdin:
+                job = json.loads(line)
+                print("> QUEUE JOB: mocaps %d to %d" % (job['start'], job['end']))
+                bpy.context.scene.GlimpseBvhGenFrom = job['start']
+                bpy.context.scene.GlimpseBvhGenTo = job['end']
+                bpy.ops.glimpse.generate_data()
+                print("> QUEUE JOB DONE: %s" % line.strip(), flush=True)
+        else:
+            bpy.ops.glimpse.generate_data()
+
+
+def serve_worker(socket_path):
+    """Keep Blender resident and run subcommands sent over a unix socket
+
+    Each connection starts with a JSON line with the "argv" of a
+    subcommand, which is then run with the connection in place of
+    stdin/stdout. The connection's final line reports the exit status.
+    """
+    global worker_mode
+    worker_mode = True
+
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    server.listen(1)
+    print("Worker listening on %s" % socket_path, flush=True)
+
+    while True:
+        (conn, addr) = server.accept()
+        conn_in = conn.makefile('r', encoding='utf-8')
+        conn_out = SocketWriter(conn)
+        try:
+            request = json.loads(conn_in.readline())
+        except ValueError:
+            conn.close()
+            continue
+
+        job_argv = request['argv']
+        if request.get('shutdown'):
+            conn.close()
+            break
+
+        print("Running job: %s" % " ".join(job_argv), flush=True)
+        (real_stdin, real_stdout) = (sys.stdin, sys.stdout)
+        (sys.stdin, sys.stdout) = (conn_in, conn_out)
+        status = 0
+        try:
+            run_subcommand(parser.parse_args(job_argv))
+        except WorkerJobError as e:
+            if e.args[0]:
+                print("ERROR: %s" % str(e.args[0]))
+                status = 1
+        except SystemExit as e:
+            status = 1 if e.code else 0
+        except Exception:
+            traceback.print_exc(file=sys.stdout)
+            status = 1
+        finally:
+            (sys.stdin, sys.stdout) = (real_stdin, real_stdout)
+
+        try:
+            conn_out.write("> WORKER JOB STATUS: %d\n" % status)
+            conn_out.flush()
+        except OSError:
+            pass
+        conn.close()
+        print("Finished job (status = %d)" % status, flush=True)
+
+    server.close()
+    os.remove(socket_path)
+
+
+if cli_args.subcommand == 'worker':
+    serve_worker(cli_args.socket)
+else:
+    run_subcommand(cli_args)
+blender_exit()
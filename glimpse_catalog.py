@@ -0,0 +1,1035 @@
+#
+# Copyright (c) 2018 Glimp IP Ltd
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+# Shared helpers for the compact, binary frame catalog that
+# glimpse-data-indexer.py maintains alongside the plain-text index.full
+# (also used by glimpse-data-stats.py)
+#
+# A catalog file is a small JSON header (interned string tables, column
+# descriptions and misc attributes) followed by a number of raw, 64 byte
+# aligned column arrays that can be memory mapped directly with numpy:
+#
+#   [8 byte magic][uint64 header length][JSON header][pad][column 0][pad]...
+#
+# Every frame path "/<bvh>/<section>/<name>" is stored as three integer ids
+# into the 'bvh', 'section' and 'name' string tables, plus some columns that
+# are derived from the frame name (the frame number and whether the frame was
+# flipped by the pre-processor) so that common filters don't need to touch
+# any strings.
+#
+# The same file format is also used for a FrameMetadata table which
+# consolidates the per-frame .json meta data (body, clothes, camera and tags)
+# so that filtering by body or tag doesn't need to open a file per frame.
+#
+# Finally a FrameQuery implements a small query language for selecting
+# frames from a catalog (see FrameQuery for details).
+#
+# The meta data of a frame is either read from its .json file or, for renders
+# made with --meta-format=store, from the consolidated frame meta data stores
+# in the data directory (see blender/modules/glimpse_frame_store.py).
+
+import os
+import sys
+import re
+import json
+import uuid
+import fnmatch
+import hashlib
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                'blender', 'modules'))
+import glimpse_frame_store
+
+TABLE_MAGIC = b'GLMPTBL1'
+TABLE_ALIGN = 64
+
+
+def _align(offset):
+    return (offset + TABLE_ALIGN - 1) // TABLE_ALIGN * TABLE_ALIGN
+
+
+def write_table(filename, columns, strings=None, attrs=None):
+    """Write a dictionary of equal length numpy arrays to filename
+
+    The file is written to a temporary file first and then renamed, so
+    readers never see a partially written table.
+    """
+    n_rows = None
+    for name, column in columns.items():
+        if n_rows is None:
+            n_rows = len(column)
+        elif len(column) != n_rows:
+            raise ValueError("Inconsistent length for '%s' column" % name)
+
+    header = {
+        'n_rows': n_rows or 0,
+        'attrs': attrs or {},
+        'strings': strings or {},
+        'columns': {},
+    }
+
+    # The header needs to know the offsets of all the columns which in turn
+    # depend on the size of the header, so we first size the header with
+    # placeholder offsets that are big enough to not change the length...
+    arrays = []
+    for name, column in columns.items():
+        array = np.ascontiguousarray(column)
+        arrays.append((name, array))
+        header['columns'][name] = {
+            'dtype': array.dtype.str,
+            'shape': list(array.shape),
+            'offset': 0,
+        }
+
+    def encode_header():
+        return json.dumps(header, separators=(',', ':')).encode('utf-8')
+
+    for name, array in arrays:
+        header['columns'][name]['offset'] = 2**62
+    data_start = _align(16 + len(encode_header()))
+
+    offset = data_start
+    for name, array in arrays:
+        header['columns'][name]['offset'] = offset
+        offset = _align(offset + array.nbytes)
+    header_bytes = encode_header().ljust(data_start - 16)
+
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'wb') as fp:
+        fp.write(TABLE_MAGIC)
+        fp.write(np.uint64(len(header_bytes)).tobytes())
+        fp.write(header_bytes)
+        for name, array in arrays:
+            fp.seek(header['columns'][name]['offset'])
+            fp.write(array.tobytes())
+        fp.truncate(offset)
+    os.replace(tmp_filename, filename)
+
+
+def read_table(filename):
+    """Map a table written by write_table()
+
+    Returns a (columns, strings, attrs) tuple where columns are read-only
+    numpy memmaps of the column data.
+    """
+    with open(filename, 'rb') as fp:
+        magic = fp.read(8)
+        if magic != TABLE_MAGIC:
+            raise ValueError("%s is not a Glimpse table file" % filename)
+        header_len = int(np.frombuffer(fp.read(8), dtype=np.uint64)[0])
+        header = json.loads(fp.read(header_len).decode('utf-8'))
+
+    columns = {}
+    for name, desc in header['columns'].items():
+        dtype = np.dtype(desc['dtype'])
+        shape = tuple(desc['shape'])
+        if not np.prod(shape):
+            # numpy can't mmap an empty range of a file
+            columns[name] = np.zeros(shape, dtype=dtype)
+        else:
+            columns[name] = np.memmap(filename, dtype=dtype, mode='r',
+                                      offset=desc['offset'], shape=shape)
+
+    return (columns, header['strings'], header['attrs'])
+
+
+def parse_frame_name(name):
+    """Returns the (frame number, flipped) for a frame name like Image0001"""
+    digits = name[5:]
+    end = 0
+    while end < len(digits) and digits[end].isdigit():
+        end += 1
+    frame = int(digits[:end]) if end else 0
+    return (frame, name.endswith('flipped'))
+
+
+def _dir_sort_key(name):
+    # Sorting directory names with a trailing '/' means that sorting frames
+    # by (bvh, section, name) ids is equivalent to sorting their paths, since
+    # e.g. "/01_01-a/..." sorts before "/01_01/..." ('-' < '/')
+    return name + '/'
+
+
+def intern_strings(strings, key=None):
+    """Returns a sorted table of unique strings and an id for each string"""
+    table = sorted(set(strings), key=key)
+    lookup = {s: i for i, s in enumerate(table)}
+    return (table, np.array([lookup[s] for s in strings], dtype=np.uint32))
+
+
+class FrameCatalog:
+    """An indexed, column oriented list of all frames in a data directory
+
+    Rows are kept in the same (sorted) order as the text index.full file so
+    that a row id is interchangeable with a line number of that file. The
+    string tables are sorted such that the rows are also sorted by their
+    (bvh, section, name) ids.
+    """
+
+    def __init__(self, columns, strings, attrs=None):
+        self.bvh = columns['bvh']
+        self.section = columns['section']
+        self.name = columns['name']
+        self.frame = columns['frame']
+        self.flipped = columns['flipped']
+
+        self.bvh_names = strings['bvh']
+        self.section_names = strings['section']
+        self.frame_names = strings['name']
+
+        self.attrs = attrs if attrs is not None else {}
+        if 'version' not in self.attrs:
+            self.attrs['version'] = uuid.uuid4().hex
+
+    @classmethod
+    def _from_ids(cls, bvh_names, section_names, frame_names,
+                  bvh_ids, section_ids, name_ids, sort=True):
+        # Sorts the rows (dropping any duplicates), unless sort=False, and
+        # derives the frame number and flipped columns
+        if sort and len(bvh_ids):
+            order = np.lexsort((name_ids, section_ids, bvh_ids))
+            bvh_ids = bvh_ids[order]
+            section_ids = section_ids[order]
+            name_ids = name_ids[order]
+            unique = np.ones(len(order), dtype=bool)
+            unique[1:] = ((bvh_ids[1:] != bvh_ids[:-1]) |
+                          (section_ids[1:] != section_ids[:-1]) |
+                          (name_ids[1:] != name_ids[:-1]))
+            bvh_ids = bvh_ids[unique]
+            section_ids = section_ids[unique]
+            name_ids = name_ids[unique]
+
+        frame_numbers = np.zeros(len(frame_names), dtype=np.uint32)
+        frame_flipped = np.zeros(len(frame_names), dtype=np.uint8)
+        for i, name in enumerate(frame_names):
+            (frame_numbers[i], frame_flipped[i]) = parse_frame_name(name)
+
+        columns = {
+            'bvh': bvh_ids,
+            'section': section_ids,
+            'name': name_ids,
+            'frame': frame_numbers[name_ids],
+            'flipped': frame_flipped[name_ids],
+        }
+        strings = {
+            'bvh': list(bvh_names),
+            'section': list(section_names),
+            'name': list(frame_names),
+        }
+        return cls(columns, strings)
+
+    @classmethod
+    def from_frames(cls, bvhs, sections, names, sort=True):
+        """Create a catalog from parallel lists of bvh, section and frame names
+
+        The rows are sorted and any duplicates dropped, unless sort=False in
+        which case the given order and any duplicates are kept.
+        """
+        (bvh_names, bvh_ids) = intern_strings(bvhs, key=_dir_sort_key)
+        (section_names, section_ids) = intern_strings(sections,
+                                                      key=_dir_sort_key)
+        (frame_names, name_ids) = intern_strings(names)
+        return cls._from_ids(bvh_names, section_names, frame_names,
+                             bvh_ids, section_ids, name_ids, sort=sort)
+
+    @classmethod
+    def from_paths(cls, paths):
+        """Create a catalog from frame paths like /bvh/section/ImageNNNN
+
+        The rows keep the order of the paths, including any duplicates, since
+        an existing index may have been sampled or ordered by hand.
+        """
+        bvhs = []
+        sections = []
+        names = []
+        for path in paths:
+            path = path.strip()
+            if not path:
+                continue
+            (bvh, section, name) = path[1:].split('/')
+            bvhs.append(bvh)
+            sections.append(section)
+            names.append(name)
+        return cls.from_frames(bvhs, sections, names, sort=False)
+
+    def merge(self, keep, bvhs, sections, names):
+        """Create a new catalog from a subset of this one plus new frames
+
+        keep is a boolean array of the rows to keep from this catalog and
+        bvhs, sections and names are parallel lists of new frames to add.
+        """
+        def merge_table(old_table, new_strings, key=None):
+            table = sorted(set(old_table) | set(new_strings), key=key)
+            lookup = {s: i for i, s in enumerate(table)}
+            old_map = np.array([lookup[s] for s in old_table], dtype=np.uint32)
+            new_ids = np.array([lookup[s] for s in new_strings],
+                               dtype=np.uint32)
+            return (table, old_map, new_ids)
+
+        (bvh_names, bvh_map, bvh_ids) = \
+            merge_table(self.bvh_names, bvhs, key=_dir_sort_key)
+        (section_names, section_map, section_ids) = \
+            merge_table(self.section_names, sections, key=_dir_sort_key)
+        (frame_names, name_map, name_ids) = \
+            merge_table(self.frame_names, names)
+
+        keep = np.asarray(keep, dtype=bool)
+        return self._from_ids(
+            bvh_names, section_names, frame_names,
+            np.concatenate((bvh_map[self.bvh[keep]], bvh_ids)),
+            np.concatenate((section_map[self.section[keep]], section_ids)),
+            np.concatenate((name_map[self.name[keep]], name_ids)))
+
+    @classmethod
+    def load(cls, filename):
+        (columns, strings, attrs) = read_table(filename)
+        return cls(columns, strings, attrs)
+
+    def save(self, filename):
+        columns = {
+            'bvh': self.bvh,
+            'section': self.section,
+            'name': self.name,
+            'frame': self.frame,
+            'flipped': self.flipped,
+        }
+        strings = {
+            'bvh': self.bvh_names,
+            'section': self.section_names,
+            'name': self.frame_names,
+        }
+        write_table(filename, columns, strings, self.attrs)
+
+    @property
+    def version(self):
+        return self.attrs['version']
+
+    def __len__(self):
+        return len(self.bvh)
+
+    def path(self, i):
+        return "/%s/%s/%s" % (self.bvh_names[self.bvh[i]],
+                              self.section_names[self.section[i]],
+                              self.frame_names[self.name[i]])
+
+    def paths(self, ids):
+        """Returns the frame paths for an array of row ids"""
+        bvh_names = self.bvh_names
+        section_names = self.section_names
+        frame_names = self.frame_names
+        bvh = self.bvh[ids].tolist()
+        section = self.section[ids].tolist()
+        name = self.name[ids].tolist()
+        return ["/%s/%s/%s" % (bvh_names[b], section_names[s], frame_names[n])
+                for (b, s, n) in zip(bvh, section, name)]
+
+    def bvh_ids(self, bvh_names):
+        """Map a list of bvh names to ids (ignoring unknown names)"""
+        lookup = {name: i for i, name in enumerate(self.bvh_names)}
+        return np.array([lookup[name] for name in bvh_names if name in lookup],
+                        dtype=np.uint32)
+
+    def keys(self):
+        """Returns an int64 key for each row
+
+        The keys are in ascending order for catalogs created by crawling,
+        but not necessarily for a catalog loaded from an existing index.
+        """
+        n_sections = len(self.section_names)
+        n_names = len(self.frame_names)
+        return ((self.bvh.astype(np.int64) * n_sections + self.section) *
+                n_names + self.name)
+
+    def lookup(self, paths):
+        """Map frame paths like /bvh/section/ImageNNNN to row ids
+
+        Returns an array with the row id of each path, or -1 for paths that
+        aren't in the catalog.
+        """
+        bvh_lookup = {name: i for i, name in enumerate(self.bvh_names)}
+        section_lookup = {name: i for i, name in enumerate(self.section_names)}
+        name_lookup = {name: i for i, name in enumerate(self.frame_names)}
+        n_sections = len(self.section_names)
+        n_names = len(self.frame_names)
+
+        # Paths will typically share a small number of /bvh/section/ prefixes
+        prefix_keys = {}
+
+        def prefix_key(prefix):
+            try:
+                (bvh, section) = prefix[1:].split('/')
+                return (bvh_lookup[bvh] * n_sections +
+                        section_lookup[section]) * n_names
+            except (ValueError, KeyError):
+                return -1
+
+        query = []
+        for path in paths:
+            (prefix, sep, name) = path.strip().rpartition('/')
+            if prefix not in prefix_keys:
+                prefix_keys[prefix] = prefix_key(prefix)
+            key = prefix_keys[prefix]
+            if key < 0 or name not in name_lookup:
+                query.append(-1)
+            else:
+                query.append(key + name_lookup[name])
+        query = np.array(query, dtype=np.int64)
+
+        keys = self.keys()
+        if len(keys) > 1 and not np.all(keys[1:] > keys[:-1]):
+            # Catalogs loaded from an existing index (or created before the
+            # string tables were sorted to match the row order) need an
+            # explicit sort, which is stable so a duplicated frame maps to
+            # its first row...
+            order = np.argsort(keys, kind='mergesort')
+            keys = keys[order]
+        else:
+            order = None
+
+        # Searching with sorted queries is much more cache friendly
+        query_order = np.argsort(query)
+        ids = np.empty(len(query), dtype=np.int64)
+        ids[query_order] = np.searchsorted(keys, query[query_order])
+        ids[ids >= len(keys)] = 0
+        found = (query >= 0) & (keys[ids] == query) if len(keys) else \
+            np.zeros(len(query), dtype=bool)
+        if order is not None:
+            ids = order[ids]
+        return np.where(found, ids, -1)
+
+    def write_index(self, filename, ids):
+        """Export the given rows as a plain text index file"""
+        paths = self.paths(ids)
+        with open(filename, 'w+') as fp:
+            if paths:
+                fp.write('\n'.join(paths))
+                fp.write('\n')
+
+
+frame_stores_cache = {}
+
+
+def load_frame_stores(data_dir):
+    """Returns a dict mapping frame paths to (store, position) tuples
+
+    This covers the latest record of every frame found in the frame meta
+    data stores of data_dir (one store per Blender instance that rendered
+    into the directory). The stores are only loaded once per data_dir.
+    """
+    if data_dir in frame_stores_cache:
+        return frame_stores_cache[data_dir]
+
+    frames = {}
+    for name in glimpse_frame_store.store_names(data_dir):
+        store = glimpse_frame_store.FrameMetaStore(data_dir, name)
+        for i in store.latest():
+            frames[store.frame_path(i)] = (store, i)
+
+    frame_stores_cache[data_dir] = frames
+    return frames
+
+
+def load_frame_meta(data_dir, path):
+    """Load the meta data for a frame
+
+    The meta data is read from a frame meta data store if the frame is found
+    in one, and otherwise from labels/<bvh>/<section>/<name>.json
+    """
+    frame_stores = load_frame_stores(data_dir)
+    if path in frame_stores:
+        (store, i) = frame_stores[path]
+        return store.frame_meta(i)
+
+    meta_filename = os.path.join(data_dir, 'labels', path[1:] + ".json")
+    with open(meta_filename, 'r') as fp:
+        return json.load(fp)
+
+
+def frame_meta_mtime(data_dir, path):
+    """The modification time (in ns) of a frame's .json meta data file
+
+    Returns -1 if the file doesn't exist.
+    """
+    meta_filename = os.path.join(data_dir, 'labels', path[1:] + ".json")
+    try:
+        return os.stat(meta_filename).st_mtime_ns
+    except FileNotFoundError:
+        return -1
+
+
+def summarize_frame_meta(meta):
+    """Extract the (body, clothes, tags, distance, angle) of a frame
+
+    Clothes are returned as a "hat=x,top=y" string and tags as a "run,walk"
+    string, which are the forms stored in a FrameMetadata table.
+    """
+    clothes_meta = meta.get('clothes', {})
+    camera_meta = meta.get('camera', {})
+    return (meta.get('body', ''),
+            ','.join("%s=%s" % (key, clothes_meta[key])
+                     for key in sorted(clothes_meta)),
+            ','.join(sorted(meta.get('tags', {}))),
+            camera_meta.get('distance', np.nan),
+            camera_meta.get('viewing_angle', np.nan))
+
+
+def summarize_frames(data_dir, paths):
+    """Returns summarize_frame_meta() results for a list of frame paths
+
+    Frames whose meta data can't be loaded are returned as None. This is
+    suitable for running in a separate process over chunks of an index.
+    """
+    results = []
+    for path in paths:
+        try:
+            results.append(summarize_frame_meta(load_frame_meta(data_dir,
+                                                                path)))
+        except (IOError, ValueError):
+            results.append(None)
+    return results
+
+
+class Interner:
+    """Helper for appending strings to an existing string table"""
+
+    def __init__(self, table):
+        self.table = list(table)
+        self.lookup = {s: i for i, s in enumerate(self.table)}
+
+    def __call__(self, string):
+        if string not in self.lookup:
+            self.lookup[string] = len(self.table)
+            self.table.append(string)
+        return self.lookup[string]
+
+
+class FrameMetadata:
+    """Per-frame meta data, consolidated from the frame .json files
+
+    The rows of this table are aligned with the rows of a FrameCatalog so
+    it can be indexed with the same row ids. Only the properties we filter
+    or report statistics on are kept (so no bones). Frames whose .json
+    couldn't be loaded are marked as not 'valid', and their 'failed_mtime'
+    records the modification time of the .json file (or -1 if there was no
+    file) so they're only tried again once the file has changed.
+
+    The body, clothing and tags of each frame are interned: clothing
+    combinations are stored as strings like "hat=patrol_cap,top=none" and
+    tag sets as comma separated, sorted tag names.
+
+    We also keep a copy of the catalog's frame keys so that the table can be
+    incrementally updated if the catalog is re-created, only loading the
+    .json files for new frames.
+    """
+
+    columns = ['valid', 'failed_mtime', 'body', 'clothes', 'tags',
+               'camera_distance', 'camera_viewing_angle']
+
+    def __init__(self, columns, strings, attrs):
+        self.valid = columns['valid']
+        # Tables saved before we tracked failures will retry all invalid
+        # frames once
+        if 'failed_mtime' in columns:
+            self.failed_mtime = columns['failed_mtime']
+        else:
+            self.failed_mtime = np.zeros(len(self.valid), dtype=np.int64)
+        self.body = columns['body']
+        self.clothes = columns['clothes']
+        self.tags = columns['tags']
+        self.camera_distance = columns['camera_distance']
+        self.camera_viewing_angle = columns['camera_viewing_angle']
+
+        self.body_names = strings['body']
+        self.clothes_sets = strings['clothes']
+        self.tag_sets = strings['tags']
+
+        self._keys = (columns['key_bvh'], columns['key_section'],
+                      columns['key_name'])
+        self._key_strings = (strings['key_bvh'], strings['key_section'],
+                             strings['key_name'])
+        self.attrs = attrs
+
+    @classmethod
+    def load(cls, filename):
+        (columns, strings, attrs) = read_table(filename)
+        return cls(columns, strings, attrs)
+
+    def save(self, filename):
+        columns = {name: getattr(self, name) for name in self.columns}
+        (columns['key_bvh'], columns['key_section'],
+         columns['key_name']) = self._keys
+        strings = {
+            'body': self.body_names,
+            'clothes': self.clothes_sets,
+            'tags': self.tag_sets,
+        }
+        (strings['key_bvh'], strings['key_section'],
+         strings['key_name']) = self._key_strings
+        write_table(filename, columns, strings, self.attrs)
+
+    def __len__(self):
+        return len(self.valid)
+
+    @property
+    def catalog_version(self):
+        return self.attrs['catalog_version']
+
+    @property
+    def version(self):
+        # Tables saved before we tracked a version are identified by the
+        # catalog they were built for
+        return self.attrs.get('version', self.catalog_version)
+
+    def _key_paths(self):
+        (bvh, section, name) = self._keys
+        (bvh_names, section_names, frame_names) = self._key_strings
+        return ["/%s/%s/%s" % (bvh_names[b], section_names[s], frame_names[n])
+                for (b, s, n) in zip(bvh.tolist(), section.tolist(),
+                                     name.tolist())]
+
+    @classmethod
+    def update(cls, catalog, data_dir, filename, verbose=False):
+        """Load and (if necessary) update the meta data for a catalog
+
+        Meta data is copied from any existing table at filename and only
+        the .json files for frames not found in that table are loaded, or
+        that failed to load before but have changed since. The updated table
+        is saved back to filename.
+        """
+        try:
+            old = cls.load(filename)
+        except FileNotFoundError:
+            old = None
+
+        if (old is not None and old.catalog_version == catalog.version and
+                np.all(old.valid)):
+            return old
+
+        n_rows = len(catalog)
+        columns = {
+            'valid': np.zeros(n_rows, dtype=np.uint8),
+            'failed_mtime': np.zeros(n_rows, dtype=np.int64),
+            'body': np.zeros(n_rows, dtype=np.uint32),
+            'clothes': np.zeros(n_rows, dtype=np.uint32),
+            'tags': np.zeros(n_rows, dtype=np.uint32),
+            'camera_distance': np.full(n_rows, np.nan, dtype=np.float32),
+            'camera_viewing_angle': np.full(n_rows, np.nan, dtype=np.float32),
+        }
+
+        if old is not None:
+            bodies = Interner(old.body_names)
+            clothes = Interner(old.clothes_sets)
+            tags = Interner(old.tag_sets)
+
+            if old.catalog_version == catalog.version:
+                dst = src = np.arange(n_rows)
+            else:
+                print("Re-aligning frame meta data with updated catalog...")
+                old_rows = {path: i for i, path in enumerate(old._key_paths())}
+                pairs = [(i, old_rows[path])
+                         for i, path in enumerate(catalog.paths(np.arange(n_rows)))
+                         if path in old_rows]
+                dst = np.array([i for (i, j) in pairs], dtype=np.int64)
+                src = np.array([j for (i, j) in pairs], dtype=np.int64)
+
+            for name in cls.columns:
+                columns[name][dst] = getattr(old, name)[src]
+        else:
+            bodies = Interner([])
+            clothes = Interner([])
+            tags = Interner([])
+
+        missing = np.flatnonzero(columns['valid'] == 0)
+        missing_paths = catalog.paths(missing)
+        mtimes = [frame_meta_mtime(data_dir, path) for path in missing_paths]
+
+        # Frames that failed to load before are only retried if their .json
+        # has changed since or they've been found in a frame meta data store
+        failed_mtime = columns['failed_mtime'][missing].tolist()
+        frame_stores = load_frame_stores(data_dir)
+        retry = [failed == 0 or failed != mtime or path in frame_stores
+                 for (path, mtime, failed) in zip(missing_paths, mtimes,
+                                                  failed_mtime)]
+        n_unchanged = retry.count(False)
+        if n_unchanged:
+            print("Skipping %u frames whose meta data failed to load before "
+                  "and hasn't changed" % n_unchanged)
+
+        n_retry = len(retry) - n_unchanged
+        if n_retry:
+            print("Loading meta data for %u frames..." % n_retry)
+        n_errors = 0
+        n_loaded = 0
+        for (i, path, mtime, try_load) in zip(missing.tolist(), missing_paths,
+                                              mtimes, retry):
+            if not try_load:
+                continue
+            try:
+                meta = load_frame_meta(data_dir, path)
+            except (IOError, ValueError) as e:
+                n_errors += 1
+                columns['failed_mtime'][i] = mtime
+                if verbose:
+                    print("Failed to load meta data for %s: %s" % (path, e))
+                continue
+
+            (body, clothes_set, tags_set, distance, angle) = \
+                summarize_frame_meta(meta)
+            columns['body'][i] = bodies(body)
+            columns['clothes'][i] = clothes(clothes_set)
+            columns['tags'][i] = tags(tags_set)
+            columns['camera_distance'][i] = distance
+            columns['camera_viewing_angle'][i] = angle
+            columns['valid'][i] = 1
+            columns['failed_mtime'][i] = 0
+            n_loaded += 1
+
+        if n_errors:
+            print("WARNING: Failed to load meta data for %u frames" % n_errors)
+
+        # Avoid bumping the version (invalidating cached query results) if
+        # nothing changed, besides recording which frames failed to load
+        version = uuid.uuid4().hex
+        if (old is not None and old.catalog_version == catalog.version and
+                not n_loaded):
+            if np.array_equal(columns['failed_mtime'], old.failed_mtime):
+                return old
+            version = old.version
+
+        columns['key_bvh'] = catalog.bvh
+        columns['key_section'] = catalog.section
+        columns['key_name'] = catalog.name
+        strings = {
+            'body': bodies.table,
+            'clothes': clothes.table,
+            'tags': tags.table,
+            'key_bvh': catalog.bvh_names,
+            'key_section': catalog.section_names,
+            'key_name': catalog.frame_names,
+        }
+        attrs = {
+            'catalog_version': catalog.version,
+            'version': version,
+        }
+
+        metadata = cls(columns, strings, attrs)
+        metadata.save(filename)
+        return metadata
+
+    def body_ids(self, body_names):
+        """Map a list of body names to ids (ignoring unknown names)"""
+        return np.array([i for i, name in enumerate(self.body_names)
+                         if name in body_names], dtype=np.uint32)
+
+    def tag_set(self, tags_id):
+        tags = self.tag_sets[tags_id]
+        return set(tags.split(',')) if tags else set()
+
+    def clothes_set(self, clothes_id):
+        clothes = self.clothes_sets[clothes_id]
+        return dict(entry.split('=', 1) for entry in clothes.split(',')
+                    if entry)
+
+    def tags_match(self, tags):
+        """Returns a boolean per tag set id for whether any tags match"""
+        tags = set(tags)
+        return np.array([bool(self.tag_set(i) & tags)
+                         for i in range(len(self.tag_sets))], dtype=bool)
+
+
+_QUERY_TOKEN_RE = re.compile(r"""\s*(?:
+    (?P<cmp><=|>=|!=|=|<|>|:) |
+    (?P<op>[&|!()]) |
+    "(?P<quoted>(?:[^"\\]|\\.)*)" |
+    (?P<word>[^\s&|!()<>=:"]+)
+    )""", re.VERBOSE)
+
+
+class FrameQuery:
+    """A query for selecting frames, like "tag:walk & !body:Man2"
+
+    Queries are made of terms combined with '&' (and), '|' (or), '!' (not)
+    and parentheses. Terms are one of:
+
+      bvh:PATTERN, section:PATTERN, body:PATTERN  Glob style name matching
+      bvh=NAME, bvh!=NAME, (etc)                  Exact name matching
+      tag:PATTERN                                 Frames with a matching tag
+      clothes:PATTERN                             Frames with matching clothing
+                                                  (e.g. clothes:*cap or
+                                                  clothes:hat=none)
+      flipped=true, flipped=false                 Flipped frames (or not)
+      frame, distance, angle <op> NUMBER          Compare frame numbers, camera
+                                                  distance or viewing angle,
+                                                  with op one of = != < <= > >=
+
+    Values containing special characters can be "quoted", using JSON style
+    backslash escapes within the quotes (e.g. "a \\"quoted\\" name"). Terms
+    other than bvh, section, flipped and frame depend on a FrameMetadata
+    table and frames without any meta data never match queries using these
+    terms.
+    """
+
+    name_fields = ['bvh', 'section', 'body', 'tag', 'clothes']
+    number_fields = ['frame', 'distance', 'angle']
+    bool_fields = ['flipped']
+    metadata_fields = ['body', 'tag', 'clothes', 'distance', 'angle']
+
+    def __init__(self, text):
+        self._tokens = self._tokenize(text)
+        self._pos = 0
+        self.tree = self._parse_or()
+        if self._pos != len(self._tokens):
+            raise ValueError("Unexpected '%s' in query" %
+                             self._tokens[self._pos][1])
+        del self._tokens
+
+        self.text = self._format(self.tree)
+        self.uses_metadata = self._uses_metadata(self.tree)
+
+    @staticmethod
+    def _tokenize(text):
+        tokens = []
+        pos = 0
+        text = text.strip()
+        while pos < len(text):
+            match = _QUERY_TOKEN_RE.match(text, pos)
+            if not match or match.end() == pos:
+                raise ValueError("Failed to parse query at '%s'" % text[pos:])
+            kind = match.lastgroup
+            value = match.group(kind)
+            if kind == 'quoted':
+                # Quoted values use JSON string escapes (which is also how
+                # they're formatted)
+                kind = 'word'
+                try:
+                    value = json.loads('"%s"' % value)
+                except ValueError:
+                    raise ValueError("Invalid escape in quoted value '%s'" %
+                                     value)
+            tokens.append((kind, value))
+            pos = match.end()
+        return tokens
+
+    def _peek(self):
+        if self._pos < len(self._tokens):
+            return self._tokens[self._pos]
+        return (None, None)
+
+    def _next(self, kind, what):
+        token = self._peek()
+        if token[0] != kind:
+            raise ValueError("Expected %s in query, found '%s'" %
+                             (what, token[1] if token[1] else "end of query"))
+        self._pos += 1
+        return token[1]
+
+    def _parse_or(self):
+        node = self._parse_and()
+        while self._peek() == ('op', '|'):
+            self._pos += 1
+            node = ('or', node, self._parse_and())
+        return node
+
+    def _parse_and(self):
+        node = self._parse_not()
+        while self._peek() == ('op', '&'):
+            self._pos += 1
+            node = ('and', node, self._parse_not())
+        return node
+
+    def _parse_not(self):
+        if self._peek() == ('op', '!'):
+            self._pos += 1
+            return ('not', self._parse_not())
+        if self._peek() == ('op', '('):
+            self._pos += 1
+            node = self._parse_or()
+            self._next('op', "')'")
+            return node
+        return self._parse_term()
+
+    def _parse_term(self):
+        field = self._next('word', "a term").lower()
+        op = self._next('cmp', "a comparison after '%s'" % field)
+        value = self._next('word', "a value after '%s%s'" % (field, op))
+
+        if field in self.name_fields:
+            if op not in (':', '=', '!='):
+                raise ValueError("Can't compare %s with '%s'" % (field, op))
+        elif field in self.number_fields:
+            if op == ':':
+                raise ValueError("%s should be compared with one of "
+                                 "= != < <= > >=" % field)
+            try:
+                value = float(value)
+            except ValueError:
+                raise ValueError("Expected a number to compare %s with" % field)
+        elif field in self.bool_fields:
+            if op not in ('=', '!='):
+                raise ValueError("%s should be compared with = or !=" % field)
+            if value.lower() not in ('true', 'false'):
+                raise ValueError("Expected true or false for %s" % field)
+            value = (value.lower() == 'true')
+        else:
+            raise ValueError("Unknown query term '%s'" % field)
+
+        return ('term', field, op, value)
+
+    def _format(self, node):
+        kind = node[0]
+        if kind == 'term':
+            (field, op, value) = node[1:]
+            if isinstance(value, bool):
+                value = 'true' if value else 'false'
+            elif isinstance(value, float):
+                value = repr(value)
+            else:
+                value = json.dumps(value)
+            return '%s%s%s' % (field, op, value)
+        elif kind == 'not':
+            return '!%s' % self._format(node[1])
+        else:
+            sep = ' & ' if kind == 'and' else ' | '
+            return '(%s%s%s)' % (self._format(node[1]), sep,
+                                 self._format(node[2]))
+
+    def _uses_metadata(self, node):
+        if node[0] == 'term':
+            return node[1] in self.metadata_fields
+        return any(self._uses_metadata(child) for child in node[1:])
+
+    def __str__(self):
+        return self.text
+
+    @staticmethod
+    def _match_table(table, op, pattern, split=None):
+        # Returns a boolean per string table entry
+        def match(string):
+            if split is None:
+                values = [string]
+            else:
+                values = split(string)
+            if op == ':':
+                return any(fnmatch.fnmatchcase(value, pattern)
+                           for value in values)
+            else:
+                return pattern in values
+        result = np.array([match(string) for string in table], dtype=bool)
+        if op == '!=':
+            result = ~result
+        return result
+
+    @staticmethod
+    def _compare(column, op, value):
+        if op == '=':
+            return column == value
+        elif op == '!=':
+            return column != value
+        elif op == '<':
+            return column < value
+        elif op == '<=':
+            return column <= value
+        elif op == '>':
+            return column > value
+        else:
+            return column >= value
+
+    def _evaluate(self, node, catalog, metadata):
+        kind = node[0]
+        if kind == 'and':
+            return (self._evaluate(node[1], catalog, metadata) &
+                    self._evaluate(node[2], catalog, metadata))
+        elif kind == 'or':
+            return (self._evaluate(node[1], catalog, metadata) |
+                    self._evaluate(node[2], catalog, metadata))
+        elif kind == 'not':
+            return ~self._evaluate(node[1], catalog, metadata)
+
+        (field, op, value) = node[1:]
+        if field == 'bvh':
+            return self._match_table(catalog.bvh_names, op,
+                                     value)[catalog.bvh]
+        elif field == 'section':
+            return self._match_table(catalog.section_names, op,
+                                     value)[catalog.section]
+        elif field == 'body':
+            return self._match_table(metadata.body_names, op,
+                                     value)[metadata.body]
+        elif field == 'tag':
+            return self._match_table(
+                metadata.tag_sets, op, value,
+                split=lambda tags: tags.split(',') if tags else [])[
+                    metadata.tags]
+        elif field == 'clothes':
+            def split_clothes(clothes):
+                entries = clothes.split(',') if clothes else []
+                return entries + [entry.split('=', 1)[-1] for entry in entries]
+            return self._match_table(metadata.clothes_sets, op, value,
+                                     split=split_clothes)[metadata.clothes]
+        elif field == 'flipped':
+            return self._compare(catalog.flipped != 0, op, value)
+        elif field == 'frame':
+            return self._compare(catalog.frame, op, value)
+        elif field == 'distance':
+            return self._compare(metadata.camera_distance, op, value)
+        else:
+            return self._compare(metadata.camera_viewing_angle, op, value)
+
+    def evaluate(self, catalog, metadata=None):
+        """Returns a boolean mask of the catalog rows matching the query"""
+        if self.uses_metadata and metadata is None:
+            raise ValueError("Query '%s' requires frame meta data" % self.text)
+        mask = self._evaluate(self.tree, catalog, metadata)
+        if self.uses_metadata:
+            mask &= metadata.valid != 0
+        return mask
+
+    def cache_key(self, catalog, metadata=None):
+        key = 'query=%s\ncatalog=%s\n' % (self.text, catalog.version)
+        if self.uses_metadata:
+            key += 'metadata=%s\n' % metadata.version
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def cached_evaluate(self, catalog, metadata, cache_dir):
+        """Like evaluate() but caches results as bitmaps under cache_dir
+
+        Returns a (mask, cached) tuple where cached is True if the result
+        was loaded from the cache.
+        """
+        filename = os.path.join(cache_dir,
+                                self.cache_key(catalog, metadata) + '.bits')
+        try:
+            bits = np.fromfile(filename, dtype=np.uint8)
+            mask = np.unpackbits(bits)[:len(catalog)].astype(bool)
+            if len(bits) == (len(catalog) + 7) // 8:
+                return (mask, True)
+        except (IOError, ValueError):
+            pass
+
+        mask = self.evaluate(catalog, metadata)
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_filename = filename + '.tmp'
+        np.packbits(mask).tofile(tmp_filename)
+        os.replace(tmp_filename, filename)
+        return (mask, False)